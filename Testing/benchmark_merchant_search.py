@@ -0,0 +1,114 @@
+import argparse
+import os
+import statistics
+import sys
+import time
+from datetime import date
+import sqlalchemy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from src import database as db
+from src.api.transactions import list_transactions_sql, search_transactions_sql
+
+# Times merchant search for the heaviest and a typical user, with and without
+# the trigram index from migration 0004. Run it against a scratch database that
+# has been migrated (python -m src.migrations): it adds fake users and
+# transactions until there are --rows transactions.
+#
+#     python Testing/benchmark_merchant_search.py --rows 1000000
+
+TRGM_INDEX = "transactions_merchant_trgm_idx"
+
+parser = argparse.ArgumentParser(description="Benchmark merchant search.")
+parser.add_argument("--rows", type=int, default=1_000_000, help="transactions to have in the table")
+parser.add_argument("--users", type=int, default=2000, help="users to spread new transactions over")
+parser.add_argument("--runs", type=int, default=20, help="timed runs per query")
+parser.add_argument("--terms", nargs="+", default=["coffee", "Golden Bakery #317"], help="search terms, broad and narrow")
+args = parser.parse_args()
+
+engine = db.engine
+
+def seed(connection):
+    existing = connection.execute(sqlalchemy.text("SELECT count(*) FROM transactions")).scalar_one()
+    missing = args.rows - existing
+    if missing <= 0:
+        return
+
+    print(f"adding {missing} transactions...")
+    first_user = connection.execute(sqlalchemy.text(
+        """
+        INSERT INTO users (name, email)
+        SELECT 'Bench User ' || g, 'bench' || g || '@example.com'
+        FROM generate_series(1, :users) AS g
+        RETURNING id
+        """
+    ), {"users": args.users}).scalars().all()[0]
+
+    # cubing random() skews rows towards the first users, so a few users end up
+    # with tens of thousands of transactions like real power users
+    connection.execute(sqlalchemy.text(
+        """
+        INSERT INTO transactions (user_id, merchant, description, date)
+        SELECT
+            :first_user + floor(:users * power(random(), 3))::bigint,
+            (ARRAY['Blue', 'Golden', 'Corner', 'Urban', 'Happy', 'Green', 'Star', 'Pacific', 'Metro', 'Lucky'])[1 + floor(random() * 10)::int]
+                || ' ' || (ARRAY['Coffee', 'Market', 'Books', 'Hardware', 'Pharmacy', 'Diner', 'Outfitters', 'Grill', 'Bakery', 'Garage'])[1 + floor(random() * 10)::int]
+                || ' #' || floor(random() * 500)::int,
+            'benchmark',
+            DATE '2020-01-01' + floor(random() * 1500)::int
+        FROM generate_series(1, :missing)
+        """
+    ), {"first_user": first_user, "users": args.users, "missing": missing})
+    connection.execute(sqlalchemy.text("ANALYZE transactions"))
+
+def pick_users(connection):
+    rows = connection.execute(sqlalchemy.text(
+        """
+        SELECT user_id, count(*) AS n
+        FROM transactions
+        GROUP BY user_id
+        ORDER BY n DESC
+        """
+    )).all()
+    return {"heaviest": rows[0], "typical": rows[len(rows) // 2]}
+
+def time_query(connection, statement, params):
+    timings = []
+    for _ in range(args.runs):
+        start_time = time.perf_counter()
+        connection.execute(statement, params).all()
+        timings.append((time.perf_counter() - start_time) * 1000)
+
+    plan = "\n".join(connection.execute(sqlalchemy.text(f"EXPLAIN {statement.text}"), params).scalars())
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.95) - 1], TRGM_INDEX in plan
+
+def run(connection, label):
+    listing = sqlalchemy.text(list_transactions_sql("date", "asc", False, "offset"))
+    search = sqlalchemy.text(search_transactions_sql(False))
+
+    for size, (user_id, count) in pick_users(connection).items():
+        for term in args.terms:
+            queries = {
+                "ILIKE": (listing, {"merchant": f"%{term}%", "search": None}),
+                "search": (search, {"merchant": "%", "search": term}),
+            }
+            for name, (statement, params) in queries.items():
+                params = {"user_id": user_id, "transaction_id": -1, "date_from": date(1000, 1, 1), "date_to": date(9999, 12, 31),
+                          "page_size": 10, "offset": 0, **params}
+                median, p95, uses_index = time_query(connection, statement, params)
+                print(f"{label:<14} {size:<8} ({count:>6} rows)  {name:<6} {term!r:<22} "
+                      f"median {median:8.2f} ms  p95 {p95:8.2f} ms  trgm index: {'yes' if uses_index else 'no'}")
+
+with engine.begin() as connection:
+    seed(connection)
+
+with engine.connect() as connection:
+    run(connection, "with index")
+    connection.rollback()
+
+    # dropping the index inside a transaction that is rolled back leaves the table as it was
+    with connection.begin() as transaction:
+        connection.execute(sqlalchemy.text(f"DROP INDEX IF EXISTS {TRGM_INDEX}"))
+        run(connection, "without index")
+        transaction.rollback()
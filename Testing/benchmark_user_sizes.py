@@ -0,0 +1,140 @@
+import argparse
+import asyncio
+import contextlib
+import math
+import os
+import random
+import sys
+import time
+import httpx
+import sqlalchemy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from src import database as db
+from src.api import auth
+
+# Times the endpoints that slow down with the size of the user, and reports
+# p50/p95/p99 per endpoint for each size of user, by purchases. Run it
+# against a scratch database filled with one of the skewed profiles, so
+# there are whales to time:
+#
+#     python Testing/populate_posts.py --rows 1000000 --profile zipf
+#     python Testing/benchmark_user_sizes.py
+#
+# Requests go through the app in this process, or to a running server with
+# --url, and the cache is cleared before each one unless --warm-cache is
+# given. delete_user really deletes users, so it runs last and only for
+# --deletes users per bucket; populate again before the next run.
+
+# (label, at least, fewer than) purchases
+BUCKETS = [
+    ("<100", 0, 100),
+    ("100-1k", 100, 1000),
+    ("1k-10k", 1000, 10000),
+    ("10k-100k", 10000, 100000),
+    ("100k+", 100000, math.inf),
+]
+
+READ_ENDPOINTS = {
+    "get_all_purchases_warranty": "/user/{user_id}/budgets/warranty",
+    "/budgets/categories": "/user/{user_id}/budgets/categories",
+    "get_transactions": "/user/{user_id}/transactions/",
+}
+
+PERCENTILES = [50, 95, 99]
+
+parser = argparse.ArgumentParser(description="Benchmark endpoint tail latency by user size.")
+parser.add_argument("--users-per-bucket", type=int, default=20, help="users sampled from each bucket")
+parser.add_argument("--runs", type=int, default=5, help="timed requests per user and read endpoint")
+parser.add_argument("--deletes", type=int, default=3, help="users deleted per bucket, 0 to skip delete_user")
+parser.add_argument("--seed", type=int, default=42, help="which users are sampled")
+parser.add_argument("--url", help="a running server to benchmark instead of the app in this process")
+parser.add_argument("--api-key", default=auth.DEMO_KEY)
+parser.add_argument("--warm-cache", action="store_true", help="don't clear the cache before each request")
+args = parser.parse_args()
+
+def sample_users():
+    """Sampled user ids for each bucket, the ones to delete kept apart from the rest."""
+    with db.engine.connect() as connection:
+        sizes = connection.execute(sqlalchemy.text(
+            """
+            SELECT users.id, count(purchases.id) AS purchases
+            FROM users
+            LEFT JOIN purchases ON purchases.user_id = users.id
+            GROUP BY users.id
+            ORDER BY users.id
+            """
+        )).all()
+
+    rng = random.Random(args.seed)
+    samples = {}
+    for label, low, high in BUCKETS:
+        user_ids = [user_id for user_id, purchases in sizes if low <= purchases < high]
+        # reads all run before the deletes, so the same users can be in both
+        deletes = rng.sample(user_ids, min(args.deletes, len(user_ids)))
+        samples[label] = {
+            "users": len(user_ids),
+            "reads": rng.sample(user_ids, min(args.users_per_bucket, len(user_ids))),
+            "deletes": deletes,
+        }
+    return samples
+
+def percentile(timings, p):
+    # nearest rank
+    ordered = sorted(timings)
+    return ordered[max(math.ceil(len(ordered) * p / 100) - 1, 0)]
+
+async def time_request(client, method, path):
+    if not args.warm_cache:
+        (await client.delete("/admin/cache/")).raise_for_status()
+    start_time = time.perf_counter()
+    response = await client.request(method, path)
+    elapsed = (time.perf_counter() - start_time) * 1000
+    response.raise_for_status()
+    return elapsed
+
+async def run(client, samples):
+    timings = {}
+    for endpoint, path in READ_ENDPOINTS.items():
+        for label, sample in samples.items():
+            timings[endpoint, label] = [
+                await time_request(client, "GET", path.format(user_id=user_id))
+                for user_id in sample["reads"] for _ in range(args.runs)
+            ]
+    for label, sample in samples.items():
+        timings["delete_user", label] = [
+            await time_request(client, "DELETE", f"/user/{user_id}") for user_id in sample["deletes"]
+        ]
+    return timings
+
+def report(samples, timings):
+    print(f"{'endpoint':<28} {'bucket':<9} {'users':>7} {'requests':>8}"
+          + "".join(f" {f'p{p} ms':>10}" for p in PERCENTILES))
+    for (endpoint, label), values in timings.items():
+        if not values:
+            continue
+        print(f"{endpoint:<28} {label:<9} {samples[label]['users']:>7} {len(values):>8}"
+              + "".join(f" {percentile(values, p):>10.2f}" for p in PERCENTILES))
+
+async def main():
+    samples = sample_users()
+    headers = {"access_token": args.api_key}
+
+    if args.url:
+        async with httpx.AsyncClient(base_url=args.url, headers=headers, timeout=None) as client:
+            timings = await run(client, samples)
+    else:
+        from src.api.server import app
+        await app.router.startup()
+        try:
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", headers=headers, timeout=None) as client:
+                # the handlers print what they return, which for a whale is a lot
+                with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                    timings = await run(client, samples)
+        finally:
+            await app.router.shutdown()
+
+    report(samples, timings)
+
+asyncio.run(main())
@@ -1,8 +1,82 @@
-import sqlalchemy
+import argparse
+import collections
+import functools
+import io
 import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date
 import dotenv
-from faker import Faker
 import numpy as np
+import psycopg2
+import sqlalchemy
+from faker import Faker
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from src import migrations
+
+# Rebuilds the database from scratch and fills it with fake data, reproducibly
+# for a given --seed. Whole columns are drawn at once with NumPy, ids are
+# assigned up front, and each chunk of users is loaded with COPY by one of
+# --workers processes, so large datasets take minutes:
+#
+#     python Testing/populate_posts.py --rows 1000000 --seed 42
+#
+# Every user has a budget. How many transactions each user has, how many
+# purchases each transaction has and whether purchases have receipts comes
+# from --profile. The default, writeup, is the dataset Docs/performace_writeup.md
+# measured: 5-10 transactions per user, 5-30 purchases per transaction and no
+# receipts, so the default 1M rows is about 7000 users. uniform gives everyone
+# 1-4 transactions of 1-4 purchases, each with a receipt. zipf and lognormal
+# are like uniform but heavy-tailed like production, where most users have a
+# handful of transactions and a few "whales" have tens of thousands (capped by
+# --max-user-transactions). Testing/benchmark_user_sizes.py times endpoints
+# for each size of user.
+#
+# User triggers are off while loading, so the columns and tables they maintain
+# (purchases.user_id, budget_lines, spending_rollup) are written here or
+# rebuilt afterwards.
+
+CATEGORIES = ['Groceries', 'Clothing and Accessories', 'Electronics', 'Home and Garden',
+              'Health and Beauty', 'Entertainment', 'Travel', 'Automotive',
+              'Services', 'Gifts and Special Occasions', 'Education',
+              'Fitness and Sports', 'Pets', 'Office Supplies',
+              'Financial Services', 'Other']
+
+BUDGET_COLUMNS = ["groceries", "clothing_and_accessories", "electronics", "home_and_garden",
+                  "health_and_beauty", "entertainment", "travel", "automotive", "services",
+                  "gifts_and_special_occasions", "education", "fitness_and_sports", "pets",
+                  "office_supplies", "financial_services", "other"]
+
+# transactions draws how many transactions each user has, purchases is the
+# [low, high) range of purchases per transaction. zipf and lognormal draws are
+# heavy-tailed: with the defaults a million rows have a median user of 1-3
+# transactions and a few users with 10000+, about 25000 purchases
+Profile = collections.namedtuple("Profile", ["transactions", "purchases", "receipts"])
+
+PROFILES = {
+    "writeup": Profile(lambda rng, count: rng.integers(5, 11, count), (5, 31), False),
+    "uniform": Profile(lambda rng, count: rng.integers(1, 5, count), (1, 5), True),
+    "zipf": Profile(lambda rng, count: rng.zipf(1.8, count), (1, 5), True),
+    "lognormal": Profile(lambda rng, count: np.ceil(rng.lognormal(1.0, 3.0, count)), (1, 5), True),
+}
+
+# besides its transactions, a user is a row and has a budget, and each
+# transaction has its average number of purchases, and receipts if any
+def estimated_rows(transaction_counts, profile):
+    low, high = PROFILES[profile].purchases
+    per_transaction = 1 + (low + high - 1) / 2 * (2 if PROFILES[profile].receipts else 1)
+    return 2 + per_transaction * transaction_counts
+
+# users are drawn this many at a time until there are enough rows
+DRAW_USERS = 10000
+
+# tables in the order they're loaded, for foreign keys
+TABLES = ["users", "budgets", "budget_lines", "transactions", "purchases", "receipts"]
+
+# faker is slow per value, so each worker draws from pools of this many values
+POOL_SIZE = 2000
 
 def database_connection_url():
     dotenv.load_dotenv()
@@ -13,216 +87,218 @@ def database_connection_url():
     DB_NAME: str = os.environ.get("POSTGRES_DB")
     return f"postgresql://{DB_USER}:{DB_PASSWD}@{DB_SERVER}:{DB_PORT}/{DB_NAME}"
 
-# Create a new DB engine based on our connection string
-engine = sqlalchemy.create_engine(database_connection_url(), use_insertmanyvalues=True)
-
-with engine.begin() as conn:
-    conn.execute(sqlalchemy.text("""
-    DROP TABLE IF EXISTS budgets;
-    DROP TABLE IF EXISTS receipts;
-    DROP TABLE IF EXISTS purchases;
-    DROP TABLE IF EXISTS transactions;
-    DROP TABLE IF EXISTS users;
-
-    CREATE TABLE 
-        public.users (
-            id bigint generated by default as identity,
-            name text not null,
-            email text not null,
-            constraint Users_pkey primary key (id),
-            constraint users_email_check check (
-                (
-                    email ~* '^[A-Za-z0-9._+%-]+@[A-Za-z0-9.-]+[.][A-Za-z]+$'::text
-                )
-            )
-        ) tablespace pg_default;
-
-    CREATE TABLE 
-        public.transactions (
-            id bigint generated by default as identity,
-            user_id bigint not null,
-            merchant text not null,
-            description text null,
-            created_at timestamp with time zone not null default now(),
-            date text null,
-            constraint Transaction_pkey primary key (id),
-            constraint transactions_user_id_fkey foreign key (user_id) references users (id) on update cascade on delete cascade
-        ) tablespace pg_default;
-
-    CREATE TABLE 
-        public.purchases (
-            id bigint generated by default as identity,
-            transaction_id bigint not null,
-            item text not null,
-            price integer not null,
-            warranty_date text null,
-            return_date text null,
-            category text not null default 'Other'::text,
-            quantity integer not null default 1,
-            constraint Purchase_pkey primary key (id),
-            constraint purchases_transaction_id_fkey foreign key (transaction_id) references transactions (id) on update cascade on delete cascade,
-            constraint purchases_category_check check (
-                (
-                    category = any (
-                        array[
-                            'Groceries'::text,
-                            'Clothing and Accessories'::text,
-                            'Electronics'::text,
-                            'Home and Garden'::text,
-                            'Health and Beauty'::text,
-                            'Entertainment'::text,
-                            'Travel'::text,
-                            'Automotive'::text,
-                            'Services'::text,
-                            'Gifts and Special Occasions'::text,
-                            'Education'::text,
-                            'Fitness and Sports'::text,
-                            'Pets'::text,
-                            'Office Supplies'::text,
-                            'Financial Services'::text,
-                            'Other'::text
-                        ]
-                    )
-                )
-            ),
-            constraint purchases_price_check check ((price >= 0)),
-            constraint purchases_quantity_check check ((quantity >= 1))
-        ) tablespace pg_default;
-
-    CREATE TABLE 
-        public.receipts (
-            id bigint generated by default as identity,
-            transaction_id bigint null,
-            url text not null,
-            parsed_data text not null,
-            constraint Reciept_pkey primary key (id),
-            constraint receipts_transaction_id_fkey foreign key (transaction_id) references transactions (id) on update cascade on delete cascade
-        ) tablespace pg_default;
-
-    CREATE TABLE 
-        public.budgets (
-            id bigint generated by default as identity,
-            user_id bigint not null,
-            groceries integer not null default 0,
-            clothing_and_accessories integer not null default 0,
-            electronics integer not null default 0,
-            home_and_garden integer not null default 0,
-            health_and_beauty integer not null default 0,
-            entertainment integer not null default 0,
-            travel integer not null default 0,
-            automotive integer not null default 0,
-            services integer not null default 0,
-            gifts_and_special_occasions integer not null default 0,
-            education integer not null default 0,
-            fitness_and_sports integer not null default 0,
-            pets integer not null default 0,
-            office_supplies integer not null default 0,
-            financial_services integer not null default 0,
-            other integer not null default 0,
-            constraint budgets_pkey primary key (id),
-            constraint budgets_user_id_fkey foreign key (user_id) references users (id) on update cascade on delete cascade,
-            constraint budgets_education_check check ((education >= 0)),
-            constraint budgets_electronics_check check ((electronics >= 0)),
-            constraint budgets_entertainment_check check ((entertainment >= 0)),
-            constraint budgets_financial_services_check check ((financial_services >= 0)),
-            constraint budgets_fitness_and_sports_check check ((fitness_and_sports >= 0)),
-            constraint budgets_gifts_and_special_occasions_check check ((gifts_and_special_occasions >= 0)),
-            constraint budgets_groceries_check check ((groceries >= 0)),
-            constraint budgets_automotive_check check ((automotive >= 0)),
-            constraint budgets_home_and_garden_check check ((home_and_garden >= 0)),
-            constraint budgets_office_supplies_check check ((office_supplies >= 0)),
-            constraint budgets_other_check check ((other >= 0)),
-            constraint budgets_pets_check check ((pets >= 0)),
-            constraint budgets_services_check check ((services >= 0)),
-            constraint budgets_travel_check check ((travel >= 0)),
-            constraint budgets_health_and_beauty_check check ((health_and_beauty >= 0)),
-            constraint budgets_clothing_and_accessories_check check ((clothing_and_accessories >= 0))
-        ) tablespace pg_default;
-    """))
-
-# 60,000 for 1 mil rows fake data
-num_users = 1000
-fake = Faker()
-
-# create fake users
-with engine.begin() as conn:
-    print("creating fake users...")
-    for i in range(num_users):
-        if (i % 10 == 0):
-            print(i)
-
-        user_id = conn.execute(sqlalchemy.text("""
-        INSERT INTO public.users (name, email) VALUES (:name, :email) RETURNING id;
-        """), {"name": fake.name(), "email": fake.email()}).scalar_one()
-
-        # create fake transactions
-        num_transactions = np.random.randint(1, 5)
-        for j in range(num_transactions):
-            merchant = fake.company()
-            description = fake.sentence()
-            date = fake.date_time_between(start_date='-1y', end_date='now', tzinfo=None)
-            
-            transaction_id = conn.execute(sqlalchemy.text("""
-            INSERT INTO public.transactions (user_id, merchant, description, created_at, date) 
-            VALUES (:user_id, :merchant, :description, :created_at, :date) RETURNING id;
-            """), {"user_id": user_id, "merchant": merchant, "description": description, "created_at": date, "date": date}).scalar_one()
-
-            # create fake purchases
-            num_purchases = np.random.randint(1, 5)
-            for k in range(num_purchases):
-                item = fake.word()
-                price = np.random.randint(1, 100)
-                warranty_date = fake.date_between(start_date='now', end_date='+1y').strftime("%Y-%m-%d")
-                return_date = fake.date_between(start_date='+1d', end_date='+1y').strftime("%Y-%m-%d")
-                category = fake.random_element(elements=['Groceries', 'Clothing and Accessories', 'Electronics', 'Home and Garden', 
-                                                        'Health and Beauty', 'Entertainment', 'Travel', 'Automotive', 
-                                                        'Services', 'Gifts and Special Occasions', 'Education', 
-                                                        'Fitness and Sports', 'Pets', 'Office Supplies', 
-                                                        'Financial Services', 'Other'])
-                quantity = np.random.randint(1, 10)
-
-                purchase_id = conn.execute(sqlalchemy.text("""
-                INSERT INTO public.purchases (transaction_id, item, price, warranty_date, return_date, category, quantity) 
-                VALUES (:transaction_id, :item, :price, :warranty_date, :return_date, :category, :quantity) RETURNING id;
-                """), {"transaction_id": transaction_id, "item": item, "price": price, 
-                       "warranty_date": warranty_date, "return_date": return_date, 
-                       "category": category, "quantity": quantity}).scalar_one()
-
-                # create fake receipts
-                url = fake.uri()
-                parsed_data = fake.text()
-                conn.execute(sqlalchemy.text("""
-                INSERT INTO public.receipts (transaction_id, url, parsed_data) 
-                VALUES (:transaction_id, :url, :parsed_data);
-                """), {"transaction_id": transaction_id, "url": url, "parsed_data": parsed_data})
-
-        # create fake budgets for users
+def copy_escape(value):
+    # COPY's text format
+    return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+@functools.lru_cache
+def make_pools(seed):
+    fake = Faker()
+    fake.seed_instance(seed)
+    pools = {
+        "name": [fake.name() for _ in range(POOL_SIZE)],
+        "user_name": [fake.user_name() for _ in range(POOL_SIZE)],
+        "company": [fake.company() for _ in range(POOL_SIZE)],
+        "sentence": [fake.sentence() for _ in range(POOL_SIZE)],
+        "word": [fake.word() for _ in range(POOL_SIZE)],
+        "uri": [fake.uri() for _ in range(POOL_SIZE)],
+        "text": [fake.text() for _ in range(POOL_SIZE // 10)],
+    }
+    return {name: np.array([copy_escape(value) for value in values], dtype=object) for name, values in pools.items()}
+
+def pick(rng, pool, count):
+    return pool[rng.integers(0, len(pool), count)]
+
+def as_text(values):
+    return values.astype(str) if isinstance(values, np.ndarray) else values
+
+def copy_rows(cursor, table, columns):
+    """COPYs columns (name -> equally long array or list) into table."""
+    buffer = io.StringIO()
+    rows = zip(*(as_text(values) for values in columns.values()))
+    buffer.writelines("\t".join(row) + "\n" for row in rows)
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
+
+def draw_transaction_counts(rows, profile, max_transactions, rng):
+    """Transactions per user, for as many users as it takes to make about rows rows."""
+    drawn = []
+    total = 0
+    while total < rows:
+        counts = np.clip(PROFILES[profile].transactions(rng, DRAW_USERS), 1, max_transactions).astype(np.int64)
+        drawn.append(counts)
+        total += int(estimated_rows(counts, profile).sum())
+    counts = np.concatenate(drawn)
+    users = int(np.searchsorted(np.cumsum(estimated_rows(counts, profile)), rows)) + 1
+    return counts[:min(users, len(counts))]
+
+def plan_chunks(rows, profile, max_transactions, chunk_rows, seed):
+    """
+    Draws how many transactions each user and purchases each transaction has,
+    and splits users into chunks of about chunk_rows rows, each knowing the
+    first id of every table, so workers can assign ids without talking to each
+    other or the database. A whale bigger than chunk_rows gets a chunk to itself.
+    """
+    rng = np.random.default_rng([seed, 0])
+    transaction_counts = draw_transaction_counts(rows, profile, max_transactions, rng)
+    purchase_counts = rng.integers(*PROFILES[profile].purchases, int(transaction_counts.sum()), dtype=np.int8)
+    users = len(transaction_counts)
+
+    transaction_starts = np.concatenate([[0], np.cumsum(transaction_counts, dtype=np.int64)])
+    purchase_starts = np.concatenate([[0], np.cumsum(purchase_counts, dtype=np.int64)])
+    row_ends = np.cumsum(estimated_rows(transaction_counts, profile))
+
+    chunks = []
+    first_user = 0
+    while first_user < users:
+        rows_before = row_ends[first_user - 1] if first_user else 0
+        last_user = max(int(np.searchsorted(row_ends, rows_before + chunk_rows, side="right")), first_user + 1)
+        first_transaction, last_transaction = transaction_starts[first_user], transaction_starts[last_user]
+        chunks.append({
+            "index": len(chunks),
+            "first_user_id": first_user + 1,
+            "transaction_counts": transaction_counts[first_user:last_user],
+            "first_transaction_id": int(first_transaction) + 1,
+            "purchase_counts": purchase_counts[first_transaction:last_transaction],
+            "first_purchase_id": int(purchase_starts[first_transaction]) + 1,
+            "receipts": PROFILES[profile].receipts,
+        })
+        first_user = last_user
+    return chunks, transaction_counts
+
+def load_chunk(url, seed, as_of, chunk):
+    """Generates one chunk of users and everything they own, and COPYs it in one transaction."""
+    rng = np.random.default_rng([seed, 1, chunk["index"]])
+    pools = make_pools(seed)
+    as_of = np.datetime64(as_of)
+
+    users = len(chunk["transaction_counts"])
+    user_ids = np.arange(chunk["first_user_id"], chunk["first_user_id"] + users)
+    transactions = int(chunk["transaction_counts"].sum())
+    transaction_ids = np.arange(chunk["first_transaction_id"], chunk["first_transaction_id"] + transactions)
+    transaction_user_ids = np.repeat(user_ids, chunk["transaction_counts"])
+    purchases = int(chunk["purchase_counts"].sum())
+    purchase_ids = np.arange(chunk["first_purchase_id"], chunk["first_purchase_id"] + purchases)
+    purchase_transaction_ids = np.repeat(transaction_ids, chunk["purchase_counts"])
+    purchase_user_ids = np.repeat(transaction_user_ids, chunk["purchase_counts"])
+
+    # within the year before as_of
+    created_at = as_of - rng.integers(0, 365 * 24 * 3600, transactions).astype("timedelta64[s]")
+    day = np.timedelta64(1, "D")
+    budget_amounts = rng.integers(50, 500, (users, len(BUDGET_COLUMNS)))
+
+    connection = psycopg2.connect(url)
+    try:
+        with connection, connection.cursor() as cursor:
+            copy_rows(cursor, "users", {
+                "id": user_ids,
+                "name": pick(rng, pools["name"], users),
+                "email": [f"{name}{user_id}@example.com" for name, user_id in zip(pick(rng, pools["user_name"], users), user_ids)],
+            })
+            # one budget per user, with the user's id
+            copy_rows(cursor, "budgets", {
+                "id": user_ids,
+                "user_id": user_ids,
+                **{column: budget_amounts[:, position] for position, column in enumerate(BUDGET_COLUMNS)},
+            })
+            # what budgets_sync_lines would have written: every amount, for every month
+            copy_rows(cursor, "budget_lines", {
+                "user_id": np.repeat(user_ids, len(CATEGORIES)),
+                "category": np.tile(np.array(CATEGORIES, dtype=object), users),
+                "period": ["-infinity"] * (users * len(CATEGORIES)),
+                "amount_cents": budget_amounts.reshape(-1),
+            })
+            copy_rows(cursor, "transactions", {
+                "id": transaction_ids,
+                "user_id": transaction_user_ids,
+                "merchant": pick(rng, pools["company"], transactions),
+                "description": pick(rng, pools["sentence"], transactions),
+                "created_at": created_at,
+                "date": created_at.astype("datetime64[D]"),
+            })
+            today = as_of.astype("datetime64[D]")
+            copy_rows(cursor, "purchases", {
+                "id": purchase_ids,
+                "transaction_id": purchase_transaction_ids,
+                "user_id": purchase_user_ids,
+                "item": pick(rng, pools["word"], purchases),
+                "price": rng.integers(1, 100, purchases),
+                "warranty_date": today + rng.integers(0, 366, purchases) * day,
+                "return_date": today + rng.integers(1, 366, purchases) * day,
+                "category": pick(rng, np.array(CATEGORIES, dtype=object), purchases),
+                "quantity": rng.integers(1, 10, purchases),
+            })
+            # a receipt per purchase, ids the same as the purchases'
+            if chunk["receipts"]:
+                copy_rows(cursor, "receipts", {
+                    "id": purchase_ids,
+                    "transaction_id": purchase_transaction_ids,
+                    "url": pick(rng, pools["uri"], purchases),
+                    "parsed_data": pick(rng, pools["text"], purchases),
+                })
+    finally:
+        connection.close()
+
+    return 2 * users + users * len(CATEGORIES) + transactions + (2 if chunk["receipts"] else 1) * purchases
+
+def main():
+    parser = argparse.ArgumentParser(description="Fill a fresh database with reproducible fake data.")
+    parser.add_argument("--rows", type=int, default=1_000_000, help="about how many rows to create, not counting budget lines")
+    parser.add_argument("--seed", type=int, default=42, help="the same seed gives the same data")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="processes generating and loading chunks")
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="writeup", help="how many transactions users have and purchases transactions have")
+    parser.add_argument("--max-user-transactions", type=int, default=50000, help="cap on one user's transactions for the skewed profiles")
+    parser.add_argument("--chunk-rows", type=int, default=340000, help="about how many rows each worker loads at a time")
+    parser.add_argument("--as-of", type=date.fromisoformat, default=date.today(), help="dates are drawn around this day")
+    args = parser.parse_args()
+
+    url = database_connection_url()
+    engine = sqlalchemy.create_engine(url)
+
+    with engine.begin() as conn:
+        # the migrations also create functions, triggers and extensions, so start
+        # from an empty schema rather than dropping tables one by one
         conn.execute(sqlalchemy.text("""
-        INSERT INTO public.budgets (user_id, groceries, clothing_and_accessories, electronics, home_and_garden, 
-                                     health_and_beauty, entertainment, travel, automotive, services, 
-                                     gifts_and_special_occasions, education, fitness_and_sports, pets, 
-                                     office_supplies, financial_services, other) 
-        VALUES (:user_id, :groceries, :clothing_and_accessories, :electronics, :home_and_garden, 
-                :health_and_beauty, :entertainment, :travel, :automotive, :services, 
-                :gifts_and_special_occasions, :education, :fitness_and_sports, :pets, 
-                :office_supplies, :financial_services, :other);
-        """), {"user_id": user_id,
-               "groceries": np.random.randint(50, 500),
-               "clothing_and_accessories": np.random.randint(50, 500),
-               "electronics": np.random.randint(50, 500),
-               "home_and_garden": np.random.randint(50, 500),
-               "health_and_beauty": np.random.randint(50, 500),
-               "entertainment": np.random.randint(50, 500),
-               "travel": np.random.randint(50, 500),
-               "automotive": np.random.randint(50, 500),
-               "services": np.random.randint(50, 500),
-               "gifts_and_special_occasions": np.random.randint(50, 500),
-               "education": np.random.randint(50, 500),
-               "fitness_and_sports": np.random.randint(50, 500),
-               "pets": np.random.randint(50, 500),
-               "office_supplies": np.random.randint(50, 500),
-               "financial_services": np.random.randint(50, 500),
-               "other": np.random.randint(50, 500),
-              })
-
-print("Fake data generation completed.")
+        DROP SCHEMA IF EXISTS public CASCADE;
+        CREATE SCHEMA public;
+        """))
+
+    # tables and indexes come from the migrations, same as every other environment
+    migrations.migrate(engine)
+
+    chunks, transaction_counts = plan_chunks(args.rows, args.profile, args.max_user_transactions, args.chunk_rows, args.seed)
+    median, p99 = np.percentile(transaction_counts, [50, 99])
+    print(f"creating {len(transaction_counts)} users ({args.profile}: median {median:.0f}, p99 {p99:.0f}, "
+          f"max {transaction_counts.max()} transactions) in {len(chunks)} chunks with {args.workers} workers...")
+    start_time = time.time()
+
+    with engine.begin() as conn:
+        for table in TABLES:
+            conn.execute(sqlalchemy.text(f"ALTER TABLE {table} DISABLE TRIGGER USER"))
+    try:
+        loaded = 0
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            futures = [executor.submit(load_chunk, url, args.seed, args.as_of.isoformat(), chunk) for chunk in chunks]
+            for done, future in enumerate(as_completed(futures), 1):
+                loaded += future.result()
+                print(f"{done}/{len(chunks)} chunks, {loaded} rows, {time.time() - start_time:.1f}s")
+    finally:
+        with engine.begin() as conn:
+            for table in TABLES:
+                conn.execute(sqlalchemy.text(f"ALTER TABLE {table} ENABLE TRIGGER USER"))
+
+    with engine.begin() as conn:
+        # ids were assigned here, so move the identity sequences past them
+        for table in ["users", "budgets", "transactions", "purchases", "receipts"]:
+            conn.execute(sqlalchemy.text(
+                f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT COALESCE(max(id), 0) + 1 FROM {table}), false)"))
+        print("rebuilding spending rollup...")
+        conn.execute(sqlalchemy.text("SELECT rebuild_spending_rollup()"))
+
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(sqlalchemy.text("ANALYZE"))
+
+    print(f"Fake data generation completed in {time.time() - start_time:.1f}s.")
+
+if __name__ == "__main__":
+    main()
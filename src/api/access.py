@@ -0,0 +1,70 @@
+from fastapi import HTTPException
+
+# Existence and ownership checks that used to be separate round trips
+# (check_user_query, check_transaction_query, check_purchase_query).
+# guarded() folds them into the main statement as a "guard" CTE and
+# check_access() reads them back out of the result. Users and transactions
+# waiting to be purged (deleted_at is set, see src/api/purges.py) are not
+# found, so every guarded read and write treats them as already gone.
+
+SCOPES = ["user", "transaction", "purchase"]
+
+GUARD_COLUMNS = {
+    "user": "(SELECT id FROM users WHERE id = :user_id AND deleted_at IS NULL) AS guard_user_id",
+    "transaction": "(SELECT user_id FROM transactions WHERE id = :transaction_id AND deleted_at IS NULL) AS guard_owner_id",
+    "purchase": "(SELECT transaction_id FROM purchases WHERE id = :purchase_id) AS guard_transaction_id",
+}
+
+def guarded(body, scope="user", ctes=()):
+    """
+    Wraps body (a SELECT, or an INSERT/UPDATE/DELETE with RETURNING) so the
+    guard columns for scope come back with every row. The guard CTE always
+    yields one row, so an empty body still returns one row with the guard
+    filled in and the body columns NULL.
+
+    Data-modifying bodies must gate themselves, e.g. by selecting FROM guard
+    or filtering on user_id, since Postgres runs them regardless of the guard.
+    Extra CTEs the body depends on go in ctes, as "name AS (...)" strings.
+    """
+    columns = ",\n".join(GUARD_COLUMNS[name] for name in SCOPES[:SCOPES.index(scope) + 1])
+    extra = "".join(f"{cte},\n" for cte in ctes)
+
+    return f"""
+    WITH guard AS (
+        SELECT {columns}
+    ),
+    {extra}body AS (
+        {body}
+    )
+    SELECT guard.*, numbered.*
+    FROM guard
+    LEFT JOIN (SELECT row_number() OVER () AS guard_seq, body.* FROM body) AS numbered ON TRUE
+    ORDER BY numbered.guard_seq
+    """
+
+def check_access(rows, user_id, transaction_id=None):
+    """
+    Raises the HTTPException the old check queries would have raised for the
+    guard columns in rows, otherwise returns the body rows as dicts.
+    """
+    guard = rows[0]
+
+    if guard["guard_user_id"] is None:
+        raise HTTPException(status_code=404, detail="User not found")
+
+    if "guard_owner_id" in guard:
+        if guard["guard_owner_id"] is None:
+            raise HTTPException(status_code=404, detail="Transaction not found")
+        if guard["guard_owner_id"] != user_id:
+            raise HTTPException(status_code=400, detail="Transaction does not belong to user")
+
+    if "guard_transaction_id" in guard:
+        if guard["guard_transaction_id"] is None:
+            raise HTTPException(status_code=404, detail="Purchase not found")
+        if guard["guard_transaction_id"] != transaction_id:
+            raise HTTPException(status_code=400, detail="Purchase does not belong to transaction")
+
+    return [
+        {key: value for key, value in row.items() if not key.startswith("guard_")}
+        for row in rows if row["guard_seq"] is not None
+    ]
@@ -1,5 +1,8 @@
 from fastapi import APIRouter, Depends
 from src.api import auth
+from src import database as db
+from src.api.statements import registry as statements
+from src.api.cache import cache
 
 router = APIRouter(
     prefix="/admin",
@@ -12,4 +15,27 @@ def get_project_info():
     return {
         "Project Name": "Receipt App",
         "Contributors": ["Connor OBrien", "Arne Noori", "Bryan Nguyen", "Sebastian Thau"]
-    }
\ No newline at end of file
+    }
+
+@router.get("/pool/")
+def get_pool_status():
+    return db.pool_metrics.snapshot(db.async_engine.pool)
+
+
+@router.get("/statements/")
+def get_statement_cache_status():
+    return {
+        **statements.stats(),
+        **db.statement_cache_metrics.snapshot(),
+    }
+
+
+@router.get("/cache/")
+async def get_cache_status():
+    return await cache.stats()
+
+
+@router.delete("/cache/")
+async def clear_cache():
+    await cache.clear()
+    return "OK"
@@ -1,11 +1,19 @@
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Query, Request, Response
 from pydantic import BaseModel
+from typing import Optional
 from src.api import auth
-import sqlalchemy
+from src.api.access import guarded, check_access
+from src.api.statements import registry as statements
+from src.api.cache import cache, MISSING
+from src.api.etags import not_modified
+from src.api.pagination import PAGING, paging_mode, order_sql, keyset_sql, limit_sql, keyset_params, keyset_page
 from src import database as db
 from sqlalchemy.exc import DBAPIError
 from fastapi import HTTPException
-from datetime import datetime, timedelta
+from src.api.dates import parse_date, is_first_day_of_month, is_last_day_of_month
+from src.api.dates import GRANULARITIES, bucket_start, shift_buckets, count_buckets
+from src.api.dates import is_valid_date  # noqa: F401 (still imported from here)
+from datetime import date
 import time
 
 router = APIRouter(
@@ -32,31 +40,52 @@ class NewBudget(BaseModel):
     financial_services: int
     other: int
 
-def is_valid_date(date_string, format='%Y-%m-%d'):
-    try:
-        datetime.strptime(date_string, format)
-        year, month, day = date_string.split('-')
-        if len(year) != 4 or len(month) != 2 or len(day) != 2: 
-            return False
-        return True
-    except ValueError:
-        return False
-
-def is_first_day_of_month(date):
-    date_obj = datetime.strptime(date, "%Y-%m-%d")
-    return date_obj.day == 1
-
-def is_last_day_of_month(date):
-    date_obj = datetime.strptime(date, "%Y-%m-%d")
-    return date_obj.day == (date_obj.replace(month=date_obj.month % 12 + 1, day=1) - timedelta(days=1)).day
-
-check_budget_query = "SELECT user_id FROM budgets WHERE id = :budget_id"
-check_user_query = "SELECT id FROM users WHERE id = :user_id"
+# a user who already has a budget gets the new amounts in place, which the
+# budget lines trigger turns into their budget from this month on
+statements.register("budgets.create", guarded(
+    """
+    SELECT id FROM updated_budget
+    UNION ALL
+    SELECT id FROM new_budget
+    """, ctes=[
+        """
+        updated_budget AS (
+            UPDATE budgets
+            SET groceries = :groceries, clothing_and_accessories = :clothing_and_accessories, electronics = :electronics,
+            home_and_garden = :home_and_garden, health_and_beauty = :health_and_beauty, entertainment = :entertainment,
+            travel = :travel, automotive = :automotive, services = :services, gifts_and_special_occasions = :gifts_and_special_occasions,
+            education = :education, fitness_and_sports = :fitness_and_sports, pets = :pets, office_supplies = :office_supplies,
+            financial_services = :financial_services, other = :other
+            FROM guard
+            WHERE budgets.user_id = guard_user_id
+            RETURNING id
+        )
+        """,
+        """
+        new_budget AS (
+            INSERT INTO budgets (user_id, groceries, clothing_and_accessories, electronics, home_and_garden,
+            health_and_beauty, entertainment, travel, automotive, services, gifts_and_special_occasions, education,
+            fitness_and_sports, pets, office_supplies, financial_services, other)
+            SELECT guard_user_id, :groceries, :clothing_and_accessories, :electronics, :home_and_garden, :health_and_beauty,
+            :entertainment, :travel, :automotive, :services, :gifts_and_special_occasions, :education, :fitness_and_sports,
+            :pets, :office_supplies, :financial_services, :other
+            FROM guard
+            WHERE guard_user_id IS NOT NULL
+            AND NOT EXISTS (SELECT 1 FROM budgets WHERE user_id = :user_id)
+            RETURNING id
+        )
+        """,
+    ]
+))
 
 # creates a new budget for a user
 @router.post("/", tags=["budgets"])
-def create_budget(user_id: int, budget: NewBudget):
-    """ """
+async def create_budget(user_id: int, budget: NewBudget):
+    """
+    A user's first budget applies to every month. Creating another replaces
+    it from the current month on, and earlier months keep what they had. To
+    set the budget from some other month, use PUT /months/{month}.
+    """
     start_time = time.time()
     budget_id = None
 
@@ -67,37 +96,11 @@ def create_budget(user_id: int, budget: NewBudget):
             raise HTTPException(status_code=400, detail="Invalid budget")
     
     try:
-        with db.engine.begin() as connection:
-            # check if user exists
-            result = connection.execute(
-                sqlalchemy.text(check_user_query), 
-                [{"user_id": user_id}]).fetchone()
-            if result is None:
-                raise HTTPException(status_code=404, detail="User not found")
-
-            # check if user already has a budget
-            result = connection.execute(
-                sqlalchemy.text(
-                    """
-                    SELECT id FROM budgets WHERE user_id = :user_id
-                    """
-                ), [{"user_id": user_id}]).fetchone()
-            if result is not None:
-                raise HTTPException(status_code=400, detail="User already has a budget")        
-
-            # add budget to database
-            budget_id = connection.execute(
-                sqlalchemy.text(
-                    """
-                    INSERT INTO budgets (user_id, groceries, clothing_and_accessories, electronics, home_and_garden, 
-                    health_and_beauty, entertainment, travel, automotive, services, gifts_and_special_occasions, education, 
-                    fitness_and_sports, pets, office_supplies, financial_services, other)
-                    VALUES (:user_id, :groceries, :clothing_and_accessories, :electronics, :home_and_garden, :health_and_beauty, 
-                    :entertainment, :travel, :automotive, :services, :gifts_and_special_occasions, :education, :fitness_and_sports, 
-                    :pets, :office_supplies, :financial_services, :other)
-                    RETURNING id
-                    """
-                ), [{"user_id": user_id, 
+        async with db.async_engine.begin() as connection:
+            # add budget to database, or replace the user's budget if they have one
+            rows = (await connection.execute(
+                statements.get("budgets.create"),
+                [{"user_id": user_id, 
                      "groceries": budget.groceries, 
                      "clothing_and_accessories": budget.clothing_and_accessories, 
                      "electronics": budget.electronics, 
@@ -113,79 +116,89 @@ def create_budget(user_id: int, budget: NewBudget):
                      "pets": budget.pets, 
                      "office_supplies": budget.office_supplies, 
                      "financial_services": budget.financial_services, 
-                     "other": budget.other}]).scalar_one()
+                     "other": budget.other}])).mappings().all()
+            budget_id = check_access(rows, user_id)[0]["id"]
     except DBAPIError as error:
         print(f"Error returned: <<<{error}>>>")
+        raise HTTPException(status_code=500, detail="Database error")
+    # the user's cached aggregates are out of date now
+    await cache.invalidate(user_id)
     end_time = time.time()
     print(f"time: {(end_time - start_time) * 1000}")
     return {"budget_id": budget_id}
 
+statements.register("budgets.get", guarded(
+    """
+    SELECT groceries, clothing_and_accessories, electronics, home_and_garden, health_and_beauty, entertainment, travel, 
+    automotive, services, gifts_and_special_occasions, education, fitness_and_sports, pets, office_supplies, 
+    financial_services, other
+    FROM budgets
+    WHERE user_id = :user_id
+    """
+))
+
 # gets a user's monthly budgets
 @router.get("/", tags=["budgets"])
-def get_budgets(user_id: int):
+async def get_budgets(user_id: int, request: Request = None, response: Response = None):
     """ """
     start_time = time.time()
+    # the client's copy is still current
+    unchanged = await not_modified(user_id, request, response)
+    if unchanged is not None:
+        return unchanged
+
+    ans, token = await cache.get(user_id, ("budgets.get",))
+    if ans is not MISSING:
+        return ans
+
     try:
-        with db.engine.begin() as connection:
-            # check if user exists
-            result = connection.execute(
-                sqlalchemy.text(check_user_query), 
-                [{"user_id": user_id}]).fetchone()
-            if result is None:
-                raise HTTPException(status_code=404, detail="User not found")
-            
+        async with db.async_engine.begin() as connection:
             # gets budgets from database
-            ans = connection.execute(
-                sqlalchemy.text(
-                    """
-                    SELECT groceries, clothing_and_accessories, electronics, home_and_garden, health_and_beauty, entertainment, travel, 
-                    automotive, services, gifts_and_special_occasions, education, fitness_and_sports, pets, office_supplies, 
-                    financial_services, other
-                    FROM budgets
-                    WHERE user_id = :user_id
-                    """
-                ), [{"user_id": user_id}]).fetchone()
-            if ans is None:
+            rows = (await connection.execute(
+                statements.get("budgets.get"),
+                [{"user_id": user_id}])).mappings().all()
+            rows = check_access(rows, user_id)
+            if not rows:
                 raise HTTPException(status_code=404, detail="Budget not found")
+            ans = rows[0]
+            await cache.set(user_id, ("budgets.get",), ans, token)
     except DBAPIError as error:
         print(f"DBAPIError returned: <<<{error}>>>")
     end_time = time.time()
     print(f"time: {(end_time - start_time) * 1000}")
 
-    return dict(ans._mapping)
+    return ans
+
+statements.register("budgets.update", guarded(
+    """
+    UPDATE budgets
+    SET groceries = :groceries, clothing_and_accessories = :clothing_and_accessories, electronics = :electronics, 
+    home_and_garden = :home_and_garden, health_and_beauty = :health_and_beauty, entertainment = :entertainment, 
+    travel = :travel, automotive = :automotive, services = :services, gifts_and_special_occasions = :gifts_and_special_occasions, 
+    education = :education, fitness_and_sports = :fitness_and_sports, pets = :pets, office_supplies = :office_supplies, 
+    financial_services = :financial_services, other = :other
+    FROM guard
+    WHERE id = :budget_id AND user_id = guard_user_id
+    RETURNING id
+    """
+))
 
 # updates a user's monthly budgets
 @router.put("/{budget_id}", tags=["budgets"])
-def update_budget(user_id: int, budget_id: int, budget: NewBudget):
+async def update_budget(user_id: int, budget_id: int, budget: NewBudget):
     """ """
     start_time = time.time()
     # check if budget is valid
     for category, amt in vars(budget).items():
         print(f"category: {category}, amt: {amt}")
-        if amt is None or not isinstance(amt, int) or amt < 0:
+        if not isinstance(amt, int) or amt < 0:
             raise HTTPException(status_code=400, detail="Invalid budget")
     try:
-        with db.engine.begin() as connection:
-            # check if budget exists
-            result = connection.execute(
-                sqlalchemy.text(check_budget_query), 
-                [{"budget_id": budget_id}]).fetchone()
-            if result is None:
-                raise HTTPException(status_code=404, detail="Budget not found")
-            
+        async with db.async_engine.begin() as connection:
             # update budget in database
-            connection.execute(
-                sqlalchemy.text(
-                    """
-                    UPDATE budgets
-                    SET groceries = :groceries, clothing_and_accessories = :clothing_and_accessories, electronics = :electronics, 
-                    home_and_garden = :home_and_garden, health_and_beauty = :health_and_beauty, entertainment = :entertainment, 
-                    travel = :travel, automotive = :automotive, services = :services, gifts_and_special_occasions = :gifts_and_special_occasions, 
-                    education = :education, fitness_and_sports = :fitness_and_sports, pets = :pets, office_supplies = :office_supplies, 
-                    financial_services = :financial_services, other = :other
-                    WHERE id = :budget_id
-                    """
-                ), [{"budget_id": budget_id, 
+            rows = (await connection.execute(
+                statements.get("budgets.update"),
+                [{"user_id": user_id, "budget_id": budget_id, 
                      "groceries": budget.groceries, 
                      "clothing_and_accessories": budget.clothing_and_accessories, 
                      "electronics": budget.electronics, 
@@ -201,9 +214,15 @@ def update_budget(user_id: int, budget_id: int, budget: NewBudget):
                      "pets": budget.pets, 
                      "office_supplies": budget.office_supplies, 
                      "financial_services": budget.financial_services, 
-                     "other": budget.other}])
+                     "other": budget.other}])).mappings().all()
+            # a budget that isn't the user's isn't found either
+            if not check_access(rows, user_id):
+                raise HTTPException(status_code=404, detail="Budget not found")
     except DBAPIError as error:
-        print(f"DBAPIError returned: <<{error}>>>")
+        print(f"DBAPIError returned: <<<{error}>>>")
+        raise HTTPException(status_code=500, detail="Database error")
+    # the user's cached aggregates are out of date now
+    await cache.invalidate(user_id)
     end_time = time.time()
     print(f"time: {(end_time - start_time) * 1000}")    
     return {"budget_id": budget_id, "groceries": budget.groceries, "clothing_and_accessories": budget.clothing_and_accessories, 
@@ -213,94 +232,167 @@ def update_budget(user_id: int, budget_id: int, budget: NewBudget):
             "fitness_and_sports": budget.fitness_and_sports, "pets": budget.pets, "office_supplies": budget.office_supplies, 
             "financial_services": budget.financial_services, "other": budget.other}
 
+# purchase categories in the order of the budget columns. budget_lines and
+# spending_rollup use these names, the API uses the NewBudget field names.
+BUDGET_CATEGORIES = {
+    "groceries": "Groceries",
+    "clothing_and_accessories": "Clothing and Accessories",
+    "electronics": "Electronics",
+    "home_and_garden": "Home and Garden",
+    "health_and_beauty": "Health and Beauty",
+    "entertainment": "Entertainment",
+    "travel": "Travel",
+    "automotive": "Automotive",
+    "services": "Services",
+    "gifts_and_special_occasions": "Gifts and Special Occasions",
+    "education": "Education",
+    "fitness_and_sports": "Fitness and Sports",
+    "pets": "Pets",
+    "office_supplies": "Office Supplies",
+    "financial_services": "Financial Services",
+    "other": "Other",
+}
+
+MAX_COMPARE_MONTHS = 120
+
+def parse_month(month):
+    # YYYY-MM, as the first day of that month
+    return parse_date(f"{month}-01") if len(month) == 7 else None
+
+def categories_cte():
+    # compare_categories(position, field, category), one row per budget category
+    categories = ",\n            ".join(
+        f"({position}, '{field}', '{name}')" for position, (field, name) in enumerate(BUDGET_CATEGORIES.items()))
+    return f"""compare_categories AS (
+            SELECT * FROM (VALUES
+            {categories}
+            ) AS c(position, field, category)
+        )"""
+
+def comparison_ctes():
+    """
+    CTEs ending in comparison(position, field, category, actual_cents,
+    budget_cents) for the months :month_from through :month_to. A month's
+    budget is each category's latest budget line at or before it and budgets
+    add up over several months; budget_cents is NULL for categories without
+    any line in effect.
+    """
+    return [
+        categories_cte(),
+        """compare_months AS (
+            SELECT generate_series(CAST(CAST(:month_from AS date) AS timestamp), CAST(CAST(:month_to AS date) AS timestamp),
+            interval '1 month')::date AS month
+        )""",
+        # one budget_lines_pkey seek per category and month
+        """compare_budget AS (
+            SELECT c.category, SUM(line.amount_cents) AS budget_cents
+            FROM compare_categories AS c
+            CROSS JOIN compare_months AS m
+            JOIN LATERAL (
+                SELECT amount_cents
+                FROM budget_lines
+                WHERE user_id = :user_id AND category = c.category AND period <= m.month
+                ORDER BY period DESC
+                LIMIT 1
+            ) AS line ON TRUE
+            GROUP BY c.category
+        )""",
+        """compare_actual AS (
+            SELECT category, SUM(total_cents) AS actual_cents
+            FROM spending_rollup
+            WHERE user_id = :user_id
+            AND month >= :month_from AND month <= :month_to
+            GROUP BY category
+        )""",
+        """comparison AS (
+            SELECT c.position, c.field, c.category, COALESCE(a.actual_cents, 0) AS actual_cents, b.budget_cents
+            FROM compare_categories AS c
+            LEFT JOIN compare_budget AS b ON b.category = c.category
+            LEFT JOIN compare_actual AS a ON a.category = c.category
+        )""",
+    ]
+
+# budget lines (migration 0008) joined to the spending rollup (migration 0005)
+statements.register("budgets.compare", guarded(
+    """
+    SELECT field AS category,
+    ('$' || ROUND((actual_cents / 100.0), 2)::text) AS actual,
+    ('$' || ROUND((COALESCE(budget_cents, 0) / 100.0), 2)::text) AS budget,
+    budget_cents IS NOT NULL AS budgeted
+    FROM comparison
+    ORDER BY position
+    """, ctes=comparison_ctes()
+))
+
 # compare actual monthly spending to budget
 @router.get("/compare", tags=["budgets"])
-def compare_budgets_to_actual_spending(user_id: int, date_from: str = None, date_to: str = None):
-    """ """
+async def compare_budgets_to_actual_spending(user_id: int, date_from: Optional[str] = None, date_to: Optional[str] = None, month: Optional[str] = None, request: Request = None, response: Response = None):
+    """
+    Compares one month (month, as YYYY-MM) or a range of whole months
+    (date_from and date_to) to the budgets in effect for them, the current
+    month by default. Over several months the monthly budgets add up.
+    """
     start_time = time.time()
-    try:
-        with db.engine.begin() as connection:
-            # check if date_from and date_to are valid
-            if date_from is not None and not is_valid_date(date_from) :
-                raise HTTPException(status_code=400, detail="Invalid date_from")
-            if date_to is not None and not is_valid_date(date_to):
-                raise HTTPException(status_code=400, detail="Invalid date_to")
-            if date_from is None and date_to is not None:
-                raise HTTPException(status_code=400, detail="date_from must be specified if date_to is specified")
-            if date_from is not None and date_to is None:
-                raise HTTPException(status_code=400, detail="date_to must be specified if date_from is specified")
-            
-            # set date_from to first day of current month and date_to to current day if not specified
-            now = datetime.now()
-            if date_from is None:
-                date_from = datetime(now.year, now.month, 1).strftime('%Y-%m-%d')
-            elif not is_first_day_of_month(date_from):
-                raise HTTPException(status_code=400, detail="date_from must be first day of month")
-            if date_to is None:
-                # current day is fine b/c there shouldn't be any purchases in the future
-                date_to = datetime(now.year, now.month, now.day).strftime('%Y-%m-%d')
-            elif not is_last_day_of_month(date_to):
-                raise HTTPException(status_code=400, detail="date_to must be last day of month")
-            
-            print(f"date_from: {date_from}, date_to: {date_to}")
-            
-            # check if user exists
-            result = connection.execute(
-                sqlalchemy.text(check_user_query), 
-                [{"user_id": user_id}]).fetchone()
-            if result is None:
-                raise HTTPException(status_code=404, detail="User not found")
-            
-            # gets budgets from database
-            budgets = connection.execute(
-                sqlalchemy.text(
-                    """
-                    SELECT groceries, clothing_and_accessories, electronics, home_and_garden, health_and_beauty, entertainment, 
-                    travel, automotive, services, gifts_and_special_occasions, education, fitness_and_sports, pets, office_supplies, 
-                    financial_services, other
-                    FROM budgets
-                    WHERE user_id = :user_id
-                    """
-                ), [{"user_id": user_id}]).fetchone()
-            if budgets is None:
-                raise HTTPException(status_code=404, detail="Budget not found")
 
-            # gets actual spending from database
-            actual_spending = connection.execute(
-                sqlalchemy.text(
-                    """
-                    SELECT category, ('$' || ROUND((SUM(price * quantity) / 100.0), 2)::text) AS total
-                    FROM purchases
-                    JOIN transactions on purchases.transaction_id = transactions.id
-                    WHERE user_id = :user_id AND (date BETWEEN :date_from AND :date_to)
-                    GROUP BY category
-                    """
-                ), [{"user_id": user_id, "date_from": date_from, "date_to": date_to}]).all()
+    # check if date_from and date_to are valid
+    parsed_from = parse_date(date_from) if date_from is not None else None
+    parsed_to = parse_date(date_to) if date_to is not None else None
+    if date_from is not None and parsed_from is None:
+        raise HTTPException(status_code=400, detail="Invalid date_from")
+    if date_to is not None and parsed_to is None:
+        raise HTTPException(status_code=400, detail="Invalid date_to")
+    if date_from is None and date_to is not None:
+        raise HTTPException(status_code=400, detail="date_from must be specified if date_to is specified")
+    if date_from is not None and date_to is None:
+        raise HTTPException(status_code=400, detail="date_to must be specified if date_from is specified")
+
+    if parsed_from is not None and not is_first_day_of_month(parsed_from):
+        raise HTTPException(status_code=400, detail="date_from must be first day of month")
+    if parsed_to is not None and not is_last_day_of_month(parsed_to):
+        raise HTTPException(status_code=400, detail="date_to must be last day of month")
+
+    if month is not None:
+        if date_from is not None:
+            raise HTTPException(status_code=400, detail="month can't be combined with date_from and date_to")
+        parsed_from = parse_month(month)
+        if parsed_from is None:
+            raise HTTPException(status_code=400, detail="Invalid month")
+        parsed_to = parsed_from
+    elif parsed_from is None:
+        parsed_from = parsed_to = date.today()
+
+    month_from = bucket_start(parsed_from, "month")
+    month_to = bucket_start(parsed_to, "month")
+    if month_from > month_to:
+        raise HTTPException(status_code=400, detail="date_from must be before date_to")
+    if count_buckets(month_from, month_to, "month") > MAX_COMPARE_MONTHS:
+        raise HTTPException(status_code=400, detail=f"Too many months, at most {MAX_COMPARE_MONTHS} allowed")
+
+    print(f"month_from: {month_from}, month_to: {month_to}")
+
+    # the default month changes without the data changing, so it's part of the ETag
+    unchanged = await not_modified(user_id, request, response, month_from, month_to)
+    if unchanged is not None:
+        return unchanged
+
+    key = ("budgets.compare", month_from, month_to)
+    rows, token = await cache.get(user_id, key)
+    try:
+        if rows is MISSING:
+            async with db.async_engine.begin() as connection:
+                # budgets and actual spending side by side, one row per category
+                rows = (await connection.execute(
+                    statements.get("budgets.compare"),
+                    [{"user_id": user_id, "month_from": month_from, "month_to": month_to}])).mappings().all()
+                rows = check_access(rows, user_id)
+                await cache.set(user_id, key, rows, token)
     except DBAPIError as error:
         print(f"DBAPIError returned: <<<{error}>>>")
+        raise HTTPException(status_code=500, detail="Database error")
 
-    print(actual_spending)
-
-    # convert budgets to dictionary
-    budgets_dict = dict(budgets._mapping)
-    print(f"budgets_dict: {budgets_dict}")
-
-    # convert actual spending to dictionary
-    actual_spending_dict = {}
-    for row in actual_spending:
-        if row.category is not None:
-            actual_spending_dict[row.category.lower().replace(" ", "_")] = row.total
-        else:
-            actual_spending_dict['other'] = row.total
-    print(f"actual_spending_dict: {actual_spending_dict}")
-
-    # compare actual spending to budget
-    comparisons = {}
-    for category in budgets_dict.keys():
-        if category in actual_spending_dict:
-            comparisons[category] = {"actual": actual_spending_dict[category], "budget": "${:.2f}".format(budgets_dict[category] / 100.0)}
-        else:
-            comparisons[category] = {"actual": "$0.00", "budget": "${:.2f}".format(budgets_dict[category] / 100.0)}
+    if not any(row["budgeted"] for row in rows):
+        raise HTTPException(status_code=404, detail="Budget not found")
+    comparisons = {row["category"]: {"actual": row["actual"], "budget": row["budget"]} for row in rows}
 
     print(comparisons)
     end_time = time.time()
@@ -308,34 +400,184 @@ def compare_budgets_to_actual_spending(user_id: int, date_from: str = None, date
     # in form of {category: {actual: amt, budget: amt}, ...}
     return comparisons
 
+statements.register("budgets.months.set", guarded(
+    """
+    INSERT INTO budget_lines (user_id, category, period, amount_cents)
+    SELECT guard_user_id, line.category, :period, line.amount_cents
+    FROM guard, unnest(CAST(:categories AS text[]), CAST(:amounts AS bigint[])) AS line(category, amount_cents)
+    WHERE guard_user_id IS NOT NULL
+    ON CONFLICT (user_id, category, period) DO UPDATE SET amount_cents = EXCLUDED.amount_cents
+    RETURNING category
+    """
+))
+
+# sets a user's budget from a given month on
+@router.put("/months/{month}", tags=["budgets"])
+async def set_monthly_budget(user_id: int, month: str, budget: NewBudget):
+    """
+    Sets the budget for month (YYYY-MM) and every month after it, up to the
+    next month with a budget of its own. Earlier months keep theirs.
+    """
+    start_time = time.time()
+    period = parse_month(month)
+    if period is None:
+        raise HTTPException(status_code=400, detail="Invalid month")
+    # check if budget is valid
+    amounts = vars(budget)
+    for category, amt in amounts.items():
+        if not isinstance(amt, int) or amt < 0:
+            raise HTTPException(status_code=400, detail="Invalid budget")
+
+    try:
+        async with db.async_engine.begin() as connection:
+            # one budget line per category, replacing any the month already had
+            rows = (await connection.execute(
+                statements.get("budgets.months.set"),
+                [{"user_id": user_id, "period": period,
+                  "categories": list(BUDGET_CATEGORIES.values()),
+                  "amounts": [amounts[field] for field in BUDGET_CATEGORIES]}])).mappings().all()
+            check_access(rows, user_id)
+    except DBAPIError as error:
+        print(f"Error returned: <<<{error}>>>")
+        raise HTTPException(status_code=500, detail="Database error")
+    # the user's cached aggregates are out of date now
+    await cache.invalidate(user_id)
+    end_time = time.time()
+    print(f"time: {(end_time - start_time) * 1000}")
+    return {"month": month, **amounts}
+
+# each category's latest budget line at or before the month
+statements.register("budgets.months.get", guarded(
+    """
+    SELECT c.field, line.amount_cents
+    FROM compare_categories AS c
+    JOIN LATERAL (
+        SELECT amount_cents
+        FROM budget_lines
+        WHERE user_id = :user_id AND category = c.category AND period <= :period
+        ORDER BY period DESC
+        LIMIT 1
+    ) AS line ON TRUE
+    ORDER BY c.position
+    """, ctes=[categories_cte()]
+))
+
+# gets the budget in effect for a month
+@router.get("/months/{month}", tags=["budgets"])
+async def get_monthly_budget(user_id: int, month: str, request: Request = None, response: Response = None):
+    """
+    The budget for month (YYYY-MM), per category. Categories without a budget
+    that month are null.
+    """
+    start_time = time.time()
+    period = parse_month(month)
+    if period is None:
+        raise HTTPException(status_code=400, detail="Invalid month")
+    unchanged = await not_modified(user_id, request, response)
+    if unchanged is not None:
+        return unchanged
+
+    key = ("budgets.months.get", period)
+    ans, token = await cache.get(user_id, key)
+    if ans is not MISSING:
+        return ans
+
+    try:
+        async with db.async_engine.begin() as connection:
+            rows = (await connection.execute(
+                statements.get("budgets.months.get"),
+                [{"user_id": user_id, "period": period}])).mappings().all()
+            rows = check_access(rows, user_id)
+    except DBAPIError as error:
+        print(f"Error returned: <<<{error}>>>")
+        raise HTTPException(status_code=500, detail="Database error")
+
+    if not rows:
+        raise HTTPException(status_code=404, detail="Budget not found")
+    ans = {field: None for field in BUDGET_CATEGORIES}
+    ans.update({row["field"]: row["amount_cents"] for row in rows})
+    await cache.set(user_id, key, ans, token)
+    end_time = time.time()
+    print(f"time: {(end_time - start_time) * 1000}")
+    return ans
+
+# a budget that applies from the start has no month
+statements.register("budgets.history", guarded(
+    """
+    SELECT CASE WHEN l.period = '-infinity' THEN NULL ELSE to_char(l.period, 'YYYY-MM') END AS month,
+    c.field, l.amount_cents
+    FROM budget_lines AS l
+    JOIN compare_categories AS c ON c.category = l.category
+    WHERE l.user_id = :user_id
+    ORDER BY l.period, c.position
+    """, ctes=[categories_cte()]
+))
+
+# gets every budget a user has set, oldest first
+@router.get("/history", tags=["budgets"])
+async def get_budget_history(user_id: int, request: Request = None, response: Response = None):
+    """
+    One entry per month a budget was set from, with the categories it set.
+    month is null for the budget that applies from the start.
+    """
+    start_time = time.time()
+    unchanged = await not_modified(user_id, request, response)
+    if unchanged is not None:
+        return unchanged
+
+    ans, token = await cache.get(user_id, ("budgets.history",))
+    if ans is not MISSING:
+        return ans
+    ans = []
+
+    try:
+        async with db.async_engine.begin() as connection:
+            rows = (await connection.execute(
+                statements.get("budgets.history"),
+                [{"user_id": user_id}])).mappings().all()
+            rows = check_access(rows, user_id)
+        # rows come ordered by month, so each month's lines are together
+        for row in rows:
+            if not ans or ans[-1]["month"] != row["month"]:
+                ans.append({"month": row["month"], "budget": {}})
+            ans[-1]["budget"][row["field"]] = row["amount_cents"]
+        await cache.set(user_id, ("budgets.history",), ans, token)
+    except DBAPIError as error:
+        print(f"Error returned: <<<{error}>>>")
+        raise HTTPException(status_code=500, detail="Database error")
+
+    end_time = time.time()
+    print(f"time: {(end_time - start_time) * 1000}")
+    return ans
+
+statements.register("budgets.categorized", guarded(
+    """
+    SELECT category, ('$' || ROUND((SUM(total_cents) / 100.0), 2)::text) AS total
+    FROM spending_rollup
+    WHERE user_id = :user_id
+    GROUP BY category
+    ORDER BY total
+    """
+))
+
 # gets sum of money spent of different catagories of all purchases for a user
 @router.get("/categories", tags=["budgets"])
-def get_all_purchases_categorized(user_id: int):
+async def get_all_purchases_categorized(user_id: int):
     """ """
     start_time = time.time()
+    ans, token = await cache.get(user_id, ("budgets.categorized",))
+    if ans is not MISSING:
+        return ans
     ans = []
 
     try: 
-        with db.engine.begin() as connection:
-            # check if user exists
-            result = connection.execute(
-                sqlalchemy.text(check_user_query), 
-                [{"user_id": user_id}]).fetchone()
-            if result is None:
-                raise HTTPException(status_code=404, detail="User not found")
-            
+        async with db.async_engine.begin() as connection:
             # ans stores query result as list of dictionaries/json
-            ans = connection.execute(
-                sqlalchemy.text(
-                    """
-                    SELECT category, ('$' || ROUND((SUM(price * quantity) / 100.0), 2)::text) AS total
-                    FROM purchases AS p
-                    JOIN transactions AS t ON p.transaction_id = t.id
-                    WHERE t.user_id = :user_id
-                    GROUP BY category
-                    ORDER BY total
-                    """
-                ), [{"user_id": user_id}]).mappings().all()
+            rows = (await connection.execute(
+                statements.get("budgets.categorized"),
+                [{"user_id": user_id}])).mappings().all()
+            ans = check_access(rows, user_id)
+            await cache.set(user_id, ("budgets.categorized",), ans, token)
     except DBAPIError as error:
         print(f"Error returned: <<<{error}>>>")
 
@@ -345,73 +587,191 @@ def get_all_purchases_categorized(user_id: int):
     
     return ans
 
-# Get warranty of all purchases for a user 
-# and return purchases that are going to expire within a week
-@router.get("/warranty", tags=["budgets"])
-def get_all_purchases_warranty(user_id: int):
+# default number of buckets when from isn't given, and the most one request may ask for
+SERIES_BUCKETS = 12
+MAX_SERIES_BUCKETS = 366
+
+def spending_series_sql(granularity, dense):
+    # months come straight from the rollup, shorter buckets are summed from purchases
+    if granularity == "month":
+        spending = """
+        SELECT month AS bucket, category, total_cents
+        FROM spending_rollup
+        WHERE user_id = :user_id
+        AND month >= :bucket_from AND month < :bucket_end
+        """
+    else:
+        spending = f"""
+        SELECT date_trunc('{granularity}', t.date)::date AS bucket, p.category, SUM(p.price::bigint * p.quantity) AS total_cents
+        FROM transactions AS t
+        JOIN purchases AS p ON p.transaction_id = t.id
+        WHERE t.user_id = :user_id AND t.deleted_at IS NULL
+        AND t.date >= :bucket_from AND t.date < :bucket_end
+        GROUP BY 1, 2
+        """
+    ctes = [f"spending AS ({spending})"]
+
+    if not dense:
+        return guarded(
+            """
+            SELECT bucket, category, ('$' || ROUND((total_cents / 100.0), 2)::text) AS total
+            FROM spending
+            ORDER BY bucket, category
+            """, ctes=ctes)
+
+    # every bucket for every category spent on in the range, zero filled. a range
+    # without any spending still gets one row per bucket, with a NULL category
+    ctes += [
+        f"""buckets AS (
+            SELECT generate_series(CAST(CAST(:bucket_from AS date) AS timestamp), CAST(CAST(:bucket_last AS date) AS timestamp),
+            interval '1 {granularity}')::date AS bucket
+        )""",
+        "categories AS (SELECT DISTINCT category FROM spending)",
+    ]
+    return guarded(
+        """
+        SELECT b.bucket, c.category, ('$' || ROUND((COALESCE(s.total_cents, 0) / 100.0), 2)::text) AS total
+        FROM buckets AS b
+        LEFT JOIN categories AS c ON TRUE
+        LEFT JOIN spending AS s ON s.bucket = b.bucket AND s.category = c.category
+        ORDER BY b.bucket, c.category
+        """, ctes=ctes)
+
+statements.register("budgets.series", spending_series_sql, granularity=GRANULARITIES, dense=[False, True])
+
+# gets spending per category for every day, week or month between from and to,
+# so a chart takes one request instead of one compare call per month
+@router.get("/series", tags=["budgets"])
+async def get_spending_series(user_id: int, granularity: str = "month", date_from: str = Query(None, alias="from"),
+                              date_to: str = Query(None, alias="to"), dense: bool = False):
+    """
+    Buckets cover whole days, weeks (starting Monday) or months, so from and to
+    may fall anywhere inside the first and last bucket. to defaults to today
+    and from to 12 buckets before it.
+    """
+    start_time = time.time()
     ans = []
 
-    try:
-        with db.engine.begin() as connection:
-            # check if user exists
-            result = connection.execute(
-                sqlalchemy.text(check_user_query), 
-                [{"user_id": user_id}]).fetchone()
-            if result is None:
-                raise HTTPException(status_code=404, detail="User not found")
+    if granularity not in GRANULARITIES:
+        raise HTTPException(status_code=400, detail="Invalid granularity")
+    parsed_from = parse_date(date_from) if date_from is not None else None
+    parsed_to = parse_date(date_to) if date_to is not None else date.today()
+    if date_from is not None and parsed_from is None:
+        raise HTTPException(status_code=400, detail="Invalid from")
+    if parsed_to is None:
+        raise HTTPException(status_code=400, detail="Invalid to")
+
+    bucket_last = bucket_start(parsed_to, granularity)
+    if parsed_from is None:
+        bucket_from = shift_buckets(bucket_last, granularity, 1 - SERIES_BUCKETS)
+    else:
+        bucket_from = bucket_start(parsed_from, granularity)
+    if bucket_from > bucket_last:
+        raise HTTPException(status_code=400, detail="from must be before to")
+    if count_buckets(bucket_from, bucket_last, granularity) > MAX_SERIES_BUCKETS:
+        raise HTTPException(status_code=400, detail=f"Too many buckets, at most {MAX_SERIES_BUCKETS} allowed")
+
+    key = ("budgets.series", granularity, bucket_from, bucket_last, dense)
+    cached, token = await cache.get(user_id, key)
+    if cached is not MISSING:
+        return cached
 
-            # ans stores query result as a list of dictionaries/json
-            ans = connection.execute(
-                sqlalchemy.text(
-                    """
-                    SELECT item, warranty_date, ('$' || ROUND((price / 100.0), 2)::text) as price, quantity, category
-                    FROM purchases AS p
-                    JOIN transactions AS t ON p.transaction_id = t.id
-                    WHERE t.user_id = :user_id
-                    AND p.warranty_date IS NOT NULL AND p.warranty_date != ''
-                    AND p.warranty_date::DATE BETWEEN NOW()::DATE AND NOW()::DATE + INTERVAL '6 days'
-                    ORDER BY p.warranty_date
-                    """
-                ), {"user_id": user_id}
-            ).mappings().all()
+    try:
+        async with db.async_engine.begin() as connection:
+            # one grouped query for every bucket and category
+            rows = (await connection.execute(
+                statements.get("budgets.series", granularity=granularity, dense=dense),
+                [{"user_id": user_id, "bucket_from": bucket_from, "bucket_last": bucket_last,
+                  "bucket_end": shift_buckets(bucket_last, granularity, 1)}])).mappings().all()
+            ans = check_access(rows, user_id)
+            await cache.set(user_id, key, ans, token)
     except DBAPIError as error:
         print(f"Error returned: <<<{error}>>>")
 
-    print(f"USER_{user_id}_PURCHASES_WARRANTY: {ans}")
+    end_time = time.time()
+    print(f"time: {(end_time - start_time) * 1000}")
 
+    # in form of [{bucket: date, category: str, total: amt}, ...]
     return ans
 
-# Get all purchases that have a return date in a week
-@router.get("/return", tags=["budgets"])
-def get_all_purchases_return(user_id: int):
+# default and largest page of warranty or return deadlines
+DEADLINES_LIMIT = 50
+MAX_DEADLINES_LIMIT = 500
+MAX_WITHIN_DAYS = 3650
+
+# warranty_date and return_date are YYYY-MM-DD text, so only well formed values
+# are compared. the partial (user_id, date, id) indexes from migration 0007 carry
+# the same condition, which lets a date window be a single index range scan
+WELL_FORMED_DATE = r"'^\d{4}-\d{2}-\d{2}$'"
+
+def deadlines_sql(column, paging):
+    # expired dates sort before today's, so include_expired only drops the lower bound
+    sort_key, after = keyset_sql(f"p.{column}", "p.id", "asc", "text", paging)
+    return guarded(
+        f"""
+        SELECT p.id, item, {column}, ('$' || ROUND((price / 100.0), 2)::text) as price, quantity, category{sort_key}
+        FROM purchases AS p
+        JOIN transactions AS t ON t.id = p.transaction_id AND t.deleted_at IS NULL
+        WHERE p.user_id = :user_id
+        AND p.{column} ~ {WELL_FORMED_DATE}
+        AND p.{column} >= CASE WHEN :include_expired THEN '' ELSE to_char(CURRENT_DATE, 'YYYY-MM-DD') END
+        AND p.{column} < to_char(CURRENT_DATE + CAST(:within_days AS integer), 'YYYY-MM-DD')
+        {after}
+        ORDER BY {order_sql(f"p.{column}", "p.id", "asc", "first")}
+        {limit_sql(paging)}
+        """
+    )
+
+statements.register("budgets.warranty", lambda paging: deadlines_sql("warranty_date", paging), paging=PAGING)
+statements.register("budgets.return", lambda paging: deadlines_sql("return_date", paging), paging=PAGING)
+
+async def get_deadlines(name, column, user_id, within_days, limit, after, include_expired):
+    """
+    Returns purchases whose column falls within the next within_days days
+    (today included), soonest first. Without after this is a plain list of at
+    most limit rows; with it, a {"items", "next_cursor"} page like the listing
+    endpoints return.
+    """
+    if within_days < 1 or within_days > MAX_WITHIN_DAYS:
+        raise HTTPException(status_code=400, detail="Invalid within_days")
+    if limit < 1 or limit > MAX_DEADLINES_LIMIT:
+        raise HTTPException(status_code=400, detail="Invalid limit")
+
     ans = []
+    paging = paging_mode(after)
+    cursor = keyset_params(after, column, "asc")
 
     try:
-        with db.engine.begin() as connection:
-            # check if user exists
-            result = connection.execute(
-                sqlalchemy.text(check_user_query), 
-                [{"user_id": user_id}]).fetchone()
-            if result is None:
-                raise HTTPException(status_code=404, detail="User not found")
-
+        async with db.async_engine.begin() as connection:
             # ans stores query result as a list of dictionaries/json
-            ans = connection.execute(
-                sqlalchemy.text(
-                    """
-                    SELECT item, return_date, ('$' || ROUND((price / 100.0), 2)::text) as price, quantity, category
-                    FROM purchases AS p
-                    JOIN transactions AS t ON p.transaction_id = t.id
-                    WHERE t.user_id = :user_id
-                    AND p.return_date IS NOT NULL AND p.return_date != ''
-                    AND p.return_date::DATE BETWEEN NOW()::DATE AND NOW()::DATE + INTERVAL '6 days'
-                    ORDER BY p.return_date
-                    """
-                ), {"user_id": user_id}
-            ).mappings().all()
+            rows = (await connection.execute(
+                statements.get(name, paging=paging),
+                {"user_id": user_id, "within_days": within_days, "include_expired": include_expired,
+                 "page_size": limit, "offset": 0, **cursor}
+            )).mappings().all()
+            ans = check_access(rows, user_id)
+            if paging != "offset":
+                ans = keyset_page(ans, limit, column, "asc")
     except DBAPIError as error:
         print(f"Error returned: <<<{error}>>>")
 
+    return ans
+
+# Get warranty of all purchases for a user 
+# and return purchases that are going to expire within a week
+@router.get("/warranty", tags=["budgets"])
+async def get_all_purchases_warranty(user_id: int, within_days: int = 7, limit: int = DEADLINES_LIMIT, after: Optional[str] = None, include_expired: bool = False):
+    ans = await get_deadlines("budgets.warranty", "warranty_date", user_id, within_days, limit, after, include_expired)
+
+    print(f"USER_{user_id}_PURCHASES_WARRANTY: {ans}")
+
+    return ans
+
+# Get all purchases that have a return date in a week
+@router.get("/return", tags=["budgets"])
+async def get_all_purchases_return(user_id: int, within_days: int = 7, limit: int = DEADLINES_LIMIT, after: Optional[str] = None, include_expired: bool = False):
+    ans = await get_deadlines("budgets.return", "return_date", user_id, within_days, limit, after, include_expired)
+
     print(f"USER_{user_id}_PURCHASES_RETURN: {ans}")
 
     return ans
@@ -0,0 +1,419 @@
+import asyncio
+import collections
+import datetime
+import json
+import math
+import os
+import time
+import uuid
+from abc import ABC, abstractmethod
+
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError, WatchError
+
+# Cache for per-user reads (transactions, purchases, budgets, compare,
+# categories, series, dashboard). Entries are keyed by user and query shape and
+# expire after a TTL. Every endpoint that writes a user's transactions,
+# purchases or budgets calls invalidate(user_id) after committing, which drops
+# all of that user's entries.
+#
+# A read that started before an invalidation must not put what it read back
+# into the cache, so get() hands out a token along with the value and set()
+# ignores results whose token is older than the user's last invalidation.
+#
+# CACHE_BACKEND picks where entries live: "memory" keeps them in this process,
+# "redis" shares them between every worker pointed at the same REDIS_URL.
+
+MISSING = object()
+
+def cache_settings():
+    return {
+        "max_entries": int(os.environ.get("CACHE_MAX_ENTRIES", 10000)),
+        "ttl": float(os.environ.get("CACHE_TTL_SECONDS", 60)),
+    }
+
+def redis_settings():
+    return {
+        "url": os.environ.get("REDIS_URL", "redis://localhost:6379/0"),
+        "prefix": os.environ.get("CACHE_REDIS_PREFIX", "receipts:cache"),
+        "l1_ttl": float(os.environ.get("CACHE_L1_TTL_SECONDS", 5)),
+    }
+
+class UserCache:
+    def __init__(self, max_entries=10000, ttl=60.0, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = collections.OrderedDict()
+        self._keys_by_user = collections.defaultdict(set)
+        # when each user was last invalidated, bounded like the entries. a user
+        # whose stamp was dropped counts as invalidated at the newest dropped stamp
+        self._invalidated = collections.OrderedDict()
+        self._dropped_stamp = 0
+        self._counter = 0
+        self._stats = {"hits": 0, "misses": 0, "expirations": 0, "evictions": 0, "invalidations": 0, "stale_sets": 0}
+
+    def token(self):
+        return self._counter
+
+    def get(self, user_id, key):
+        """
+        Returns the cached value for user_id and key, or MISSING. Cached values
+        are shared between requests and must not be modified.
+        """
+        entry = self._entries.get((user_id, key))
+        if entry is None:
+            self._stats["misses"] += 1
+            return MISSING
+
+        expires_at, value = entry
+        if expires_at <= self._clock():
+            self._stats["expirations"] += 1
+            self._stats["misses"] += 1
+            self._remove((user_id, key))
+            return MISSING
+
+        self._entries.move_to_end((user_id, key))
+        self._stats["hits"] += 1
+        return value
+
+    def set(self, user_id, key, value, token):
+        # the user's data changed after this value was read
+        if token < self._invalidated.get(user_id, self._dropped_stamp):
+            self._stats["stale_sets"] += 1
+            return
+
+        self._entries[(user_id, key)] = (self._clock() + self.ttl, value)
+        self._entries.move_to_end((user_id, key))
+        self._keys_by_user[user_id].add(key)
+
+        while len(self._entries) > self.max_entries:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self._stats["evictions"] += 1
+
+    def invalidate(self, user_id):
+        self._counter += 1
+        self._invalidated[user_id] = self._counter
+        self._invalidated.move_to_end(user_id)
+        while len(self._invalidated) > self.max_entries:
+            _, stamp = self._invalidated.popitem(last=False)
+            self._dropped_stamp = max(self._dropped_stamp, stamp)
+
+        self._stats["invalidations"] += 1
+        for key in self._keys_by_user.pop(user_id, ()):
+            del self._entries[(user_id, key)]
+
+    def clear(self):
+        self._entries.clear()
+        self._keys_by_user.clear()
+
+    def stats(self):
+        lookups = self._stats["hits"] + self._stats["misses"]
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            **self._stats,
+            "hit_rate": self._stats["hits"] / lookups if lookups else None,
+        }
+
+    def _remove(self, entry_key):
+        user_id, key = entry_key
+        del self._entries[entry_key]
+        keys = self._keys_by_user.get(user_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_user[user_id]
+
+class CacheBackend(ABC):
+    """
+    What the endpoints talk to. get() returns the cached value or MISSING,
+    together with a token to pass to set() once the value has been read from
+    the database. Cached values are shared between requests and must not be
+    modified.
+    """
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    @abstractmethod
+    async def get(self, user_id, key):
+        ...
+
+    @abstractmethod
+    async def set(self, user_id, key, value, token):
+        ...
+
+    @abstractmethod
+    async def invalidate(self, user_id):
+        ...
+
+    @abstractmethod
+    async def clear(self):
+        ...
+
+    @abstractmethod
+    async def stats(self):
+        ...
+
+class MemoryBackend(CacheBackend):
+    """
+    Entries live in this process only, so with several workers each one caches
+    separately and only sees its own invalidations.
+    """
+
+    def __init__(self, max_entries=10000, ttl=60.0, clock=time.monotonic):
+        self.cache = UserCache(max_entries=max_entries, ttl=ttl, clock=clock)
+
+    async def get(self, user_id, key):
+        token = self.cache.token()
+        return self.cache.get(user_id, key), token
+
+    async def set(self, user_id, key, value, token):
+        self.cache.set(user_id, key, value, token)
+
+    async def invalidate(self, user_id):
+        self.cache.invalidate(user_id)
+
+    async def clear(self):
+        self.cache.clear()
+
+    async def stats(self):
+        return {"backend": "memory", **self.cache.stats()}
+
+def encode(value):
+    # dates go over the wire the way the API returns them anyway
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} can't be cached")
+
+# seconds to wait before subscribing again after losing the invalidation channel
+RESUBSCRIBE_SECONDS = 1.0
+
+class RedisBackend(CacheBackend):
+    """
+    Entries live in Redis, one hash per user, so every worker shares them and
+    a write on one worker is seen by all. Each user also has a generation
+    counter that invalidate() bumps: set() only writes if the generation is
+    still the one get() saw, which keeps racing reads out like the memory
+    backend's tokens do.
+
+    Hits are also kept in a small in-process cache (l1) with a short TTL, so
+    hot keys don't cost a round trip. invalidate() publishes the user on a
+    channel every worker subscribes to, and each worker drops that user from
+    its l1. l1 is only used while subscribed, and emptied on resubscribing,
+    so a worker that missed messages doesn't serve what they invalidated.
+    """
+
+    def __init__(self, client, ttl=60.0, prefix="receipts:cache", l1_max_entries=10000, l1_ttl=5.0,
+                 clock=time.time, l1_clock=time.monotonic):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.channel = f"{prefix}:invalidations"
+        self.l1 = UserCache(max_entries=l1_max_entries, ttl=l1_ttl, clock=l1_clock)
+        self.subscribed = False
+        self._clock = clock
+        # tells this worker's own messages apart, it has already applied them
+        self._origin = uuid.uuid4().hex
+        self._pubsub = None
+        self._listener = None
+        self._stats = {"hits": 0, "misses": 0, "l1_hits": 0, "expirations": 0, "invalidations": 0,
+                       "remote_invalidations": 0, "stale_sets": 0, "errors": 0}
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        return cls(aioredis.from_url(url), **kwargs)
+
+    def _data_key(self, user_id):
+        return f"{self.prefix}:{user_id}:data"
+
+    def _generation_key(self, user_id):
+        return f"{self.prefix}:{user_id}:generation"
+
+    def _error(self, error):
+        # the cache is never worth failing a request over, the database answers instead
+        self._stats["errors"] += 1
+        print(f"Cache error: <<<{error}>>>")
+
+    async def start(self):
+        try:
+            await self._subscribe()
+        except RedisError as error:
+            self._error(error)
+        self._listener = asyncio.create_task(self._listen())
+
+    async def close(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+        await self._unsubscribe()
+        await self.client.aclose()
+
+    async def _subscribe(self):
+        self._pubsub = self.client.pubsub()
+        await self._pubsub.subscribe(self.channel)
+        # anything could have changed while we weren't listening
+        self.l1.clear()
+        self.subscribed = True
+
+    async def _unsubscribe(self):
+        self.subscribed = False
+        if self._pubsub is not None:
+            pubsub, self._pubsub = self._pubsub, None
+            try:
+                await pubsub.aclose()
+            except RedisError as error:
+                self._error(error)
+
+    async def _listen(self):
+        while True:
+            try:
+                if self._pubsub is None:
+                    await self._subscribe()
+                async for message in self._pubsub.listen():
+                    if message["type"] == "message":
+                        self._receive(message["data"])
+            except RedisError as error:
+                self._error(error)
+            await self._unsubscribe()
+            await asyncio.sleep(RESUBSCRIBE_SECONDS)
+
+    def _receive(self, data):
+        message = json.loads(data)
+        if message["origin"] == self._origin:
+            return
+        self._stats["remote_invalidations"] += 1
+        if message["user_id"] is None:
+            self.l1.clear()
+        else:
+            self.l1.invalidate(message["user_id"])
+
+    def _message(self, user_id):
+        # user_id None means every user
+        return json.dumps({"origin": self._origin, "user_id": user_id})
+
+    async def get(self, user_id, key):
+        l1_token = self.l1.token()
+        if self.subscribed:
+            value = self.l1.get(user_id, key)
+            if value is not MISSING:
+                self._stats["hits"] += 1
+                self._stats["l1_hits"] += 1
+                return value, None
+
+        try:
+            async with self.client.pipeline(transaction=False) as pipe:
+                pipe.hget(self._data_key(user_id), json.dumps(key, default=encode))
+                pipe.get(self._generation_key(user_id))
+                payload, generation = await pipe.execute()
+        except RedisError as error:
+            self._error(error)
+            return MISSING, None
+
+        token = (l1_token, int(generation or 0))
+        if payload is None:
+            self._stats["misses"] += 1
+            return MISSING, token
+
+        entry = json.loads(payload)
+        if entry["expires_at"] <= self._clock():
+            self._stats["expirations"] += 1
+            self._stats["misses"] += 1
+            return MISSING, token
+
+        self._stats["hits"] += 1
+        if self.subscribed:
+            self.l1.set(user_id, key, entry["value"], l1_token)
+        return entry["value"], token
+
+    async def set(self, user_id, key, value, token):
+        # the get() that handed out this token couldn't reach Redis
+        if token is None:
+            return
+        l1_token, generation = token
+        payload = json.dumps({"expires_at": self._clock() + self.ttl, "value": value}, default=encode)
+        generation_key = self._generation_key(user_id)
+
+        try:
+            async with self.client.pipeline(transaction=True) as pipe:
+                await pipe.watch(generation_key)
+                if int(await pipe.get(generation_key) or 0) != generation:
+                    self._stats["stale_sets"] += 1
+                    return
+                pipe.multi()
+                # entries carry their own expiry, the hash's only cleans up
+                # users nobody has read for a while
+                pipe.hset(self._data_key(user_id), json.dumps(key, default=encode), payload)
+                pipe.expire(self._data_key(user_id), math.ceil(self.ttl))
+                await pipe.execute()
+        except WatchError:
+            # invalidated between the check and the write
+            self._stats["stale_sets"] += 1
+            return
+        except RedisError as error:
+            self._error(error)
+            return
+
+        if self.subscribed:
+            # what other workers would read back from Redis
+            self.l1.set(user_id, key, json.loads(payload)["value"], l1_token)
+
+    async def invalidate(self, user_id):
+        self.l1.invalidate(user_id)
+        self._stats["invalidations"] += 1
+        try:
+            async with self.client.pipeline(transaction=True) as pipe:
+                pipe.incr(self._generation_key(user_id))
+                pipe.delete(self._data_key(user_id))
+                pipe.publish(self.channel, self._message(user_id))
+                await pipe.execute()
+        except RedisError as error:
+            # other workers keep serving this user's entries until they expire
+            self._error(error)
+
+    async def clear(self):
+        self.l1.clear()
+        try:
+            keys = [key async for key in self.client.scan_iter(match=f"{self.prefix}:*:data")]
+            async with self.client.pipeline(transaction=False) as pipe:
+                if keys:
+                    pipe.delete(*keys)
+                pipe.publish(self.channel, self._message(None))
+                await pipe.execute()
+        except RedisError as error:
+            self._error(error)
+
+    async def stats(self):
+        lookups = self._stats["hits"] + self._stats["misses"]
+        return {
+            "backend": "redis",
+            "subscribed": self.subscribed,
+            "entries": self.l1.stats()["entries"],
+            "ttl": self.ttl,
+            "l1_ttl": self.l1.ttl,
+            **self._stats,
+            "hit_rate": self._stats["hits"] / lookups if lookups else None,
+        }
+
+def create_backend(name=None):
+    name = name or os.environ.get("CACHE_BACKEND", "memory")
+    if name == "memory":
+        return MemoryBackend(**cache_settings())
+    if name == "redis":
+        settings = redis_settings()
+        return RedisBackend.from_url(
+            settings["url"], ttl=cache_settings()["ttl"], prefix=settings["prefix"],
+            l1_max_entries=cache_settings()["max_entries"], l1_ttl=settings["l1_ttl"])
+    raise ValueError(f"Unknown CACHE_BACKEND: {name}")
+
+cache = create_backend()
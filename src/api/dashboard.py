@@ -0,0 +1,106 @@
+from fastapi import APIRouter, Depends
+from src.api import auth
+from src.api.access import guarded, check_access
+from src.api.budget import comparison_ctes, WELL_FORMED_DATE
+from src.api.statements import registry as statements
+from src.api.cache import cache, MISSING
+from src import database as db
+from sqlalchemy.exc import DBAPIError
+from fastapi import HTTPException
+from datetime import date
+import time
+
+router = APIRouter(
+    prefix="/user/{user_id}/dashboard",
+    tags=["dashboard"],
+    dependencies=[Depends(auth.get_api_key)],
+)
+
+MAX_LIMIT = 50
+
+def deadlines_cte(name, column):
+    # upcoming warranty or return dates, soonest first, off the indexes from migration 0007
+    return f"""{name} AS (
+        SELECT item, {column}, ('$' || ROUND((price / 100.0), 2)::text) AS price, quantity, category
+        FROM purchases AS p
+        JOIN transactions AS t ON t.id = p.transaction_id AND t.deleted_at IS NULL
+        WHERE p.user_id = :user_id
+        AND p.{column} ~ {WELL_FORMED_DATE}
+        AND p.{column} >= to_char(CURRENT_DATE, 'YYYY-MM-DD')
+        ORDER BY p.{column}, p.id
+        LIMIT :limit
+    )"""
+
+# every section of the dashboard is a CTE of one statement, aggregated to a
+# single JSON value, so the whole page is one round trip on one connection
+statements.register("dashboard.get", guarded(
+    """
+    SELECT
+        (SELECT json_object_agg(field, budget_cents ORDER BY position) FROM comparison WHERE budget_cents IS NOT NULL) AS budget,
+        (SELECT json_object_agg(field, json_build_object(
+            'actual', '$' || ROUND((actual_cents / 100.0), 2)::text,
+            'budget', '$' || ROUND((COALESCE(budget_cents, 0) / 100.0), 2)::text) ORDER BY position)
+         FROM comparison HAVING bool_or(budget_cents IS NOT NULL)) AS comparison,
+        (SELECT COALESCE(json_agg(category_totals ORDER BY total), '[]') FROM category_totals) AS categories,
+        (SELECT COALESCE(json_agg(warranties ORDER BY warranty_date), '[]') FROM warranties) AS warranties,
+        (SELECT COALESCE(json_agg(returns ORDER BY return_date), '[]') FROM returns) AS returns,
+        (SELECT COALESCE(json_agg(recent ORDER BY date DESC, id DESC), '[]') FROM recent) AS recent_transactions
+    """,
+    ctes=[
+        # this month's budget lines against this month's spending, the same join as /budgets/compare
+        *comparison_ctes(),
+        """category_totals AS (
+            SELECT category, ('$' || ROUND((SUM(total_cents) / 100.0), 2)::text) AS total
+            FROM spending_rollup
+            WHERE user_id = :user_id
+            GROUP BY category
+        )""",
+        deadlines_cte("warranties", "warranty_date"),
+        deadlines_cte("returns", "return_date"),
+        """recent AS (
+            SELECT id, merchant, description, date
+            FROM transactions
+            WHERE user_id = :user_id
+            AND date IS NOT NULL AND deleted_at IS NULL
+            ORDER BY date DESC, id DESC
+            LIMIT :limit
+        )""",
+    ]
+))
+
+# gets everything the dashboard shows in one request: budget vs actual spending
+# this month, all time category totals, the next warranty and return deadlines
+# and the most recent transactions
+@router.get("/", tags=["dashboard"])
+async def get_dashboard(user_id: int, limit: int = 5):
+    """
+    limit caps the deadlines and recent transactions lists, at most 50.
+    budget and comparison are None when the user has no budget this month.
+    """
+    start_time = time.time()
+    if limit < 1 or limit > MAX_LIMIT:
+        raise HTTPException(status_code=400, detail="Invalid limit")
+
+    # deadlines count from today, so a new day is a new entry
+    today = date.today()
+    key = ("dashboard.get", limit, today)
+    dashboard, token = await cache.get(user_id, key)
+    if dashboard is not MISSING:
+        return dashboard
+
+    month = today.replace(day=1)
+    try:
+        async with db.async_engine.begin() as connection:
+            rows = (await connection.execute(
+                statements.get("dashboard.get"),
+                [{"user_id": user_id, "limit": limit, "month_from": month, "month_to": month}])).mappings().all()
+            dashboard = check_access(rows, user_id)[0]
+            await cache.set(user_id, key, dashboard, token)
+    except DBAPIError as error:
+        print(f"Error returned: <<<{error}>>>")
+
+    end_time = time.time()
+    print(f"time: {(end_time - start_time) * 1000}")
+
+    # the driver decodes the JSON columns, so each section is already a dict or list
+    return dashboard
@@ -0,0 +1,70 @@
+from datetime import date, datetime, timedelta
+
+# Dates cross the API as YYYY-MM-DD strings. They are parsed here once, at
+# the boundary, and handed to the database as date objects so comparisons run
+# on the date column's own type instead of on text.
+
+DATE_FORMAT = "%Y-%m-%d"
+
+def parse_date(date_string):
+    """
+    Returns the date for a strict YYYY-MM-DD string (zero padded), or None if
+    date_string isn't one.
+    """
+    if not isinstance(date_string, str):
+        return None
+    try:
+        parsed = datetime.strptime(date_string, DATE_FORMAT).date()
+    except ValueError:
+        return None
+
+    # strptime also accepts unpadded months and days like 2023-1-5
+    year, month, day = date_string.split('-')
+    if len(year) != 4 or len(month) != 2 or len(day) != 2:
+        return None
+    return parsed
+
+def is_valid_date(date_string):
+    return parse_date(date_string) is not None
+
+def _as_date(value):
+    return value if isinstance(value, date) else parse_date(value)
+
+def is_first_day_of_month(value):
+    value = _as_date(value)
+    return value is not None and value.day == 1
+
+def is_last_day_of_month(value):
+    value = _as_date(value)
+    return value is not None and (value + timedelta(days=1)).month != value.month
+
+# buckets for time series, named after Postgres' date_trunc fields. weeks
+# start on Monday, as they do for date_trunc('week', ...)
+GRANULARITIES = ["day", "week", "month"]
+
+def bucket_start(value, granularity):
+    if granularity == "day":
+        return value
+    if granularity == "week":
+        return value - timedelta(days=value.weekday())
+    return value.replace(day=1)
+
+def shift_buckets(start, granularity, count):
+    """
+    Returns the start of the bucket count buckets after (or, if count is
+    negative, before) the bucket starting at start.
+    """
+    if granularity == "day":
+        return start + timedelta(days=count)
+    if granularity == "week":
+        return start + timedelta(weeks=count)
+    months = start.year * 12 + start.month - 1 + count
+    return date(months // 12, months % 12 + 1, 1)
+
+def count_buckets(first, last, granularity):
+    # both ends are bucket starts, and both are counted
+    if granularity == "day":
+        return (last - first).days + 1
+    if granularity == "week":
+        return (last - first).days // 7 + 1
+    return (last.year - first.year) * 12 + last.month - first.month + 1
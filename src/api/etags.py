@@ -0,0 +1,63 @@
+from fastapi import Response
+from src.api.statements import registry as statements
+from src import database as db
+import hashlib
+
+# ETags for per-user reads, from users.data_version (see migration 0009),
+# which goes up on every write to the user's transactions, purchases or
+# budgets. A client that sends back the ETag it got in If-None-Match gets an
+# empty 304 while the version hasn't moved, after one primary key lookup and
+# none of the endpoint's own queries.
+
+statements.register("etags.version", "SELECT data_version FROM users WHERE id = :user_id AND deleted_at IS NULL")
+
+async def data_version(user_id):
+    # None for a user that doesn't exist
+    async with db.async_engine.connect() as connection:
+        return (await connection.execute(statements.get("etags.version"), {"user_id": user_id})).scalar()
+
+def make_etag(user_id, version, shape):
+    return f'W/"u{user_id}-v{version}-{shape}"'
+
+def request_shape(request, *extra):
+    """
+    Identifies which representation of the user's data a request asks for:
+    the path, the query string and anything else the response depends on,
+    like the month a default date range resolved to.
+    """
+    query = sorted(request.query_params.multi_items())
+    return hashlib.sha1(repr((request.url.path, query, extra)).encode()).hexdigest()[:16]
+
+def etag_matches(if_none_match, etag):
+    # weak comparison, the W/ prefix doesn't count
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return etag.removeprefix("W/") in [tag.removeprefix("W/") for tag in tags]
+
+async def not_modified(user_id, request, response, *extra):
+    """
+    Returns a 304 response if the client's copy, per If-None-Match, is still
+    current. Otherwise sets the ETag on response and returns None, and the
+    endpoint answers as usual. The version is read before the endpoint's own
+    queries, so the ETag is never newer than the body it goes with. Does
+    nothing when called without a request, or for a user that doesn't exist
+    so the endpoint can raise its usual 404.
+    """
+    if request is None:
+        return None
+
+    version = await data_version(user_id)
+    if version is None:
+        return None
+
+    etag = make_etag(user_id, version, request_shape(request, *extra))
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    if response is not None:
+        response.headers.update(headers)
+    return None
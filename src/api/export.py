@@ -0,0 +1,100 @@
+from fastapi import APIRouter, Depends
+from fastapi.responses import StreamingResponse
+from src.api import auth
+from src.api.statements import registry as statements
+from src import database as db
+from fastapi import HTTPException
+import csv
+import io
+import json
+import time
+
+router = APIRouter(
+    prefix="/user/{user_id}/export",
+    tags=["export"],
+    dependencies=[Depends(auth.get_api_key)],
+)
+
+# rows fetched from the server side cursor, and written out, per chunk
+EXPORT_BATCH = 1000
+
+FORMATS = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+}
+
+COLUMNS = ["transaction_id", "merchant", "description", "date", "purchase_id", "item", "price", "category",
+           "quantity", "warranty_date", "return_date"]
+
+statements.register("export.user", "SELECT id FROM users WHERE id = :user_id AND deleted_at IS NULL")
+
+# one row per purchase, plus one per transaction without purchases, in the
+# order of transactions_user_id_date_idx so nothing has to be sorted up front
+statements.register("export.history", """
+    SELECT t.id AS transaction_id, t.merchant, t.description, t.date, p.id AS purchase_id, p.item, p.price,
+    p.category, p.quantity, p.warranty_date, p.return_date
+    FROM transactions AS t
+    LEFT JOIN purchases AS p ON p.transaction_id = t.id
+    WHERE t.user_id = :user_id AND t.deleted_at IS NULL
+    ORDER BY t.date, t.id, p.id
+    """)
+
+def csv_chunk(rows, header=False):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(COLUMNS)
+    writer.writerows(rows)
+    return buffer.getvalue()
+
+def ndjson_chunk(rows):
+    # dates become YYYY-MM-DD strings
+    return "".join(json.dumps(dict(zip(COLUMNS, row)), default=str) + "\n" for row in rows)
+
+async def stream_history(connection, result, format):
+    """
+    Yields the export a chunk of EXPORT_BATCH rows at a time, so memory stays
+    flat however long the history is, and closes the connection when done.
+    """
+    start_time = time.time()
+    try:
+        if format == "csv":
+            yield csv_chunk([], header=True)
+        async for rows in result.partitions():
+            yield csv_chunk(rows) if format == "csv" else ndjson_chunk(rows)
+    finally:
+        await result.close()
+        await connection.close()
+        end_time = time.time()
+        print(f"time: {(end_time - start_time) * 1000}")
+
+# exports every transaction and purchase of a user as CSV or newline delimited JSON
+@router.get("/", tags=["export"])
+async def export_history(user_id: int, format: str = "csv"):
+    """
+    Streams rows through a server side cursor as they are read instead of
+    building the whole export in memory first.
+    """
+    if format not in FORMATS:
+        raise HTTPException(status_code=400, detail="Invalid format")
+
+    # the connection outlives this function: stream_history closes it once the
+    # response has been sent
+    connection = await db.async_engine.connect()
+    try:
+        user = (await connection.execute(statements.get("export.user"), [{"user_id": user_id}])).first()
+        if user is None:
+            raise HTTPException(status_code=404, detail="User not found")
+
+        result = await connection.stream(
+            statements.get("export.history"),
+            {"user_id": user_id},
+            execution_options={"yield_per": EXPORT_BATCH})
+    except BaseException:
+        await connection.close()
+        raise
+
+    return StreamingResponse(
+        stream_history(connection, result, format),
+        media_type=FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="user_{user_id}_history.{format}"'})
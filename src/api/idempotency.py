@@ -0,0 +1,255 @@
+from starlette.responses import JSONResponse
+from src.api.statements import registry as statements
+from src import database as db
+from sqlalchemy.exc import DBAPIError
+import asyncio
+import hashlib
+import json
+import os
+import time
+
+# Idempotency-Key support for every POST. The first request with a given key
+# claims it in idempotency_keys (migration 0012) and runs as usual, and its
+# response is stored as it goes out. A retry with the same key and request
+# gets the stored response replayed, marked with Idempotent-Replayed, without
+# the endpoint running again: no duplicate rows, and no second S3 upload or
+# OpenAI call for a receipt. A retry that arrives while the first request is
+# still running waits for it. Reusing a key for a different request is a 422.
+#
+# 5xx responses aren't stored, and the key is released, so a retry after a
+# server error runs again. Keys are kept for IDEMPOTENCY_TTL_SECONDS.
+
+HEADER = b"idempotency-key"
+MAX_KEY_LENGTH = 255
+
+def idempotency_settings():
+    return {
+        "ttl": float(os.environ.get("IDEMPOTENCY_TTL_SECONDS", 24 * 3600)),
+        # how long a retry waits on the request holding its key
+        "wait": float(os.environ.get("IDEMPOTENCY_WAIT_SECONDS", 60)),
+        # a request holding a key this long is taken to have died with its worker
+        "lock_timeout": float(os.environ.get("IDEMPOTENCY_LOCK_SECONDS", 300)),
+        "poll": float(os.environ.get("IDEMPOTENCY_POLL_SECONDS", 0.1)),
+        "sweep_interval": float(os.environ.get("IDEMPOTENCY_SWEEP_SECONDS", 60)),
+    }
+
+# a key that expired, or whose request died, is claimed over
+statements.register("idempotency.claim", """
+    INSERT INTO idempotency_keys (client, key, request_hash, expires_at)
+    VALUES (:client, :key, :request_hash, now() + make_interval(secs => :ttl))
+    ON CONFLICT (client, key) DO UPDATE
+    SET request_hash = EXCLUDED.request_hash, status = 'in_flight', response_status = NULL,
+        response_headers = NULL, response_body = NULL, created_at = now(), expires_at = EXCLUDED.expires_at
+    WHERE idempotency_keys.expires_at < now()
+    OR (idempotency_keys.status = 'in_flight' AND idempotency_keys.created_at < now() - make_interval(secs => :lock_timeout))
+    RETURNING key
+    """)
+
+statements.register("idempotency.get", """
+    SELECT request_hash, status, response_status, response_headers, response_body
+    FROM idempotency_keys
+    WHERE client = :client AND key = :key AND expires_at >= now()
+    """)
+
+statements.register("idempotency.store", """
+    UPDATE idempotency_keys
+    SET status = 'done', response_status = :response_status,
+        response_headers = CAST(:response_headers AS jsonb), response_body = :response_body
+    WHERE client = :client AND key = :key AND request_hash = :request_hash AND status = 'in_flight'
+    """)
+
+statements.register("idempotency.release", """
+    DELETE FROM idempotency_keys
+    WHERE client = :client AND key = :key AND request_hash = :request_hash AND status = 'in_flight'
+    """)
+
+statements.register("idempotency.sweep", """
+    DELETE FROM idempotency_keys
+    WHERE (client, key) IN (
+        SELECT client, key
+        FROM idempotency_keys
+        WHERE expires_at < now()
+        LIMIT 1000
+    )
+    """)
+
+def client_id(api_key):
+    # the API key itself is never stored
+    return hashlib.sha256((api_key or "").encode()).hexdigest()[:32]
+
+def request_hash(method, path, query_string, content_type, body):
+    """
+    Fingerprints a request, so a retry can be told apart from a different
+    request reusing the key. Clients pick a new multipart boundary each time
+    they build a request, so the boundary is left out.
+    """
+    boundary = content_type.partition("boundary=")[2].split(";")[0].strip().strip('"')
+    if boundary:
+        body = body.replace(boundary.encode("latin-1"), b"")
+    digest = hashlib.sha256()
+    for part in (method.encode(), path.encode(), query_string, body):
+        digest.update(len(part).to_bytes(8, "big"))
+        digest.update(part)
+    return digest.hexdigest()
+
+class IdempotencyMiddleware:
+    """
+    Pure ASGI middleware, so the response can be stored as it is sent without
+    buffering it in front of the client.
+    """
+
+    def __init__(self, app, ttl=24 * 3600.0, wait=60.0, lock_timeout=300.0, poll=0.1, sweep_interval=60.0):
+        self.app = app
+        self.ttl = ttl
+        self.wait = wait
+        self.lock_timeout = lock_timeout
+        self.poll = poll
+        self.sweep_interval = sweep_interval
+        # set when a request this process is running finishes, so retries
+        # waiting here don't have to wait for their next poll
+        self._finished = {}
+        self._last_sweep = 0.0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST":
+            return await self.app(scope, receive, send)
+        headers = dict(scope["headers"])
+        key = headers.get(HEADER)
+        if key is None:
+            return await self.app(scope, receive, send)
+
+        key = key.decode("latin-1")
+        if not key or len(key) > MAX_KEY_LENGTH:
+            return await JSONResponse({"detail": "Invalid Idempotency-Key"}, status_code=400)(scope, receive, send)
+
+        # the whole body is needed for the fingerprint, and is then handed on
+        body, receive = await self.read_body(receive)
+        if body is None:
+            return
+        params = {
+            "client": client_id(headers.get(b"access_token", b"").decode("latin-1")),
+            "key": key,
+            "request_hash": request_hash(scope["method"], scope["path"], scope.get("query_string", b""),
+                                         headers.get(b"content-type", b"").decode("latin-1"), body),
+        }
+
+        await self.sweep()
+        await self.handle(params, scope, receive, send)
+
+    async def read_body(self, receive):
+        """Returns the request body and a receive that replays it, or None if the client left."""
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return None, receive
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                break
+        body = b"".join(chunks)
+        replayed = False
+
+        async def replay():
+            nonlocal replayed
+            if replayed:
+                return await receive()
+            replayed = True
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        return body, replay
+
+    async def handle(self, params, scope, receive, send):
+        deadline = time.monotonic() + self.wait
+        while True:
+            try:
+                claimed = await self.claim(params)
+                if not claimed:
+                    async with db.async_engine.begin() as connection:
+                        row = (await connection.execute(statements.get("idempotency.get"), params)).mappings().first()
+            except DBAPIError as error:
+                # without the table the request still runs, just not idempotently
+                print(f"Error returned: <<<{error}>>>")
+                return await self.app(scope, receive, send)
+
+            if claimed:
+                return await self.run(params, scope, receive, send)
+            # released or expired in between, so claim it again
+            if row is None:
+                continue
+            if row["request_hash"] != params["request_hash"]:
+                return await JSONResponse(
+                    {"detail": "Idempotency-Key was already used for a different request"},
+                    status_code=422)(scope, receive, send)
+            if row["status"] == "done":
+                return await self.replay(row, send)
+            if time.monotonic() >= deadline:
+                return await JSONResponse(
+                    {"detail": "A request with this Idempotency-Key is still in progress"},
+                    status_code=409)(scope, receive, send)
+
+            finished = self._finished.get((params["client"], params["key"]))
+            try:
+                await asyncio.wait_for(finished.wait() if finished else asyncio.sleep(self.poll), self.poll)
+            except asyncio.TimeoutError:
+                pass
+
+    async def claim(self, params):
+        async with db.async_engine.begin() as connection:
+            claimed = (await connection.execute(
+                statements.get("idempotency.claim"),
+                {**params, "ttl": self.ttl, "lock_timeout": self.lock_timeout})).first()
+        return claimed is not None
+
+    async def run(self, params, scope, receive, send):
+        """Runs the request holding the key, and stores its response for retries."""
+        finished = self._finished[params["client"], params["key"]] = asyncio.Event()
+        response = {"status": None, "headers": [], "body": []}
+
+        async def capture(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                response["headers"] = [[name.decode("latin-1"), value.decode("latin-1")] for name, value in message.get("headers", [])]
+            elif message["type"] == "http.response.body":
+                response["body"].append(message.get("body", b""))
+            await send(message)
+
+        stored = False
+        try:
+            await self.app(scope, receive, capture)
+            if response["status"] is not None and response["status"] < 500:
+                stored = await self.execute("idempotency.store", {
+                    **params,
+                    "response_status": response["status"],
+                    "response_headers": json.dumps(response["headers"]),
+                    "response_body": b"".join(response["body"]),
+                })
+        finally:
+            if not stored:
+                # a retry should run again rather than get an error replayed
+                await self.execute("idempotency.release", params)
+            finished.set()
+            self._finished.pop((params["client"], params["key"]), None)
+
+    async def execute(self, name, params):
+        # the response has gone out by now, so a failure here is only logged
+        try:
+            async with db.async_engine.begin() as connection:
+                await connection.execute(statements.get(name), params)
+            return True
+        except DBAPIError as error:
+            print(f"Error returned: <<<{error}>>>")
+            return False
+
+    async def replay(self, row, send):
+        headers = [(name.encode("latin-1"), value.encode("latin-1")) for name, value in row["response_headers"]]
+        headers.append((b"idempotent-replayed", b"true"))
+        await send({"type": "http.response.start", "status": row["response_status"], "headers": headers})
+        await send({"type": "http.response.body", "body": bytes(row["response_body"])})
+
+    async def sweep(self):
+        # expired keys are deleted now and then, a bounded batch at a time
+        now = time.monotonic()
+        if now - self._last_sweep < self.sweep_interval:
+            return
+        self._last_sweep = now
+        await self.execute("idempotency.sweep", {})
@@ -0,0 +1,369 @@
+from fastapi import APIRouter, Depends, File, UploadFile
+from src.api import auth
+from src.api.access import guarded, check_access
+from src.api.statements import registry as statements
+from src.api.cache import cache
+from src.api.purchases import MAX_PRICE
+from src.api.dates import parse_date
+from src import database as db
+from sqlalchemy.exc import DBAPIError
+from fastapi import HTTPException
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from typing import Optional
+import asyncpg
+import codecs
+import collections
+import csv
+import hashlib
+import html
+import re
+import time
+
+router = APIRouter(
+    prefix="/user/{user_id}/imports",
+    tags=["imports"],
+    dependencies=[Depends(auth.get_api_key)],
+)
+
+# Bank statement imports. The upload is read and parsed a chunk at a time,
+# rows are loaded into a temporary staging table with COPY every COPY_BATCH
+# rows, and one statement then merges the staging table into transactions
+# (and a purchase per transaction, so imports count towards spending).
+# Rows whose external_id the user already has are skipped as duplicates.
+
+FORMATS = ["csv", "ofx"]
+EXTENSIONS = {".csv": "csv", ".ofx": "ofx", ".qfx": "ofx"}
+
+# which sign an amount column uses for money going out
+SIGNS = ["negative", "positive"]
+
+READ_SIZE = 64 * 1024
+COPY_BATCH = 5000
+MAX_IMPORT_ROWS = 100000
+# rejected rows are all counted, the first few are also explained
+MAX_ERRORS = 20
+
+StatementRow = collections.namedtuple("StatementRow", ["external_id", "merchant", "description", "date", "price"])
+
+STAGING_COLUMNS = ["position", *StatementRow._fields]
+
+class Rejected(Exception):
+    pass
+
+# the user is checked before the file is read, rather than only by the merge
+statements.register("imports.user", guarded("SELECT 1 AS found"))
+
+statements.register("imports.staging", """
+    CREATE TEMPORARY TABLE import_staging (
+        position integer not null,
+        external_id text not null,
+        merchant text not null,
+        description text not null,
+        date date not null,
+        price integer not null
+    ) ON COMMIT DROP
+    """)
+
+# rows repeated within the file count once, in the order they came. the
+# purchases insert sees the new transactions: purchases_set_user_id is
+# volatile, so it sees rows inserted earlier in the same statement
+statements.register("imports.merge", guarded(
+    """
+    SELECT (SELECT count(*) FROM inserted) AS inserted, (SELECT count(*) FROM purchased) AS purchases
+    """, ctes=[
+        """
+        staged AS (
+            SELECT DISTINCT ON (external_id) *
+            FROM import_staging
+            ORDER BY external_id, position
+        )
+        """,
+        """
+        inserted AS (
+            INSERT INTO transactions (user_id, merchant, description, date, external_id)
+            SELECT guard_user_id, merchant, description, date, external_id
+            FROM staged, guard
+            WHERE guard_user_id IS NOT NULL
+            ORDER BY position
+            ON CONFLICT (user_id, external_id) WHERE external_id IS NOT NULL DO NOTHING
+            RETURNING id, external_id
+        )
+        """,
+        """
+        purchased AS (
+            INSERT INTO purchases (transaction_id, item, price, quantity, category)
+            SELECT inserted.id, COALESCE(NULLIF(staged.description, ''), staged.merchant), staged.price, 1, 'Other'
+            FROM inserted
+            JOIN staged ON staged.external_id = inserted.external_id
+            RETURNING id
+        )
+        """,
+    ]
+))
+
+async def read_lines(file, read_size=READ_SIZE):
+    """
+    Yields the lines of an uploaded file without reading it all at once. A
+    byte order mark is dropped and undecodable bytes are replaced.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    pending = ""
+    while True:
+        chunk = await file.read(read_size)
+        pending += decoder.decode(chunk, final=not chunk)
+        lines = pending.split("\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line.rstrip("\r")
+        if not chunk:
+            break
+    if pending:
+        yield pending.rstrip("\r")
+
+def parse_amount(text):
+    # 1,234.50, $12.00, -3.10, and (3.10) as accountants write -3.10
+    text = text.strip().replace(",", "").replace("$", "")
+    negative = text.startswith("(") and text.endswith(")")
+    if negative:
+        text = text[1:-1]
+    try:
+        amount = Decimal(text)
+    except InvalidOperation:
+        raise Rejected("Invalid amount")
+    if not amount.is_finite():
+        raise Rejected("Invalid amount")
+    return -amount if negative else amount
+
+def to_price(amount, sign):
+    # prices are positive cents, only money going out is spending
+    spent = -amount if sign == "negative" else amount
+    if spent <= 0:
+        raise Rejected("Not a debit")
+    price = int((spent * 100).quantize(Decimal(1)))
+    if price > MAX_PRICE:
+        raise Rejected("Amount too large")
+    return price
+
+STATEMENT_DATE_FORMATS = ["%m/%d/%Y", "%Y%m%d"]
+
+def parse_statement_date(text):
+    text = text.strip()
+    parsed = parse_date(text)
+    if parsed is not None:
+        return parsed
+    for date_format in STATEMENT_DATE_FORMATS:
+        try:
+            return datetime.strptime(text, date_format).date()
+        except ValueError:
+            pass
+    raise Rejected("Invalid date")
+
+def derive_external_id(seen, date, merchant, description, price):
+    """
+    An id for a row the bank didn't give one. Identical rows in one file are
+    told apart by how many came before them, so they aren't merged into one.
+    """
+    key = f"{date}|{merchant}|{description}|{price}"
+    seen[key] += 1
+    return "row:" + hashlib.sha1(f"{key}|{seen[key]}".encode()).hexdigest()
+
+# accepted header names for each field, first match wins. description is
+# only used for the merchant when nothing more specific is there
+CSV_COLUMNS = {
+    "date": ["date", "posted date", "posting date", "transaction date"],
+    "merchant": ["merchant", "payee", "name", "description"],
+    "description": ["memo", "notes", "description"],
+    "amount": ["amount"],
+    "debit": ["debit", "withdrawal"],
+    "credit": ["credit", "deposit"],
+    "external_id": ["id", "transaction id", "fitid", "reference"],
+}
+
+def csv_columns(header):
+    names = [name.strip().lower() for name in header]
+    columns = {}
+    for field, aliases in CSV_COLUMNS.items():
+        for alias in aliases:
+            if alias in names and names.index(alias) not in columns.values():
+                columns[field] = names.index(alias)
+                break
+
+    if "date" not in columns:
+        raise HTTPException(status_code=400, detail="Missing date column")
+    if "merchant" not in columns:
+        raise HTTPException(status_code=400, detail="Missing merchant column")
+    if "amount" not in columns and "debit" not in columns:
+        raise HTTPException(status_code=400, detail="Missing amount column")
+    return columns
+
+async def csv_records(lines):
+    """
+    Yields (line number, fields) for each CSV record, where quoted fields can
+    run over several lines. Blank lines are skipped.
+    """
+    record = None
+    start = line_number = 0
+    async for line in lines:
+        line_number += 1
+        if record is None:
+            record, start = line, line_number
+        else:
+            record += "\n" + line
+        # an odd number of quotes means a quoted field goes on
+        if record.count('"') % 2:
+            continue
+        if record.strip():
+            yield start, next(csv.reader([record]))
+        record = None
+    if record is not None and record.strip():
+        yield start, next(csv.reader([record]))
+
+def csv_row(fields, columns, sign, seen):
+    def field(name):
+        index = columns.get(name)
+        return fields[index].strip() if index is not None and index < len(fields) else ""
+
+    date = parse_statement_date(field("date"))
+    merchant = field("merchant")
+    if not merchant:
+        raise Rejected("Missing merchant")
+    description = field("description") if columns.get("description") != columns["merchant"] else ""
+
+    if "amount" in columns:
+        price = to_price(parse_amount(field("amount")), sign)
+    else:
+        # separate debit and credit columns, both positive
+        price = to_price(parse_amount(field("credit") or "0") - parse_amount(field("debit") or "0"), "negative")
+
+    external_id = field("external_id") or derive_external_id(seen, date, merchant, description, price)
+    return StatementRow(external_id, merchant, description, date, price)
+
+async def parse_csv(lines, sign="negative"):
+    """
+    Yields (line number, row, None) for each usable row of a CSV statement and
+    (line number, None, reason) for each rejected one. The first record is
+    the header.
+    """
+    seen = collections.Counter()
+    columns = None
+    async for line_number, fields in csv_records(lines):
+        if columns is None:
+            columns = csv_columns(fields)
+            continue
+        try:
+            yield line_number, csv_row(fields, columns, sign, seen), None
+        except Rejected as error:
+            yield line_number, None, str(error)
+
+# OFX 1.x is SGML, where elements holding a value usually aren't closed
+OFX_TAG = re.compile(r"<(/?)([A-Za-z0-9.]+)>([^<]*)")
+
+def ofx_row(block, seen):
+    date = parse_statement_date(block.get("DTPOSTED", "")[:8])
+    merchant = block.get("NAME") or block.get("PAYEE") or block.get("MEMO")
+    if not merchant:
+        raise Rejected("Missing merchant")
+    description = block.get("MEMO", "") if merchant != block.get("MEMO") else ""
+    price = to_price(parse_amount(block.get("TRNAMT", "")), "negative")
+    external_id = block.get("FITID") or derive_external_id(seen, date, merchant, description, price)
+    return StatementRow(external_id, merchant, description, date, price)
+
+async def parse_ofx(lines):
+    """
+    Yields (line number, row, None) for each usable STMTTRN of an OFX
+    statement and (line number, None, reason) for each rejected one.
+    """
+    seen = collections.Counter()
+    block = None
+    start = line_number = 0
+    async for line in lines:
+        line_number += 1
+        for closing, tag, value in OFX_TAG.findall(line):
+            tag = tag.upper()
+            if tag == "STMTTRN" and not closing:
+                block, start = {}, line_number
+            elif tag == "STMTTRN":
+                if block is not None:
+                    try:
+                        yield start, ofx_row(block, seen), None
+                    except Rejected as error:
+                        yield start, None, str(error)
+                block = None
+            elif block is not None and not closing:
+                block[tag] = html.unescape(value.strip())
+
+def detect_format(filename):
+    for extension, format in EXTENSIONS.items():
+        if (filename or "").lower().endswith(extension):
+            return format
+    return None
+
+# imports a bank statement as transactions
+@router.post("/", tags=["imports"])
+async def import_statement(user_id: int, file: UploadFile = File(...), format: Optional[str] = None, sign: str = "negative"):
+    """
+    format is csv or ofx, by default from the file name. sign says whether
+    spending is negative (the default) or positive in a CSV amount column.
+    Only spending is imported, other rows are rejected. Returns how many
+    transactions were inserted, how many were already there and how many
+    rows couldn't be used, with the first few reasons.
+    """
+    start_time = time.time()
+    format = format or detect_format(file.filename)
+    if format not in FORMATS:
+        raise HTTPException(status_code=400, detail="Invalid format")
+    if sign not in SIGNS:
+        raise HTTPException(status_code=400, detail="Invalid sign")
+
+    lines = read_lines(file)
+    rows = parse_csv(lines, sign) if format == "csv" else parse_ofx(lines)
+    staged = rejected = inserted = duplicates = 0
+    errors = []
+
+    try:
+        async with db.async_engine.begin() as connection:
+            check_access((await connection.execute(
+                statements.get("imports.user"),
+                [{"user_id": user_id}])).mappings().all(), user_id)
+            await connection.execute(statements.get("imports.staging"))
+            # COPY isn't available through SQLAlchemy, but runs on the same
+            # connection and so in the same transaction
+            driver_connection = (await connection.get_raw_connection()).driver_connection
+
+            batch = []
+            async for line_number, row, error in rows:
+                if error is not None:
+                    rejected += 1
+                    if len(errors) < MAX_ERRORS:
+                        errors.append(f"line {line_number}: {error}")
+                    continue
+
+                batch.append((staged, *row))
+                staged += 1
+                if staged > MAX_IMPORT_ROWS:
+                    raise HTTPException(status_code=400, detail=f"Too many rows, at most {MAX_IMPORT_ROWS} allowed")
+                if len(batch) >= COPY_BATCH:
+                    await driver_connection.copy_records_to_table("import_staging", records=batch, columns=STAGING_COLUMNS)
+                    batch = []
+            if batch:
+                await driver_connection.copy_records_to_table("import_staging", records=batch, columns=STAGING_COLUMNS)
+
+            # one statement merges everything staged, if the user still exists
+            result = (await connection.execute(
+                statements.get("imports.merge"),
+                [{"user_id": user_id}])).mappings().all()
+            inserted = check_access(result, user_id)[0]["inserted"]
+            duplicates = staged - inserted
+    # COPY goes around SQLAlchemy, so its errors are asyncpg's own
+    except (DBAPIError, asyncpg.PostgresError) as error:
+        print(f"Error returned: <<<{error}>>>")
+        raise HTTPException(status_code=500, detail="Database error")
+
+    # the user's cached aggregates are out of date now
+    if inserted:
+        await cache.invalidate(user_id)
+    end_time = time.time()
+    print(f"time: {(end_time - start_time) * 1000}")
+
+    return {"inserted": inserted, "duplicates": duplicates, "rejected": rejected, "errors": errors}
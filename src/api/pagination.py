@@ -0,0 +1,88 @@
+import base64
+import binascii
+import json
+from fastapi import HTTPException
+
+# Keyset (cursor) pagination for the listing endpoints. Instead of skipping
+# OFFSET rows, each page starts right after the (sort column, id) of the last
+# row of the previous one, which an index on (..., sort column, id) can seek
+# to directly. The cursor handed to clients is an opaque token holding that
+# position along with the sort it belongs to.
+
+PAGING = ["offset", "first", "after"]
+
+def paging_mode(after):
+    # no after param keeps the old page/page_size behaviour, an empty one starts a cursor walk
+    if after is None:
+        return "offset"
+    return "first" if after == "" else "after"
+
+def encode_cursor(sort_by, sort_order, sort_key, row_id):
+    payload = json.dumps([sort_by, sort_order, sort_key, row_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor, sort_by, sort_order):
+    """
+    Returns the (sort_key, row_id) position stored in cursor. Raises a 400 if
+    the token is malformed or was issued for a different sort.
+    """
+    try:
+        payload = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        cursor_sort_by, cursor_sort_order, sort_key, row_id = json.loads(payload)
+    except (binascii.Error, UnicodeDecodeError, ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    if cursor_sort_by != sort_by or cursor_sort_order != sort_order:
+        raise HTTPException(status_code=400, detail="Cursor does not match sort_by and sort_order")
+    if not isinstance(sort_key, str) or not isinstance(row_id, int):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    return sort_key, row_id
+
+def order_sql(expression, id_column, sort_order, paging):
+    # cursor pages need a unique order, so ties on the sort column fall back to id
+    if paging == "offset":
+        return f"{expression} {sort_order}"
+    return f"{expression} {sort_order}, {id_column} {sort_order}"
+
+def keyset_sql(expression, id_column, sort_order, sort_type, paging):
+    """
+    Returns the extra SELECT column and WHERE condition for paging. The sort
+    key travels through the cursor as Postgres' own text rendering, cast back
+    to sort_type, so dates and numbers round-trip exactly.
+    """
+    if paging == "offset":
+        return "", ""
+
+    column = f", ({expression})::text AS sort_key"
+    if paging == "first":
+        return column, ""
+
+    comparison = ">" if sort_order == "asc" else "<"
+    return column, f"AND ({expression}, {id_column}) {comparison} (CAST(CAST(:after_key AS text) AS {sort_type}), :after_id)"
+
+def limit_sql(paging):
+    # cursor pages fetch one extra row to tell whether there is a next page
+    return "LIMIT :page_size OFFSET :offset" if paging == "offset" else "LIMIT :page_size + 1"
+
+def keyset_params(after, sort_by, sort_order):
+    if not after:
+        return {"after_key": None, "after_id": None}
+    sort_key, row_id = decode_cursor(after, sort_by, sort_order)
+    return {"after_key": sort_key, "after_id": row_id}
+
+def keyset_page(rows, page_size, sort_by, sort_order):
+    """
+    Turns the rows of a cursor query into {"items": [...], "next_cursor": ...},
+    where next_cursor is None on the last page.
+    """
+    items = [dict(row) for row in rows[:page_size]]
+    next_cursor = None
+    if len(rows) > page_size and items:
+        last = items[-1]
+        next_cursor = encode_cursor(sort_by, sort_order, last["sort_key"], last["id"])
+
+    for item in items:
+        del item["sort_key"]
+
+    return {"items": items, "next_cursor": next_cursor}
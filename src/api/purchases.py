@@ -1,12 +1,15 @@
 from fastapi import APIRouter, Depends
 from pydantic import BaseModel
 from src.api import auth
-import sqlalchemy
+from src.api.access import guarded, check_access
+from src.api.statements import registry as statements
+from src.api.cache import cache, MISSING
 from src import database as db
 from sqlalchemy.exc import DBAPIError
-from datetime import datetime
+from src.api.dates import is_valid_date
+from src.api.pagination import PAGING, paging_mode, keyset_sql, order_sql, limit_sql, keyset_params, keyset_page
 from fastapi import HTTPException
-import sys
+from typing import List, Optional
 import time
 
 router = APIRouter(
@@ -23,32 +26,78 @@ class NewPurchase(BaseModel):
     return_date: str
     quantity: int
 
-def is_valid_date(date_string, format='%Y-%m-%d'):
-    try:
-        datetime.strptime(date_string, format)
-        year, month, day = date_string.split('-')
-        if len(year) != 4 or len(month) != 2 or len(day) != 2:
-            return False
-        return True
-    except ValueError:
-        return False
-
-check_user_query = "SELECT id FROM users WHERE id = :user_id"
-check_transaction_query = "SELECT user_id FROM transactions WHERE id = :transaction_id"
-check_purchase_query = "SELECT transaction_id FROM purchases WHERE id = :purchase_id"
+# purchases.price is an integer column, asyncpg won't bind anything larger
+MAX_PRICE = 2147483647
+
+SORT_BY = ["date", "price", "category", "warranty_date", "return_date", "quantity"]
+SORT_ORDERS = ["asc", "desc"]
+
+# sort expressions and their Postgres types for cursor positions. nullable
+# columns are coalesced so every row has a comparable position
+SORT_EXPRESSIONS = {
+    "date": ("COALESCE(transactions.date, '-infinity')", "date"),
+    "price": ("price", "integer"),
+    "category": ("category", "text"),
+    "warranty_date": ("COALESCE(warranty_date, '')", "text"),
+    "return_date": ("COALESCE(return_date, '')", "text"),
+    "quantity": ("quantity", "integer"),
+}
+
+def list_purchases_sql(sort_by, sort_order, single, paging):
+    # single narrows the listing to one purchase and checks it belongs to the transaction
+    expression, sort_type = SORT_EXPRESSIONS[sort_by] if paging != "offset" else (sort_by, None)
+    sort_key, after = keyset_sql(expression, "purchases.id", sort_order, sort_type, paging)
+    return guarded(
+        f"""
+        SELECT purchases.id, item, price, category, warranty_date, return_date, quantity{sort_key}
+        FROM purchases
+        JOIN transactions ON purchases.transaction_id = transactions.id
+        WHERE transaction_id = :transaction_id AND purchases.user_id = :user_id {"AND purchases.id = :purchase_id" if single else ""}
+        AND item ILIKE :item AND category ILIKE :category AND (price BETWEEN :price_start AND :price_end)
+        {after}
+        ORDER BY {order_sql(expression, "purchases.id", sort_order, paging)}
+        {limit_sql(paging)}
+        """, scope="purchase" if single else "transaction"
+    )
+
+statements.register("purchases.list", list_purchases_sql, sort_by=SORT_BY, sort_order=SORT_ORDERS, single=[False, True], paging=PAGING)
+
+def search_purchases_sql(single):
+    # fuzzy item search, best matches first. purchases_item_trgm_idx serves the
+    # <% match, and the planner combines it with purchases_transaction_id_idx
+    return guarded(
+        f"""
+        SELECT purchases.id, item, price, category, warranty_date, return_date, quantity
+        FROM purchases
+        JOIN transactions ON purchases.transaction_id = transactions.id
+        WHERE transaction_id = :transaction_id AND purchases.user_id = :user_id {"AND purchases.id = :purchase_id" if single else ""}
+        AND item ILIKE :item AND category ILIKE :category AND (price BETWEEN :price_start AND :price_end)
+        AND :search <% item
+        ORDER BY word_similarity(:search, item) DESC, similarity(:search, item) DESC, purchases.id
+        LIMIT :page_size OFFSET :offset
+        """, scope="purchase" if single else "transaction"
+    )
+
+statements.register("purchases.search", search_purchases_sql, single=[False, True])
 
 # gets purchases for a user (all or specific purchase)
 @router.get("/", tags=["purchase"])
-def get_purchases(user_id: int, transaction_id: int, purchase_id: int = -1, page: int = 1, page_size: int = 10, sort_by: str = "date", sort_order: str = "asc", item: str = "%", category: str = "%", price_start: int = 0, price_end: int = sys.maxsize):
+async def get_purchases(user_id: int, transaction_id: int, purchase_id: int = -1, page: int = 1, page_size: int = 10, sort_by: str = "date", sort_order: str = "asc", item: str = "%", category: str = "%", price_start: int = 0, price_end: int = MAX_PRICE, after: Optional[str] = None, search: Optional[str] = None):
     """ """
     start_time = time.time()
     ans = []
 
     # check if sort_by and sort_order is valid
-    if sort_by not in ["date", "price", "category", "warranty_date", "return_date", "quantity"]:
+    if sort_by not in SORT_BY:
         raise HTTPException(status_code=400, detail="Invalid sort_by")
-    if sort_order not in ["asc", "desc"]:
+    if sort_order not in SORT_ORDERS:
         raise HTTPException(status_code=400, detail="Invalid sort_order")
+
+    # search results are ranked by relevance, so they page by offset only
+    if search is not None and not search.strip():
+        raise HTTPException(status_code=400, detail="Invalid search")
+    if search is not None and after is not None:
+        raise HTTPException(status_code=400, detail="after can't be combined with search")
     
     # check if price_start and price_end is valid
     if price_start < 0:
@@ -57,67 +106,28 @@ def get_purchases(user_id: int, transaction_id: int, purchase_id: int = -1, page
         raise HTTPException(status_code=400, detail="Invalid price_end")
     
     offset = (page - 1) * page_size
+    price_end = min(price_end, MAX_PRICE)
     item = f"%{item}%"
     category = f"%{category}%"
+    paging = paging_mode(after)
+    cursor = keyset_params(after, sort_by, sort_order)
+
+    key = ("purchases.get", transaction_id, purchase_id, page, page_size, sort_by, sort_order, item, category, price_start, price_end, after, search)
+    cached, token = await cache.get(user_id, key)
+    if cached is not MISSING:
+        return cached
 
     try: 
-        with db.engine.begin() as connection:
-            # check if user exists
-            result = connection.execute(
-                sqlalchemy.text(check_user_query), 
-                [{"user_id": user_id}]).fetchone()
-            if result is None:
-                raise HTTPException(status_code=404, detail="User not found")
-            
-            # check if transaction exists and belongs to user
-            result = connection.execute(
-                sqlalchemy.text(check_transaction_query),
-                [{"transaction_id": transaction_id, "user_id": user_id}]).fetchone()
-            if result is None:
-                raise HTTPException(status_code=404, detail="Transaction not found")
-            if result.user_id != user_id:
-                raise HTTPException(status_code=400, detail="Transaction does not belong to user")
-
-            if purchase_id == -1:
-                # get all purchases for transaction
-                ans = connection.execute(
-                    sqlalchemy.text(
-                        f"""
-                        SELECT purchases.id, item, price, category, warranty_date, return_date, quantity
-                        FROM purchases
-                        JOIN transactions ON purchases.transaction_id = transactions.id
-                        WHERE transaction_id = :transaction_id AND user_id = :user_id 
-                        AND item ILIKE :item AND category ILIKE :category AND (price BETWEEN :price_start AND :price_end)
-                        ORDER BY {sort_by} {sort_order}
-                        LIMIT :page_size OFFSET :offset
-                        """
-                    ), [{"transaction_id": transaction_id, "user_id": user_id, "item": item, "category": category, "price_start": price_start, "price_end": price_end, "page_size": page_size, "offset": offset}]).mappings().all()
-            else:
-                # check if purchase exists and belongs to transaction
-                result = connection.execute(
-                    sqlalchemy.text(
-                        """
-                        SELECT transaction_id FROM purchases WHERE id = :purchase_id
-                        """
-                    ), [{"purchase_id": purchase_id}]).fetchone()
-                if result is None:
-                    raise HTTPException(status_code=404, detail="Purchase not found")
-                if result.transaction_id != transaction_id:
-                    raise HTTPException(status_code=400, detail="Purchase does not belong to transaction")
-
-                # get specific purchase
-                ans = connection.execute(
-                    sqlalchemy.text(
-                        f"""
-                        SELECT purchases.id, item, price, category, warranty_date, return_date, quantity
-                        FROM purchases
-                        JOIN transactions ON purchases.transaction_id = transactions.id
-                        WHERE transaction_id = :transaction_id AND user_id = :user_id AND purchases.id = :purchase_id
-                        AND item ILIKE :item AND category ILIKE :category AND (price BETWEEN :price_start AND :price_end)
-                        ORDER BY {sort_by} {sort_order}
-                        LIMIT :page_size OFFSET :offset
-                        """
-                    ), [{"transaction_id": transaction_id, "purchase_id": purchase_id, "user_id": user_id, "item": item, "category": category, "price_start": price_start, "price_end": price_end, "page_size": page_size, "offset": offset}]).mappings().all()
+        async with db.async_engine.begin() as connection:
+            # get all purchases for transaction, or a specific one, checking they belong to user
+            rows = (await connection.execute(
+                statements.get("purchases.search", single=purchase_id != -1) if search is not None else
+                statements.get("purchases.list", sort_by=sort_by, sort_order=sort_order, single=purchase_id != -1, paging=paging),
+                [{"transaction_id": transaction_id, "purchase_id": purchase_id, "user_id": user_id, "item": item, "category": category, "price_start": price_start, "price_end": price_end, "page_size": page_size, "offset": offset, "search": search, **cursor}])).mappings().all()
+            ans = check_access(rows, user_id, transaction_id)
+            if paging != "offset":
+                ans = keyset_page(ans, page_size, sort_by, sort_order)
+            await cache.set(user_id, key, ans, token)
     except DBAPIError as error:
         print(f"Error returned: <<<{error}>>>")
 
@@ -127,127 +137,186 @@ def get_purchases(user_id: int, transaction_id: int, purchase_id: int = -1, page
     print(f"time: {(end_time - start_time) * 1000}")
 
     # ex: [{"item": "TV", "price": 500.00, "category": "Electronics", "warranty_date": "2022-05-01", "return_date": "2021-06-01"}, ...]
+    # or, with after, {"items": [...], "next_cursor": cursor or None}
     return ans
 
 
 
-# creates a new purchase for a user
-@router.post("/", tags=["purchase"])
-def create_purchase(user_id: int, transaction_id: int, purchase: NewPurchase):
-    """ """
-    start_time = time.time()
-    item = purchase.item
-    price = float(purchase.price)
-    quantity = purchase.quantity
-    warranty_date = purchase.warranty_date
-    return_date = purchase.return_date
-    category = purchase.category
+statements.register("purchases.create", guarded(
+    """
+    INSERT INTO purchases (transaction_id, item, price, quantity, warranty_date, return_date, category)
+    SELECT :transaction_id, :item, :price, :quantity, :warranty_date, :return_date, :category
+    FROM guard
+    WHERE guard_owner_id = :user_id
+    RETURNING id
+    """, scope="transaction"
+))
 
+CATEGORIES = ['Groceries', 'Clothing and Accessories', 'Electronics', 'Home and Garden',
+              'Health and Beauty', 'Entertainment', 'Travel', 'Automotive', 'Services',
+              'Gifts and Special Occasions', 'Education', 'Fitness and Sports', 'Pets',
+              'Office Supplies', 'Financial Services', 'Other']
+
+def validate_purchase(purchase):
     # Validate inputs
-    if not is_valid_date(warranty_date) and warranty_date != "":
+    if not is_valid_date(purchase.warranty_date) and purchase.warranty_date != "":
         raise HTTPException(status_code=400, detail="Invalid warranty date format")
-    if not is_valid_date(return_date) and return_date != "":
+    if not is_valid_date(purchase.return_date) and purchase.return_date != "":
         raise HTTPException(status_code=400, detail="Invalid return date format")
-    if price <= 0:
+    if purchase.price <= 0 or purchase.price > MAX_PRICE:
         raise HTTPException(status_code=400, detail="Invalid price format")
-    if quantity <= 1:
+    if purchase.quantity < 1:
         raise HTTPException(status_code=400, detail="Invalid quantity format")
-    if category not in ['Groceries', 'Clothing and Accessories', 'Electronics', 'Home and Garden', 
-                        'Health and Beauty', 'Entertainment', 'Travel', 'Automotive', 'Services', 
-                        'Gifts and Special Occasions', 'Education', 'Fitness and Sports', 'Pets', 
-                        'Office Supplies', 'Financial Services', 'Other']:
+    if purchase.category not in CATEGORIES:
         raise HTTPException(status_code=400, detail="Invalid category")
 
+# creates a new purchase for a user
+@router.post("/", tags=["purchase"])
+async def create_purchase(user_id: int, transaction_id: int, purchase: NewPurchase):
+    """ """
+    start_time = time.time()
+    validate_purchase(purchase)
+
     try:
-        with db.engine.begin() as connection:
-            # check if user exists
-            result = connection.execute(
-                sqlalchemy.text(check_user_query), 
-                [{"user_id": user_id}]).fetchone()
-            if result is None:
-                raise HTTPException(status_code=404, detail="User not found")
-            
-            # check if transaction exists and belongs to user
-            result = connection.execute(
-                sqlalchemy.text(check_transaction_query),
-                [{"transaction_id": transaction_id, "user_id": user_id}]
-            ).fetchone()
-            if result is None:
-                raise HTTPException(status_code=404, detail="Transaction not found")
-            if result.user_id != user_id:
-                raise HTTPException(status_code=400, detail="Transaction does not belong to user")
-
-            purchase_id = connection.execute(
-                sqlalchemy.text(
-                    """
-                    INSERT INTO purchases (transaction_id, item, price, quantity, warranty_date, return_date, category)
-                    VALUES (:transaction_id, :item, :price, :quantity, :warranty_date, :return_date, :category)
-                    RETURNING id
-                    """
-                ), [{"transaction_id": transaction_id, "item": item, "price": price, "quantity": quantity, "warranty_date": warranty_date, "return_date": return_date, "category": category}]).scalar_one()
+        async with db.async_engine.begin() as connection:
+            # add purchase, only if the transaction exists and belongs to user
+            rows = (await connection.execute(
+                statements.get("purchases.create"),
+                [{"user_id": user_id, "transaction_id": transaction_id, "item": purchase.item, "price": purchase.price, "quantity": purchase.quantity, "warranty_date": purchase.warranty_date, "return_date": purchase.return_date, "category": purchase.category}])).mappings().all()
+            purchase_id = check_access(rows, user_id, transaction_id)[0]["id"]
     except DBAPIError as error:
         print(f"Error returned: <<<{error}>>>")
+        raise HTTPException(status_code=500, detail="Database error")
 
+    # the user's cached aggregates are out of date now
+    await cache.invalidate(user_id)
     end_time = time.time()
     print(f"time: {(end_time - start_time) * 1000}")
 
     return {"purchase_id": purchase_id}
 
+MAX_BULK_PURCHASES = 500
+
+# one row per purchase from the column arrays, numbered in input order. ids are
+# drawn up front so they can be matched back to positions, and only once the
+# guard has passed
+statements.register("purchases.create_bulk", guarded(
+    """
+    SELECT inserted.id, items.position
+    FROM inserted
+    JOIN items ON items.id = inserted.id
+    """, scope="transaction", ctes=[
+        """
+        items AS MATERIALIZED (
+            SELECT nextval(pg_get_serial_sequence('purchases', 'id')) AS id, u.*
+            FROM guard, unnest(
+                CAST(:items AS text[]), CAST(:prices AS integer[]), CAST(:quantities AS integer[]),
+                CAST(:warranty_dates AS text[]), CAST(:return_dates AS text[]), CAST(:categories AS text[])
+            ) WITH ORDINALITY AS u(item, price, quantity, warranty_date, return_date, category, position)
+            WHERE guard_owner_id = :user_id
+        )
+        """,
+        """
+        inserted AS (
+            INSERT INTO purchases (id, transaction_id, item, price, quantity, warranty_date, return_date, category)
+            SELECT id, :transaction_id, item, price, quantity, warranty_date, return_date, category
+            FROM items
+            RETURNING id
+        )
+        """,
+    ]
+))
+
+# creates several purchases in one transaction, all or none
+@router.post("/bulk", tags=["purchase"])
+async def create_purchases_bulk(user_id: int, transaction_id: int, purchases: List[NewPurchase]):
+    """
+    Validates every purchase before inserting any, then inserts them with a
+    single statement. Returns the new ids in the order the purchases were given.
+    """
+    start_time = time.time()
+    if not purchases:
+        raise HTTPException(status_code=400, detail="No purchases")
+    if len(purchases) > MAX_BULK_PURCHASES:
+        raise HTTPException(status_code=400, detail=f"Too many purchases, at most {MAX_BULK_PURCHASES} allowed")
+
+    for index, purchase in enumerate(purchases):
+        try:
+            validate_purchase(purchase)
+        except HTTPException as error:
+            raise HTTPException(status_code=error.status_code, detail=f"{error.detail} (purchase {index})")
+
+    purchase_ids = []
+    try:
+        async with db.async_engine.begin() as connection:
+            # add every purchase, only if the transaction exists and belongs to user
+            rows = (await connection.execute(
+                statements.get("purchases.create_bulk"),
+                [{"user_id": user_id, "transaction_id": transaction_id,
+                  "items": [purchase.item for purchase in purchases],
+                  "prices": [purchase.price for purchase in purchases],
+                  "quantities": [purchase.quantity for purchase in purchases],
+                  "warranty_dates": [purchase.warranty_date for purchase in purchases],
+                  "return_dates": [purchase.return_date for purchase in purchases],
+                  "categories": [purchase.category for purchase in purchases]}])).mappings().all()
+            rows = check_access(rows, user_id, transaction_id)
+            purchase_ids = [row["id"] for row in sorted(rows, key=lambda row: row["position"])]
+    except DBAPIError as error:
+        print(f"Error returned: <<<{error}>>>")
+        raise HTTPException(status_code=500, detail="Database error")
+
+    # the user's cached aggregates are out of date now
+    await cache.invalidate(user_id)
+    end_time = time.time()
+    print(f"time: {(end_time - start_time) * 1000}")
+
+    return {"purchase_ids": purchase_ids}
+
 
+statements.register("purchases.delete", guarded(
+    """
+    DELETE FROM purchases
+    USING guard
+    WHERE id = :purchase_id AND transaction_id = :transaction_id AND guard_owner_id = :user_id
+    RETURNING id
+    """, scope="purchase"
+))
 
 # deletes a specific purchase for a user
 @router.delete("/{purchase_id}", tags=["purchase"])
-def delete_purchase(user_id: int, transaction_id: int, purchase_id: int):
+async def delete_purchase(user_id: int, transaction_id: int, purchase_id: int):
     """ """
     start_time = time.time()
     try:
-        with db.engine.begin() as connection:
-            # check if user exists
-            result = connection.execute(
-                sqlalchemy.text(check_user_query), 
-                [{"user_id": user_id}]).fetchone()
-            if result is None:
-                raise HTTPException(status_code=404, detail="User not found")
-            
-            # check if transaction exists and belongs to user
-            result = connection.execute(
-                sqlalchemy.text(check_transaction_query),
-                [{"transaction_id": transaction_id, "user_id": user_id}]).fetchone()
-            if result is None:
-                raise HTTPException(status_code=404, detail="Transaction not found")
-            if result.user_id != user_id:
-                raise HTTPException(status_code=400, detail="Transaction does not belong to user")
-            
-            # check if purchase exists and belongs to transaction
-            result = connection.execute(
-                sqlalchemy.text(
-                    """
-                    SELECT transaction_id FROM purchases WHERE id = :purchase_id
-                    """
-                ), [{"purchase_id": purchase_id}]).fetchone()
-            if result is None:
-                raise HTTPException(status_code=404, detail="Purchase not found")
-            if result.transaction_id != transaction_id:
-                raise HTTPException(status_code=400, detail="Purchase does not belong to transaction")
-
-            # delete purchase
-            connection.execute(
-                sqlalchemy.text(
-                    """
-                    DELETE FROM purchases
-                    WHERE id = :purchase_id
-                    """
-                ), [{"purchase_id": purchase_id}])
+        async with db.async_engine.begin() as connection:
+            # delete purchase, checking it belongs to the user's transaction
+            rows = (await connection.execute(
+                statements.get("purchases.delete"),
+                [{"user_id": user_id, "transaction_id": transaction_id, "purchase_id": purchase_id}])).mappings().all()
+            check_access(rows, user_id, transaction_id)
     except DBAPIError as error:
         print(f"Error returned: <<<{error}>>>")
+        raise HTTPException(status_code=500, detail="Database error")
+    # the user's cached aggregates are out of date now
+    await cache.invalidate(user_id)
     end_time = time.time()
     print(f"time: {(end_time - start_time) * 1000}")
 
     return "OK"
 
+statements.register("purchases.update", guarded(
+    """
+    UPDATE purchases
+    SET item = :item, price = :price, category = :category, warranty_date = :warranty_date, return_date = :return_date, quantity = :quantity
+    FROM guard
+    WHERE id = :purchase_id AND transaction_id = :transaction_id AND guard_owner_id = :user_id
+    RETURNING id
+    """, scope="purchase"
+))
+
 # updates a specific purchase for a user
 @router.put("/{purchase_id}", tags=["purchase"])
-def update_purchase(user_id: int, transaction_id: int, purchase_id: int, purchase: NewPurchase):
+async def update_purchase(user_id: int, transaction_id: int, purchase_id: int, purchase: NewPurchase):
     """ """
     start_time = time.time()
     item = purchase.item
@@ -256,101 +325,53 @@ def update_purchase(user_id: int, transaction_id: int, purchase_id: int, purchas
     warranty_date = purchase.warranty_date
     return_date = purchase.return_date
     quantity = purchase.quantity
+    validate_purchase(purchase)
 
-    # Validate inputs
-    if not is_valid_date(warranty_date) and warranty_date != "":
-        raise HTTPException(status_code=400, detail="Invalid warranty date format")
-    if not is_valid_date(return_date) and return_date != "":
-        raise HTTPException(status_code=400, detail="Invalid return date format")
-    if price <= 0:
-        raise HTTPException(status_code=400, detail="Invalid price format")
-    if quantity <= 1:
-        raise HTTPException(status_code=400, detail="Invalid quantity format")
-    if category not in ['Groceries', 'Clothing and Accessories', 'Electronics', 'Home and Garden', 
-                        'Health and Beauty', 'Entertainment', 'Travel', 'Automotive', 'Services', 
-                        'Gifts and Special Occasions', 'Education', 'Fitness and Sports', 'Pets', 
-                        'Office Supplies', 'Financial Services', 'Other']:
-        raise HTTPException(status_code=400, detail="Invalid category")
-    
     try:
-        with db.engine.begin() as connection:
-            # check if user exists
-            result = connection.execute(
-                sqlalchemy.text(check_user_query), 
-                [{"user_id": user_id}]).fetchone()
-            if result is None:
-                raise HTTPException(status_code=404, detail="User not found")
-            
-            # check if transaction exists and belongs to user
-            result = connection.execute(
-                sqlalchemy.text(check_transaction_query),
-                [{"transaction_id": transaction_id, "user_id": user_id}]).fetchone()
-            if result is None:
-                raise HTTPException(status_code=404, detail="Transaction not found")
-            if result.user_id != user_id:
-                raise HTTPException(status_code=400, detail="Transaction does not belong to user")
-            
-            # check if purchase exists and belongs to transaction
-            result = connection.execute(
-                sqlalchemy.text(check_purchase_query), 
-                [{"purchase_id": purchase_id}]).fetchone()
-            if result is None:
-                raise HTTPException(status_code=404, detail="Purchase not found")
-            if result.transaction_id != transaction_id:
-                raise HTTPException(status_code=400, detail="Purchase does not belong to transaction")
-
-            # update purchase
-            connection.execute(
-                sqlalchemy.text(
-                    """
-                    UPDATE purchases
-                    SET item = :item, price = :price, category = :category, warranty_date = :warranty_date, return_date = :return_date, quantity = :quantity
-                    WHERE id = :purchase_id
-                    """
-                ), [{"purchase_id": purchase_id, "item": item, "price": price, "category": category, "warranty_date": warranty_date, "return_date": return_date, "quantity": quantity}])
+        async with db.async_engine.begin() as connection:
+            # update purchase, checking it belongs to the user's transaction
+            rows = (await connection.execute(
+                statements.get("purchases.update"),
+                [{"user_id": user_id, "transaction_id": transaction_id, "purchase_id": purchase_id, "item": item, "price": price, "category": category, "warranty_date": warranty_date, "return_date": return_date, "quantity": quantity}])).mappings().all()
+            check_access(rows, user_id, transaction_id)
     except DBAPIError as error:
         print(f"Error returned: <<<{error}>>>")
+        raise HTTPException(status_code=500, detail="Database error")
+    # the user's cached aggregates are out of date now
+    await cache.invalidate(user_id)
     end_time = time.time()
     print(f"time: {(end_time - start_time) * 1000}")
     return {"item": item, "price": price, "category": category, "warranty_date": warranty_date, "return_date": return_date, "quantity": quantity}
 
+statements.register("purchases.categorized", guarded(
+    """
+    SELECT category, ('$' || ROUND((SUM(price * quantity) / 100.0), 2)::text) AS total
+    FROM purchases
+    WHERE transaction_id = :transaction_id
+    GROUP BY category
+    ORDER BY total
+    """, scope="transaction"
+))
+
 # gets sum of money spent of different catagories of all purchases in a specific transaction for a user
 @router.get("/categories", tags=["purchase"])
-def get_purchases_categorized_by_transaction(user_id: int, transaction_id: int):
+async def get_purchases_categorized_by_transaction(user_id: int, transaction_id: int):
     """ """
     start_time = time.time()
+    key = ("purchases.categorized", transaction_id)
+    ans, token = await cache.get(user_id, key)
+    if ans is not MISSING:
+        return ans
     ans = []
 
     try: 
-        with db.engine.begin() as connection:
-            # check if user exists
-            result = connection.execute(
-                sqlalchemy.text(check_user_query), 
-                [{"user_id": user_id}]).fetchone()
-            if result is None:
-                raise HTTPException(status_code=404, detail="User not found")
-            
-            # check if transaction exists and belongs to user
-            result = connection.execute(
-                sqlalchemy.text(check_transaction_query),
-                [{"transaction_id": transaction_id, "user_id": user_id}]
-            ).fetchone()
-            if result is None:
-                raise HTTPException(status_code=404, detail="Transaction not found")
-            if result.user_id != user_id:
-                raise HTTPException(status_code=400, detail="Transaction does not belong to user")
-            
+        async with db.async_engine.begin() as connection:
             # ans stores query result as list of dictionaries/json
-            ans = connection.execute(
-                sqlalchemy.text(
-                    """
-                    SELECT category, ('$' || ROUND((SUM(price * quantity) / 100.0), 2)::text) AS total
-                    FROM purchases
-                    WHERE transaction_id = :transaction_id
-                    GROUP BY category
-                    ORDER BY total
-                    """
-                ), [{"transaction_id": transaction_id}]).mappings().all()
+            rows = (await connection.execute(
+                statements.get("purchases.categorized"),
+                [{"user_id": user_id, "transaction_id": transaction_id}])).mappings().all()
+            ans = check_access(rows, user_id, transaction_id)
+            await cache.set(user_id, key, ans, token)
     except DBAPIError as error:
         print(f"Error returned: <<<{error}>>>")
 
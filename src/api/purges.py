@@ -0,0 +1,262 @@
+from fastapi import APIRouter, Depends
+from src.api import auth
+from src.api.access import check_access
+from src.api.statements import registry as statements
+from src import database as db
+from sqlalchemy.exc import DBAPIError
+from fastapi import HTTPException
+import asyncio
+import os
+
+router = APIRouter(
+    prefix="/purges",
+    tags=["purges"],
+    dependencies=[Depends(auth.get_api_key)],
+)
+
+# Deleting a user or transaction with mode=async stamps its deleted_at and
+# queues a purge job in one statement, touching nothing underneath, so it
+# returns in a few milliseconds however much the user has. From then on the
+# guard (src/api/access.py) and the list queries act as if it were gone.
+#
+# PurgeWorker runs in every API process and works through the queue. It
+# deletes what the job covers in batches of PURGE_BATCH_SIZE rows, children
+# first, one short transaction per batch, so no delete cascades through more
+# than one batch and concurrent writers never wait behind a whole user.
+# GET /purges/{job_id} reports how far a job has got.
+
+MODES = ["sync", "async"]
+
+def purge_settings():
+    return {
+        "batch_size": int(os.environ.get("PURGE_BATCH_SIZE", 1000)),
+        "pause": float(os.environ.get("PURGE_PAUSE_SECONDS", 0.01)),
+        "poll": float(os.environ.get("PURGE_POLL_SECONDS", 1)),
+        "lease": float(os.environ.get("PURGE_LEASE_SECONDS", 60)),
+        "max_attempts": int(os.environ.get("PURGE_MAX_ATTEMPTS", 5)),
+    }
+
+# for each kind of job, the tables it deletes from in order and how to find
+# the next batch of ids. each step repeats until a batch comes back short.
+# the last step deletes the soft deleted row itself, whose cascade only has
+# whatever a write racing the soft delete managed to add (and for a user,
+# their budget, budget lines and rollup, a few hundred rows at most)
+PURGE_STEPS = {
+    "user": {
+        "purchases": "SELECT id FROM purchases WHERE user_id = :target_id LIMIT :batch_size",
+        "receipts": """
+            SELECT r.id
+            FROM transactions AS t
+            JOIN receipts AS r ON r.transaction_id = t.id
+            WHERE t.user_id = :target_id
+            LIMIT :batch_size
+            """,
+        "transactions": "SELECT id FROM transactions WHERE user_id = :target_id LIMIT :batch_size",
+        "users": "SELECT id FROM users WHERE id = :target_id AND deleted_at IS NOT NULL",
+    },
+    "transaction": {
+        "purchases": "SELECT id FROM purchases WHERE transaction_id = :target_id LIMIT :batch_size",
+        "receipts": "SELECT id FROM receipts WHERE transaction_id = :target_id LIMIT :batch_size",
+        "transactions": "SELECT id FROM transactions WHERE id = :target_id AND deleted_at IS NOT NULL",
+    },
+}
+
+def purge_step_sql(kind, step):
+    # deletes one batch and counts it on the job in the same transaction, which
+    # also renews the worker's lease on the job
+    return f"""
+    WITH batch AS (
+        {PURGE_STEPS[kind][step]}
+    ),
+    removed AS (
+        DELETE FROM {step}
+        WHERE id IN (SELECT id FROM batch)
+        RETURNING 1
+    )
+    UPDATE purge_jobs
+    SET step = '{step}',
+        purged = purged || jsonb_build_object('{step}', COALESCE((purged ->> '{step}')::bigint, 0) + (SELECT count(*) FROM removed)),
+        batches = batches + 1,
+        updated_at = now()
+    WHERE id = :job_id
+    RETURNING (SELECT count(*) FROM removed) AS deleted
+    """
+
+for kind, steps in PURGE_STEPS.items():
+    statements.register(f"purges.{kind}", lambda step, kind=kind: purge_step_sql(kind, step), step=list(steps))
+
+# the oldest job nobody is working on: pending, or running under a lease
+# that ran out because its worker went away
+statements.register("purges.claim", """
+    UPDATE purge_jobs
+    SET status = 'running', attempts = attempts + 1, error = NULL, updated_at = now()
+    WHERE id = (
+        SELECT id
+        FROM purge_jobs
+        WHERE status = 'pending'
+        OR (status = 'running' AND updated_at < now() - make_interval(secs => :lease))
+        ORDER BY id
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, kind, target_id, user_id, attempts, total
+    """)
+
+statements.register("purges.total.user", """
+    UPDATE purge_jobs
+    SET total = jsonb_build_object(
+        'purchases', (SELECT count(*) FROM purchases WHERE user_id = :target_id),
+        'receipts', (SELECT count(*) FROM transactions AS t JOIN receipts AS r ON r.transaction_id = t.id WHERE t.user_id = :target_id),
+        'transactions', (SELECT count(*) FROM transactions WHERE user_id = :target_id),
+        'users', 1)
+    WHERE id = :job_id
+    """)
+
+statements.register("purges.total.transaction", """
+    UPDATE purge_jobs
+    SET total = jsonb_build_object(
+        'purchases', (SELECT count(*) FROM purchases WHERE transaction_id = :target_id),
+        'receipts', (SELECT count(*) FROM receipts WHERE transaction_id = :target_id),
+        'transactions', 1)
+    WHERE id = :job_id
+    """)
+
+statements.register("purges.finish", """
+    UPDATE purge_jobs
+    SET status = 'done', step = NULL, finished_at = now(), updated_at = now()
+    WHERE id = :job_id
+    """)
+
+# a failed job goes back in the queue until it is out of attempts
+statements.register("purges.fail", """
+    UPDATE purge_jobs
+    SET status = CASE WHEN attempts >= :max_attempts THEN 'failed' ELSE 'pending' END,
+        error = :error, updated_at = now()
+    WHERE id = :job_id
+    """)
+
+statements.register("purges.get", """
+    SELECT id, kind, target_id, user_id, status, step, purged, total, batches, attempts, error,
+    created_at, updated_at, finished_at
+    FROM purge_jobs
+    WHERE id = :job_id
+    """)
+
+async def queue_purge(name, params, user_id, transaction_id=None):
+    """
+    Runs the guarded soft delete statement name, which stamps deleted_at and
+    queues a purge job, and returns the job's id. Raises the guard's 404s,
+    including for something already deleted, and a 500 if the statement fails.
+    """
+    try:
+        async with db.async_engine.begin() as connection:
+            rows = (await connection.execute(statements.get(name), [params])).mappings().all()
+            rows = check_access(rows, user_id, transaction_id)
+            # lost a race with another delete of the same row
+            if not rows:
+                raise HTTPException(status_code=404, detail="Transaction not found" if transaction_id is not None else "User not found")
+            job_id = rows[0]["id"]
+    except DBAPIError as error:
+        print(f"Error returned: <<<{error}>>>")
+        raise HTTPException(status_code=500, detail="Database error")
+    return job_id
+
+class PurgeWorker:
+    def __init__(self, batch_size=1000, pause=0.01, poll=1.0, lease=60.0, max_attempts=5):
+        self.batch_size = batch_size
+        self.pause = pause
+        self.poll = poll
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self._task = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                worked = await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                # whatever went wrong, the worker has to outlive it
+                print(f"Error returned: <<<{error}>>>")
+                worked = False
+            # keep going while there is work, otherwise wait for some
+            if not worked:
+                await asyncio.sleep(self.poll)
+
+    async def claim(self):
+        async with db.async_engine.begin() as connection:
+            job = (await connection.execute(statements.get("purges.claim"), {"lease": self.lease})).mappings().first()
+            if job is not None and job["total"] is None:
+                await connection.execute(
+                    statements.get(f"purges.total.{job['kind']}"),
+                    {"job_id": job["id"], "target_id": job["target_id"]})
+        return job
+
+    async def purge(self, job):
+        """Deletes everything job covers, a batch per transaction."""
+        for step in PURGE_STEPS[job["kind"]]:
+            while True:
+                async with db.async_engine.begin() as connection:
+                    deleted = (await connection.execute(
+                        statements.get(f"purges.{job['kind']}", step=step),
+                        {"job_id": job["id"], "target_id": job["target_id"], "batch_size": self.batch_size})).scalar_one()
+                if deleted < self.batch_size:
+                    break
+                # let other work at the tables in between batches
+                await asyncio.sleep(self.pause)
+
+        async with db.async_engine.begin() as connection:
+            await connection.execute(statements.get("purges.finish"), {"job_id": job["id"]})
+
+    async def run_once(self):
+        """Claims a job and purges it to the end. Returns False if there was none."""
+        job = await self.claim()
+        if job is None:
+            return False
+
+        try:
+            await self.purge(job)
+        except Exception as error:
+            print(f"Error returned: <<<{error}>>>")
+            # a DBAPIError's own message wraps the driver's in the statement and its parameters
+            message = str(error.orig) if isinstance(error, DBAPIError) else str(error)
+            async with db.async_engine.begin() as connection:
+                await connection.execute(
+                    statements.get("purges.fail"),
+                    {"job_id": job["id"], "max_attempts": self.max_attempts, "error": message})
+        return True
+
+worker = PurgeWorker(**purge_settings())
+
+# reports how far a purge job has got
+@router.get("/{job_id}", tags=["purges"])
+async def get_purge(job_id: int):
+    """
+    status is pending, running, done or failed. purged counts the rows
+    deleted so far per table, and total how many there were when the job
+    started, once a worker has picked it up.
+    """
+    ans = None
+    try:
+        async with db.async_engine.begin() as connection:
+            ans = (await connection.execute(statements.get("purges.get"), {"job_id": job_id})).mappings().first()
+    except DBAPIError as error:
+        print(f"Error returned: <<<{error}>>>")
+
+    if ans is None:
+        raise HTTPException(status_code=404, detail="Purge job not found")
+
+    return dict(ans)
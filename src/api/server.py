@@ -1,21 +1,23 @@
 from fastapi import FastAPI, HTTPException, exceptions, File, UploadFile, status, Depends, APIRouter
 from fastapi.responses import JSONResponse
 from pydantic import ValidationError
-from src.api import transactions, admin, users, purchases, budget
+from src.api import transactions, admin, users, purchases, budget, dashboard, export, imports, purges
 from src import database as db
-import sqlalchemy
+from src.api.statements import registry as statements
 import json
 import logging
-import boto3
 import requests
 import os
 import time
 from src.api import auth
+from src.api.cache import cache
+from src.api.storage import storage
+from src.api.idempotency import IdempotencyMiddleware, idempotency_settings
 from starlette.middleware.cors import CORSMiddleware
-from src.api.transactions import create_transaction
-from src.api.purchases import create_purchase
+from src.api.access import guarded, check_access
+from src.api.dates import parse_date
 from src.api.transactions import NewTransaction
-from src.api.purchases import NewPurchase
+from src.api.purchases import NewPurchase, validate_purchase, CATEGORIES
 
 description = """
 Receipt App
@@ -32,6 +34,32 @@ app = FastAPI(
     },
 )
 
+# the redis cache backend subscribes to invalidations from the other workers
+@app.on_event("startup")
+async def start_cache():
+    await cache.start()
+
+@app.on_event("shutdown")
+async def close_cache():
+    await cache.close()
+
+# purges what async deletes leave behind, see src/api/purges.py
+@app.on_event("startup")
+async def start_purge_worker():
+    await purges.worker.start()
+
+@app.on_event("shutdown")
+async def close_purge_worker():
+    await purges.worker.close()
+
+# receipt uploads run on their own threads, see src/api/storage.py
+@app.on_event("shutdown")
+async def close_storage():
+    await storage.close()
+
+# retried POSTs with an Idempotency-Key get the first response back
+app.add_middleware(IdempotencyMiddleware, **idempotency_settings())
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # Allows all origins
@@ -40,12 +68,6 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
-s3 = boto3.resource(
-    's3',
-    aws_access_key_id= os.environ.get('AWS_ACCESS_KEY_ID'),
-    aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY')
-)
-
 router = APIRouter(
     prefix="/receipts",
     tags=["receipt"],
@@ -54,8 +76,6 @@ router = APIRouter(
 
 api_key = os.getenv('OPENAI_API_KEY')
 
-bucket = s3.Bucket('user-receipts-upload')
-
 KB = 1024
 MB = 1024 * KB
 
@@ -75,6 +95,9 @@ def get_file_type(contents):
         b'\x25\x50\x44\x46\x2D': 'application/pdf'
     }
 
+    if not isinstance(contents, bytes):
+        return 'unknown'
+
     # Check the first few bytes against common signatures
     for signature, file_type in file_signatures.items():
         if contents.startswith(signature):
@@ -83,6 +106,45 @@ def get_file_type(contents):
     return 'unknown'
 
 
+# a receipt's transaction, its purchases and the receipt row, all or nothing.
+# the purchases trigger sees the new transaction, see imports.merge
+statements.register("receipts.ingest", guarded(
+    """
+    SELECT new_transaction.id AS transaction_id, new_receipt.id AS receipt_id,
+    (SELECT count(*) FROM new_purchases) AS purchases
+    FROM new_transaction, new_receipt
+    """, ctes=[
+        """
+        new_transaction AS (
+            INSERT INTO transactions (user_id, merchant, description, date)
+            SELECT guard_user_id, :merchant, :description, :date
+            FROM guard
+            WHERE guard_user_id IS NOT NULL
+            RETURNING id
+        )
+        """,
+        """
+        new_purchases AS (
+            INSERT INTO purchases (transaction_id, item, price, quantity, warranty_date, return_date, category)
+            SELECT new_transaction.id, u.*
+            FROM new_transaction, unnest(
+                CAST(:items AS text[]), CAST(:prices AS integer[]), CAST(:quantities AS integer[]),
+                CAST(:warranty_dates AS text[]), CAST(:return_dates AS text[]), CAST(:categories AS text[])
+            ) AS u
+            RETURNING id
+        )
+        """,
+        """
+        new_receipt AS (
+            INSERT INTO receipts (transaction_id, url, parsed_data)
+            SELECT id, :url, :parsed_data
+            FROM new_transaction
+            RETURNING id
+        )
+        """,
+    ]
+))
+
 @app.post("/upload_receipt", tags=["receipt"])
 async def upload_receipt_to_S3(user_id: int, file: UploadFile = File(...)):
     if not file:
@@ -107,7 +169,7 @@ async def upload_receipt_to_S3(user_id: int, file: UploadFile = File(...)):
     if file_type not in SUPPORTED_FILES:
         raise HTTPException (
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail='file type: {file_type} not supported'
+            detail=f'file type: {file_type} not supported'
         )
     
     #used as unique identifier
@@ -118,33 +180,25 @@ async def upload_receipt_to_S3(user_id: int, file: UploadFile = File(...)):
     
     image_url = f"https://{os.getenv('AWS_S3_BUCKET_NAME')}.s3.us-west-1.amazonaws.com/{file.filename}.{int(upload_time)}.{SUPPORTED_FILES[file_type]}"
 
-    #once this returns, all receipt info will be in purchases and transactions table assuming openai func works with proper formatting
-    transaction_id = await openai_process_receipt(user_id=user_id, img_url=image_url, file=file)
+    receipt_json = await openai_process_receipt(user_id=user_id, img_url=image_url, file=file)
 
     print("openai processing done")
 
-    #Storing receipt_url in database, linking it to user with transaction_id, receipt data done in func call right above
-    with db.engine.begin() as connection:
-        connection.execute(
-            sqlalchemy.text(
-                """
-                INSERT INTO receipts (transaction_id, url, parsed_data)
-                VALUES (:transaction_id, :url, :parsed_data)
-                """
-            ), {"transaction_id": transaction_id['transaction_id'], "url": image_url, "parsed_data": ""})
-        print("receipt_url inserted into receipts table")
+    #transaction, purchases and receipt_url are stored together, or not at all
+    ingested = await ingest_receipt(user_id=user_id, image_url=image_url, receipt_json=receipt_json)
+    print("receipt ingested")
 
-    return {"image_url": image_url}
+    return {"image_url": image_url, "transaction_id": ingested["transaction_id"]}
 
 
 
 async def s3_upload(contents: bytes, key: str):
     print("attempting to upload image to s3")
-    bucket.put_object(Key=key, Body=contents)
+    await storage.upload(key, contents)
 
 
-#openai api parses receipt and inserts purchases and transcation info into tables,
-#returns transaction id so receipt image and all of its info can be linked by that
+#openai api parses receipt, returns the parsed JSON (store_name, date, items) for
+#ingest_receipt to store
 async def openai_process_receipt(user_id: int, img_url: str, file: UploadFile = File(...)):
     # Prepare the headers and payload for the OpenAI API request
     headers = {
@@ -210,30 +264,62 @@ async def openai_process_receipt(user_id: int, img_url: str, file: UploadFile =
     # Now receipt_json contains the raw JSON data
     print("\n {0} \n".format(receipt_json))
 
-    # Extract the necessary data from the receipt_data
-    store_name = receipt_json['store_name']
-    receipt_date = receipt_json['date']
-    
-    items = receipt_json['items']  # This should be a list of items, where each item is a dictionary with 'item', 'price', and 'quantity' keys
-    
-    # Create a new transaction with the store name
-    created_transaction = NewTransaction(merchant=store_name, description="receipt", date=receipt_date)
-
-    transaction_id = create_transaction(user_id, created_transaction)
-    print("created transaction {0}".format(transaction_id))
-    
-    # Create a new purchase for each item in the receipt
-    for item in items:
-        created_purchase = NewPurchase(item=item['name'], price=item['price'], quantity=item['quantity'], category="Automotive", warranty_date="2023-11-16", return_date="2023-11-16")
-        create_purchase(user_id, transaction_id['transaction_id'], created_purchase)
-
-    return transaction_id
+    return receipt_json
+
+
+#writes a parsed receipt as a transaction with a purchase per item, plus the receipt row
+#holding the image url and the parsed JSON, in one statement
+async def ingest_receipt(user_id: int, image_url: str, receipt_json: dict):
+    """
+    Validates the transaction and every item before writing anything, so a
+    bad item doesn't leave half a receipt behind.
+    """
+    start_time = time.time()
+    transaction = NewTransaction(merchant=receipt_json['store_name'], description="receipt", date=receipt_json['date'])
+    parsed_date = parse_date(transaction.date)
+    if parsed_date is None:
+        raise HTTPException(status_code=400, detail="Invalid date")
+
+    # the parsed category, unless the model made one up. receipts don't say
+    # when warranties or returns end
+    purchases = [
+        NewPurchase(item=item['name'], price=item['price'], quantity=item['quantity'],
+                    category=item.get('category') if item.get('category') in CATEGORIES else "Other",
+                    warranty_date="", return_date="")
+        for item in receipt_json['items']
+    ]
+    for purchase in purchases:
+        validate_purchase(purchase)
+
+    async with db.async_engine.begin() as connection:
+        rows = (await connection.execute(
+            statements.get("receipts.ingest"),
+            [{"user_id": user_id, "merchant": transaction.merchant, "description": transaction.description, "date": parsed_date,
+              "items": [purchase.item for purchase in purchases],
+              "prices": [purchase.price for purchase in purchases],
+              "quantities": [purchase.quantity for purchase in purchases],
+              "warranty_dates": [purchase.warranty_date for purchase in purchases],
+              "return_dates": [purchase.return_date for purchase in purchases],
+              "categories": [purchase.category for purchase in purchases],
+              "url": image_url, "parsed_data": json.dumps(receipt_json)}])).mappings().all()
+        ingested = check_access(rows, user_id)[0]
+
+    # the user's cached aggregates are out of date now
+    await cache.invalidate(user_id)
+    end_time = time.time()
+    print(f"time: {(end_time - start_time) * 1000}")
+
+    return ingested
 
 app.include_router(transactions.router)
 app.include_router(users.router)
 app.include_router(purchases.router)
 app.include_router(admin.router)
 app.include_router(budget.router)
+app.include_router(dashboard.router)
+app.include_router(export.router)
+app.include_router(imports.router)
+app.include_router(purges.router)
 
 @app.exception_handler(exceptions.RequestValidationError)
 @app.exception_handler(ValidationError)
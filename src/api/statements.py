@@ -0,0 +1,60 @@
+import itertools
+import sqlalchemy
+
+# Every SQL statement the routers run is built once, at import time, and
+# looked up here per request. Reusing the same text() object (and so the
+# same SQL string) lets SQLAlchemy's compiled cache and asyncpg's per
+# connection prepared statement cache hit instead of re-parsing.
+
+class StatementRegistry:
+    def __init__(self):
+        self._builders = {}
+        self._statements = {}
+        self._stats = {}
+
+    def register(self, name, sql, **variants):
+        """
+        Registers a statement under name. sql is either the SQL string or a
+        function building it from keyword arguments, in which case it is built
+        for every combination of the values listed in variants.
+        """
+        builder = sql if callable(sql) else (lambda: sql)
+        self._builders[name] = builder
+        self._stats[name] = {"lookups": 0, "built_on_use": 0}
+
+        keys = sorted(variants)
+        for values in itertools.product(*(variants[key] for key in keys)):
+            variant = dict(zip(keys, values))
+            self._statements[self._key(name, variant)] = sqlalchemy.text(builder(**variant))
+
+    def get(self, name, **variant):
+        key = self._key(name, variant)
+        stats = self._stats[name]
+        stats["lookups"] += 1
+
+        statement = self._statements.get(key)
+        if statement is None:
+            # variant that wasn't built up front, build it once and keep it
+            stats["built_on_use"] += 1
+            statement = self._statements[key] = sqlalchemy.text(self._builders[name](**variant))
+
+        return statement
+
+    def stats(self):
+        """
+        How often each statement was looked up, and how many variants had to
+        be built on first use instead of at registration. Whether the database
+        side caches hit is in database.statement_cache_metrics.
+        """
+        return {
+            "registered": len(self._statements),
+            "lookups": sum(stats["lookups"] for stats in self._stats.values()),
+            "built_on_use": sum(stats["built_on_use"] for stats in self._stats.values()),
+            "statements": {name: dict(stats) for name, stats in sorted(self._stats.items())},
+        }
+
+    @staticmethod
+    def _key(name, variant):
+        return (name, tuple(sorted(variant.items())))
+
+registry = StatementRegistry()
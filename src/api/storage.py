@@ -0,0 +1,80 @@
+import asyncio
+import concurrent.futures
+import io
+import os
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+
+# Receipt images go to S3 through here. boto3 only blocks, so every upload
+# runs on a small thread pool of its own and the event loop carries on with
+# other requests while it is in flight. Uploads past the pool's size wait
+# their turn on the loop, without tying up the default executor the rest of
+# the app uses.
+#
+# Objects over S3_MULTIPART_THRESHOLD_MB go up as a multipart upload, their
+# parts sent S3_PART_CONCURRENCY at a time.
+
+MB = 1024 * 1024
+
+def storage_settings():
+    return {
+        "bucket": os.environ.get("AWS_S3_BUCKET_NAME", "user-receipts-upload"),
+        "max_workers": int(os.environ.get("S3_MAX_WORKERS", 8)),
+        "multipart_threshold": int(float(os.environ.get("S3_MULTIPART_THRESHOLD_MB", 8)) * MB),
+        "part_size": int(float(os.environ.get("S3_PART_SIZE_MB", 8)) * MB),
+        "part_concurrency": int(os.environ.get("S3_PART_CONCURRENCY", 4)),
+    }
+
+class Storage:
+    def __init__(self, bucket, max_workers=8, multipart_threshold=8 * MB, part_size=8 * MB, part_concurrency=4, client=None):
+        self.bucket = bucket
+        self.max_workers = max_workers
+        self.transfer_config = TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=part_size,
+            max_concurrency=part_concurrency,
+            use_threads=part_concurrency > 1,
+        )
+        self._client = client
+        self._executor = None
+
+    @property
+    def client(self):
+        # made on first use, so importing the app doesn't need AWS settings.
+        # upload() resolves it on the event loop, so only one thread ever gets
+        # here, and from a session of its own: boto3's default session isn't
+        # safe to share between threads
+        if self._client is None:
+            self._client = boto3.session.Session().client(
+                's3',
+                aws_access_key_id=os.environ.get('AWS_ACCESS_KEY_ID'),
+                aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY'),
+                # enough connections for every part of every upload at once
+                config=Config(max_pool_connections=self.max_workers * self.transfer_config.max_concurrency),
+            )
+        return self._client
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="s3-upload")
+        return self._executor
+
+    async def upload(self, key, contents, content_type=None):
+        """Uploads contents to key in the bucket without blocking the event loop."""
+        extra_args = {"ContentType": content_type} if content_type else None
+        client = self.client
+        await asyncio.get_running_loop().run_in_executor(
+            self.executor,
+            lambda: client.upload_fileobj(
+                io.BytesIO(contents), self.bucket, key, ExtraArgs=extra_args, Config=self.transfer_config))
+
+    async def close(self):
+        # lets uploads already running finish
+        if self._executor is not None:
+            executor, self._executor = self._executor, None
+            await asyncio.get_running_loop().run_in_executor(None, executor.shutdown)
+
+storage = Storage(**storage_settings())
@@ -1,10 +1,16 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
 from pydantic import BaseModel
+from typing import Optional
 from src.api import auth
-import sqlalchemy
+from src.api.access import guarded, check_access
+from src.api.statements import registry as statements
+from src.api.cache import cache, MISSING
+from src.api.etags import not_modified
+from src.api.purges import MODES, queue_purge
 from src import database as db
 from sqlalchemy.exc import DBAPIError
-from datetime import datetime
+from src.api.dates import parse_date
+from src.api.pagination import PAGING, paging_mode, keyset_sql, order_sql, limit_sql, keyset_params, keyset_page
 import time
 
 router = APIRouter(
@@ -18,22 +24,24 @@ class NewTransaction(BaseModel):
     description: str
     date: str
 
-def is_valid_date(date_string, format='%Y-%m-%d'):
-    try:
-        datetime.strptime(date_string, format)
-        year, month, day = date_string.split('-')
-        if len(year) != 4 or len(month) != 2 or len(day) != 2:
-            return False
-        return True
-    except ValueError:
-        return False
-
 check_transaction_query = "SELECT user_id FROM transactions WHERE id = :transaction_id"
-check_user_query = "SELECT id FROM users WHERE id = :user_id"
+
+SORT_BY = ["date", "merchant"]
+SORT_ORDERS = ["asc", "desc"]
+
+statements.register("transactions.create", guarded(
+    """
+    INSERT INTO transactions (user_id, merchant, description, date)
+    SELECT guard_user_id, :merchant, :description, :date
+    FROM guard
+    WHERE guard_user_id IS NOT NULL
+    RETURNING id
+    """
+))
 
 # creates a new transaction for a user
 @router.post("/", tags=["transactions"])
-def create_transaction(user_id: int, transaction: NewTransaction):
+async def create_transaction(user_id: int, transaction: NewTransaction):
     """ """
     start_time = time.time()
 
@@ -43,98 +51,119 @@ def create_transaction(user_id: int, transaction: NewTransaction):
     transaction_id = None
 
     # check if date is valid
-    if not is_valid_date(date):
+    parsed_date = parse_date(date)
+    if parsed_date is None:
         raise HTTPException(status_code=400, detail="Invalid date")
 
     try:
-        with db.engine.begin() as connection:
-            # check if user exists
-            result = connection.execute(
-                sqlalchemy.text(check_user_query), 
-                [{"user_id": user_id}]).fetchone()
-            if result is None:
-                raise HTTPException(status_code=404, detail="User not found")
-            
-            # add transaction to database
-            transaction_id = connection.execute(
-                sqlalchemy.text(
-                    """
-                    INSERT INTO transactions (user_id, merchant, description, date)
-                    VALUES (:user_id, :merchant, :description, :date)
-                    RETURNING id
-                    """
-                ), [{"user_id": user_id, "merchant": merchant, "description": description, "date": date}]).scalar_one()
+        async with db.async_engine.begin() as connection:
+            # add transaction to database, only if the user exists
+            rows = (await connection.execute(
+                statements.get("transactions.create"),
+                [{"user_id": user_id, "merchant": merchant, "description": description, "date": parsed_date}])).mappings().all()
+            transaction_id = check_access(rows, user_id)[0]["id"]
     except DBAPIError as error:
         print(f"Error returned: <<<{error}>>>")
+        raise HTTPException(status_code=500, detail="Database error")
     
+    # the user's cached aggregates are out of date now
+    await cache.invalidate(user_id)
     end_time = time.time()
     print(f"time: {(end_time - start_time) * 1000}")
 
     return {"transaction_id": transaction_id}
 
+# Postgres types of the sort columns, for casting cursor positions back
+SORT_TYPES = {"date": "date", "merchant": "text"}
+
+def list_transactions_sql(sort_by, sort_order, single, paging):
+    # single narrows the listing to one transaction and checks its owner
+    sort_key, after = keyset_sql(sort_by, "id", sort_order, SORT_TYPES[sort_by], paging)
+    return guarded(
+        f"""
+        SELECT id, merchant, description, date{sort_key}
+        FROM transactions
+        WHERE user_id = :user_id {"AND id = :transaction_id" if single else ""}
+        AND deleted_at IS NULL
+        AND (date BETWEEN :date_from AND :date_to) AND merchant ILIKE :merchant
+        {after}
+        ORDER BY {order_sql(sort_by, "id", sort_order, paging)}
+        {limit_sql(paging)}
+        """, scope="transaction" if single else "user"
+    )
+
+statements.register("transactions.list", list_transactions_sql, sort_by=SORT_BY, sort_order=SORT_ORDERS, single=[False, True], paging=PAGING)
+
+def search_transactions_sql(single):
+    # fuzzy merchant search, best matches first. <% is served by transactions_merchant_trgm_idx
+    return guarded(
+        f"""
+        SELECT id, merchant, description, date
+        FROM transactions
+        WHERE user_id = :user_id {"AND id = :transaction_id" if single else ""}
+        AND deleted_at IS NULL
+        AND (date BETWEEN :date_from AND :date_to) AND merchant ILIKE :merchant
+        AND :search <% merchant
+        ORDER BY word_similarity(:search, merchant) DESC, similarity(:search, merchant) DESC, id
+        LIMIT :page_size OFFSET :offset
+        """, scope="transaction" if single else "user"
+    )
+
+statements.register("transactions.search", search_transactions_sql, single=[False, True])
+
 # gets transactions for a user (all or specific transaction)
 @router.get("/", tags=["transactions"])
-def get_transactions(user_id: int, transaction_id: int = -1, page: int = 1, page_size: int = 10, sort_by: str = "date", sort_order: str = "asc", date_from: str = "1000-01-01", date_to: str = "9999-12-31", merchant: str = "%"):
+async def get_transactions(user_id: int, transaction_id: int = -1, page: int = 1, page_size: int = 10, sort_by: str = "date", sort_order: str = "asc", date_from: str = "1000-01-01", date_to: str = "9999-12-31", merchant: str = "%", after: Optional[str] = None, search: Optional[str] = None, request: Request = None, response: Response = None):
     """ """
     start_time = time.time()
     
     # check if sort_by and sort_order is valid
-    if sort_by not in ["date", "merchant"]:
+    if sort_by not in SORT_BY:
         raise HTTPException(status_code=400, detail="Invalid sort_by")
-    if sort_order not in ["asc", "desc"]:
+    if sort_order not in SORT_ORDERS:
         raise HTTPException(status_code=400, detail="Invalid sort_order")
+
+    # search results are ranked by relevance, so they page by offset only
+    if search is not None and not search.strip():
+        raise HTTPException(status_code=400, detail="Invalid search")
+    if search is not None and after is not None:
+        raise HTTPException(status_code=400, detail="after can't be combined with search")
     
     # check if date_from and date_to are valid
-    if not is_valid_date(date_from):
+    parsed_from = parse_date(date_from)
+    if parsed_from is None:
         raise HTTPException(status_code=400, detail="Invalid date_from")
-    if not is_valid_date(date_to):
+    parsed_to = parse_date(date_to)
+    if parsed_to is None:
         raise HTTPException(status_code=400, detail="Invalid date_to")
     
     offset = (page - 1) * page_size
     merchant = f"%{merchant}%"
+    paging = paging_mode(after)
+    cursor = keyset_params(after, sort_by, sort_order)
+
+    # the client's copy is still current
+    unchanged = await not_modified(user_id, request, response)
+    if unchanged is not None:
+        return unchanged
+
+    key = ("transactions.get", transaction_id, page, page_size, sort_by, sort_order, parsed_from, parsed_to, merchant, after, search)
+    ans, token = await cache.get(user_id, key)
+    if ans is not MISSING:
+        return ans
+    ans = []
 
     try: 
-        with db.engine.begin() as connection:
-            # check if user exists
-            result = connection.execute(
-                sqlalchemy.text(check_user_query), 
-                [{"user_id": user_id}]).fetchone()
-            if result is None:
-                raise HTTPException(status_code=404, detail="User not found")
-            
-            if transaction_id == -1:
-                # get all transactions for user
-                ans = connection.execute(
-                    sqlalchemy.text(
-                        f"""
-                        SELECT id, merchant, description, date
-                        FROM transactions
-                        WHERE user_id = :user_id AND (date BETWEEN :date_from AND :date_to) AND merchant ILIKE :merchant
-                        ORDER BY {sort_by} {sort_order}
-                        LIMIT :page_size OFFSET :offset
-                        """
-                    ), [{"user_id": user_id, "page_size": page_size, "offset": offset, "date_from": date_from, "date_to": date_to, "merchant": merchant}]).mappings().all()
-            else:
-                # check if transaction exists and belongs to user
-                result = connection.execute(
-                    sqlalchemy.text(check_transaction_query),
-                    [{"transaction_id": transaction_id, "user_id": user_id}]).fetchone()
-                if result is None:
-                    raise HTTPException(status_code=404, detail="Transaction not found")
-                if result.user_id != user_id:
-                    raise HTTPException(status_code=400, detail="Transaction does not belong to user")
-                
-                # get specific transaction
-                ans = connection.execute(
-                    sqlalchemy.text(
-                        f"""
-                        SELECT id, merchant, description, date
-                        FROM transactions
-                        WHERE user_id = :user_id AND id = :transaction_id AND (date BETWEEN :date_from AND :date_to) AND merchant ILIKE :merchant
-                        ORDER BY {sort_by} {sort_order}
-                        LIMIT :page_size OFFSET :offset
-                        """
-                    ), [{"user_id": user_id, "transaction_id": transaction_id, "page_size": page_size, "offset": offset, "date_from": date_from, "date_to": date_to, "merchant": merchant}]).mappings().all()
+        async with db.async_engine.begin() as connection:
+            # get all transactions for user, or a specific one after checking it belongs to user
+            rows = (await connection.execute(
+                statements.get("transactions.search", single=transaction_id != -1) if search is not None else
+                statements.get("transactions.list", sort_by=sort_by, sort_order=sort_order, single=transaction_id != -1, paging=paging),
+                [{"user_id": user_id, "transaction_id": transaction_id, "page_size": page_size, "offset": offset, "date_from": parsed_from, "date_to": parsed_to, "merchant": merchant, "search": search, **cursor}])).mappings().all()
+            ans = check_access(rows, user_id)
+            if paging != "offset":
+                ans = keyset_page(ans, page_size, sort_by, sort_order)
+            await cache.set(user_id, key, ans, token)
     except DBAPIError as error:
         print(f"Error returned: <<<{error}>>>")
 
@@ -143,51 +172,86 @@ def get_transactions(user_id: int, transaction_id: int = -1, page: int = 1, page
     print(f"time: {(end_time - start_time) * 1000}")
 
     # returns [{"id": id, "merchant": merchant, "description": description, "date": date}, ...]
+    # or, with after, {"items": [...], "next_cursor": cursor or None}
     return ans
 
+statements.register("transactions.delete", guarded(
+    """
+    DELETE FROM transactions
+    WHERE id = :transaction_id AND user_id = :user_id AND deleted_at IS NULL
+    RETURNING id
+    """, scope="transaction"
+))
+
+# marks a transaction deleted, which takes its purchases out of the spending
+# rollup, and queues the purge of its purchases and receipts
+statements.register("transactions.soft_delete", guarded(
+    """
+    INSERT INTO purge_jobs (kind, target_id, user_id)
+    SELECT 'transaction', id, user_id
+    FROM deleted
+    RETURNING id
+    """, scope="transaction", ctes=[
+        """
+        deleted AS (
+            UPDATE transactions
+            SET deleted_at = now()
+            WHERE id = :transaction_id AND user_id = :user_id AND deleted_at IS NULL
+            RETURNING id, user_id
+        )
+        """,
+    ]
+))
+
 # deletes a specific transaction for a user
 @router.delete("/{transaction_id}", tags=["transactions"])
-def delete_transaction(user_id: int, transaction_id: int):
-    """ """
+async def delete_transaction(user_id: int, transaction_id: int, mode: str = "sync"):
+    """
+    mode=async hides the transaction at once and returns the id of the purge
+    job that deletes it in the background (GET /purges/{job_id}).
+    """
     start_time = time.time()
+    if mode not in MODES:
+        raise HTTPException(status_code=400, detail="Invalid mode")
+
+    if mode == "async":
+        job_id = await queue_purge("transactions.soft_delete", {"transaction_id": transaction_id, "user_id": user_id}, user_id, transaction_id)
+        # the user's cached aggregates are out of date now
+        await cache.invalidate(user_id)
+        end_time = time.time()
+        print(f"time: {(end_time - start_time) * 1000}")
+        return {"purge_job_id": job_id}
 
     try:
-        with db.engine.begin() as connection:
-            # check if user exists
-            result = connection.execute(
-                sqlalchemy.text(check_user_query), 
-                [{"user_id": user_id}]).fetchone()
-            if result is None:
-                raise HTTPException(status_code=404, detail="User not found")
-            
-            # check if transaction exists and belongs to user
-            result = connection.execute(
-                sqlalchemy.text(check_transaction_query),
-                [{"transaction_id": transaction_id, "user_id": user_id}]).fetchone()
-            if result is None:
-                raise HTTPException(status_code=404, detail="Transaction not found")
-            if result.user_id != user_id:
-                raise HTTPException(status_code=400, detail="Transaction does not belong to user")
-            
-            # delete transaction
-            connection.execute(
-                sqlalchemy.text(
-                    """
-                    DELETE FROM transactions
-                    WHERE id = :transaction_id AND user_id = :user_id
-                    """
-                ), [{"transaction_id": transaction_id, "user_id": user_id}])
+        async with db.async_engine.begin() as connection:
+            # delete transaction, checking it exists and belongs to user
+            rows = (await connection.execute(
+                statements.get("transactions.delete"),
+                [{"transaction_id": transaction_id, "user_id": user_id}])).mappings().all()
+            check_access(rows, user_id)
     except DBAPIError as error:
         print(f"Error returned: <<<{error}>>>")
+        raise HTTPException(status_code=500, detail="Database error")
 
+    # the user's cached aggregates are out of date now
+    await cache.invalidate(user_id)
     end_time = time.time()
     print(f"time: {(end_time - start_time) * 1000}")
 
     return "OK"
 
+statements.register("transactions.update", guarded(
+    """
+    UPDATE transactions
+    SET merchant = :merchant, description = :description, date = :date
+    WHERE id = :transaction_id AND user_id = :user_id AND deleted_at IS NULL
+    RETURNING id
+    """, scope="transaction"
+))
+
 # updates a specific transaction for a user
 @router.put("/{transaction_id}", tags=["transactions"])
-def update_transaction(user_id: int, transaction_id: int, transaction: NewTransaction):
+async def update_transaction(user_id: int, transaction_id: int, transaction: NewTransaction):
     """ """
     start_time = time.time()
 
@@ -196,39 +260,23 @@ def update_transaction(user_id: int, transaction_id: int, transaction: NewTransa
     date = transaction.date
 
     # check if date is valid
-    if not is_valid_date(date):
+    parsed_date = parse_date(date)
+    if parsed_date is None:
         raise HTTPException(status_code=400, detail="Invalid date")
 
     try:
-        with db.engine.begin() as connection:
-            # check if user exists
-            result = connection.execute(
-                sqlalchemy.text(check_user_query), 
-                [{"user_id": user_id}]).fetchone()
-            if result is None:
-                raise HTTPException(status_code=404, detail="User not found")
-            
-            # check if transaction exists and belongs to user
-            result = connection.execute(
-                sqlalchemy.text(check_transaction_query),
-                [{"transaction_id": transaction_id, "user_id": user_id}]).fetchone()
-            if result is None:
-                raise HTTPException(status_code=404, detail="Transaction not found")
-            if result.user_id != user_id:
-                raise HTTPException(status_code=400, detail="Transaction does not belong to user")
-            
-            # update transaction
-            connection.execute(
-                sqlalchemy.text(
-                    """
-                    UPDATE transactions
-                    SET merchant = :merchant, description = :description, date = :date
-                    WHERE id = :transaction_id AND user_id = :user_id
-                    """
-                ), [{"transaction_id": transaction_id, "user_id": user_id, "merchant": merchant, "description": description, "date": date}])
+        async with db.async_engine.begin() as connection:
+            # update transaction, checking it exists and belongs to user
+            rows = (await connection.execute(
+                statements.get("transactions.update"),
+                [{"transaction_id": transaction_id, "user_id": user_id, "merchant": merchant, "description": description, "date": parsed_date}])).mappings().all()
+            check_access(rows, user_id)
     except DBAPIError as error:
         print(f"Error returned: <<<{error}>>>")
+        raise HTTPException(status_code=500, detail="Database error")
 
+    # the user's cached aggregates are out of date now
+    await cache.invalidate(user_id)
     end_time = time.time()
     print(f"time: {(end_time - start_time) * 1000}")
 
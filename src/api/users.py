@@ -1,7 +1,10 @@
 from fastapi import APIRouter, Depends, HTTPException
 from pydantic import BaseModel
 from src.api import auth
-import sqlalchemy
+from src.api.access import guarded, check_access
+from src.api.statements import registry as statements
+from src.api.cache import cache
+from src.api.purges import MODES, queue_purge
 from src import database as db
 from sqlalchemy.exc import DBAPIError
 import re
@@ -25,12 +28,20 @@ def is_valid_name(name):
     name_regex = r'^[A-Za-z\'\-_]+$'
     return bool(re.match(name_regex, name))
 
-check_user_query = "SELECT id FROM users WHERE id = :user_id"
 
+statements.register("users.email_taken", """
+    SELECT id FROM users WHERE email = :email AND deleted_at IS NULL
+    """)
+
+statements.register("users.create", """
+    INSERT INTO users (name, email)
+    VALUES (:name, :email)
+    RETURNING id
+    """)
 
 # creates a new user
 @router.post("/", tags=["user"])
-def create_user(new_user: NewUser):
+async def create_user(new_user: NewUser):
     """ """
     start_time = time.time()
     name = new_user.name
@@ -47,28 +58,21 @@ def create_user(new_user: NewUser):
 
     try:
         # Check if email already exists
-        with db.engine.begin() as connection:
-            result = connection.execute(
-                sqlalchemy.text(
-                    """
-                    SELECT id FROM users WHERE email = :email
-                    """
-                ), [{"email": email}]).fetchone()
+        async with db.async_engine.begin() as connection:
+            result = (await connection.execute(
+                statements.get("users.email_taken"),
+                [{"email": email}])).fetchone()
             if result is not None:
                 raise HTTPException(status_code=409, detail="Email already in use")
 
         # add user to database
-        with db.engine.begin() as connection:
-            user_id = connection.execute(
-                sqlalchemy.text(
-                    """
-                    INSERT INTO users (name, email)
-                    VALUES (:name, :email)
-                    RETURNING id
-                    """
-                ), [{"name": name, "email": email}]).scalar_one()
+        async with db.async_engine.begin() as connection:
+            user_id = (await connection.execute(
+                statements.get("users.create"),
+                [{"name": name, "email": email}])).scalar_one()
     except DBAPIError as error:
         print(f"DBAPIError returned: <<<{error}>>>")
+        raise HTTPException(status_code=500, detail="Database error")
     except Exception as error:
         print(f"Internal Server Error returned: <<<{error}>>>")
 
@@ -79,22 +83,23 @@ def create_user(new_user: NewUser):
 
 
 
+statements.register("users.get", """
+    SELECT name, email
+    FROM users
+    WHERE id = :user_id AND deleted_at IS NULL
+    """)
+
 # gets a user's name and email
 @router.get("/{user_id}", tags=["user"])
-def get_user(user_id: int):
+async def get_user(user_id: int):
     """ """
     start_time = time.time()
     try:
-        with db.engine.begin() as connection:
+        async with db.async_engine.begin() as connection:
             # ans stores query result as dictionary/json
-            ans = connection.execute(
-                sqlalchemy.text(
-                    """
-                    SELECT name, email
-                    FROM users
-                    WHERE id = :user_id
-                    """
-                ), [{"user_id": user_id}]).fetchone()
+            ans = (await connection.execute(
+                statements.get("users.get"),
+                [{"user_id": user_id}])).fetchone()
             if ans is None:
                 raise HTTPException(status_code=404, detail="User not found")
     except DBAPIError as error:
@@ -107,38 +112,82 @@ def get_user(user_id: int):
     # ex: {"name": "John Doe", "email": "jdoe@gmail"}
     return {"name": ans.name, "email": ans.email}
 
+statements.register("users.delete", guarded(
+    """
+    DELETE FROM users
+    WHERE id = :user_id AND deleted_at IS NULL
+    RETURNING id
+    """
+))
+
+# marks a user deleted and queues the purge of everything they have
+statements.register("users.soft_delete", guarded(
+    """
+    INSERT INTO purge_jobs (kind, target_id, user_id)
+    SELECT 'user', id, id
+    FROM deleted
+    RETURNING id
+    """, ctes=[
+        """
+        deleted AS (
+            UPDATE users
+            SET deleted_at = now()
+            WHERE id = :user_id AND deleted_at IS NULL
+            RETURNING id
+        )
+        """,
+    ]
+))
+
 # deletes a user
 @router.delete("/{user_id}", tags=["user"])
-def delete_user(user_id: int):
-    """ """
+async def delete_user(user_id: int, mode: str = "sync"):
+    """
+    mode=async hides the user at once and returns the id of the purge job
+    that deletes their data in the background (GET /purges/{job_id}).
+    """
     start_time = time.time()
+    if mode not in MODES:
+        raise HTTPException(status_code=400, detail="Invalid mode")
+
+    if mode == "async":
+        job_id = await queue_purge("users.soft_delete", {"user_id": user_id}, user_id)
+        # the user's cached aggregates are out of date now
+        await cache.invalidate(user_id)
+        end_time = time.time()
+        print(f"time: {(end_time - start_time) * 1000}")
+        return {"purge_job_id": job_id}
+
     try:
-        with db.engine.begin() as connection:
-            # check if user exists
-            result = connection.execute(
-                sqlalchemy.text(check_user_query), 
-                [{"user_id": user_id}]).fetchone()
-            if result is None:
-                raise HTTPException(status_code=404, detail="User not found")
-            
-            # delete user
-            connection.execute(
-                sqlalchemy.text(
-                    """
-                    DELETE FROM users
-                    WHERE id = :user_id
-                    """
-                ), [{"user_id": user_id}])
+        async with db.async_engine.begin() as connection:
+            # delete user, checking it exists
+            rows = (await connection.execute(
+                statements.get("users.delete"),
+                [{"user_id": user_id}])).mappings().all()
+            check_access(rows, user_id)
     except DBAPIError as error:
         print(f"Error returned: <<<{error}>>>")
+        raise HTTPException(status_code=500, detail="Database error")
+    # the user's cached aggregates are out of date now
+    await cache.invalidate(user_id)
     end_time = time.time()
     print(f"time: {(end_time - start_time) * 1000}")
 
     return "OK"
 
+statements.register("users.update", guarded(
+    """
+    UPDATE users
+    SET name = :name, email = :email
+    WHERE id = :user_id AND deleted_at IS NULL
+    AND NOT EXISTS (SELECT 1 FROM users WHERE email = :email AND id != :user_id AND deleted_at IS NULL)
+    RETURNING id
+    """
+))
+
 # updates a user's name and email
 @router.put("/{user_id}", tags=["user"])
-def update_user(user_id: int, new_user: NewUser):
+async def update_user(user_id: int, new_user: NewUser):
     """ """
     start_time = time.time()
     name = new_user.name
@@ -153,35 +202,16 @@ def update_user(user_id: int, new_user: NewUser):
         raise HTTPException(status_code=400, detail="Invalid email")
 
     try:
-        with db.engine.begin() as connection:
-            # check if user exists
-            result = connection.execute(
-                sqlalchemy.text(check_user_query), 
-                [{"user_id": user_id}]).fetchone()
-            if result is None:
-                raise HTTPException(status_code=404, detail="User not found")
-            
-            # check if new email already exists
-            result = connection.execute(
-                sqlalchemy.text(
-                    """
-                    SELECT id FROM users WHERE email = :email
-                    """
-                ), [{"email": email}]).fetchone()
-            if result is not None and result.id != user_id:
+        async with db.async_engine.begin() as connection:
+            # update user, unless the new email belongs to someone else
+            rows = (await connection.execute(
+                statements.get("users.update"),
+                [{"name": name, "email": email, "user_id": user_id}])).mappings().all()
+            if not check_access(rows, user_id):
                 raise HTTPException(status_code=409, detail="Email already in use")
-
-            # update user
-            connection.execute(
-                sqlalchemy.text(
-                    """
-                    UPDATE users
-                    SET name = :name, email = :email
-                    WHERE id = :user_id
-                    """
-                ), [{"name": name, "email": email, "user_id": user_id}])
     except DBAPIError as error:
         print(f"Error returned: <<<{error}>>>")
+        raise HTTPException(status_code=500, detail="Database error")
     end_time = time.time()
     print(f"time: {(end_time - start_time) * 1000}")
 
@@ -1,10 +1,180 @@
 import os
+import time
+import asyncpg
 import dotenv
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.engine.interfaces import CacheStats
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 def database_connection_url():
     dotenv.load_dotenv()
 
     return os.environ.get('POSTGRES_URI')
 
-engine = create_engine(database_connection_url(), pool_pre_ping=True)
\ No newline at end of file
+def async_database_connection_url():
+    # same database as the sync engine, reached through asyncpg
+    return make_url(database_connection_url().strip()).set(drivername="postgresql+asyncpg")
+
+def pool_settings():
+    # pool sizing comes from the environment so it can be tuned per deployment
+    dotenv.load_dotenv()
+
+    return {
+        "pool_size": int(os.environ.get("POSTGRES_POOL_SIZE", 5)),
+        "max_overflow": int(os.environ.get("POSTGRES_MAX_OVERFLOW", 10)),
+        "pool_timeout": float(os.environ.get("POSTGRES_POOL_TIMEOUT", 30)),
+        "pool_recycle": int(os.environ.get("POSTGRES_POOL_RECYCLE", -1)),
+    }
+
+def statement_cache_settings():
+    # asyncpg keeps a per-connection LRU of server-side prepared statements keyed by SQL text,
+    # which only pays off because the routers reuse the same statements (src/api/statements.py)
+    dotenv.load_dotenv()
+
+    return {
+        "prepared_statement_cache_size": int(os.environ.get("POSTGRES_STATEMENT_CACHE_SIZE", 100)),
+    }
+
+
+class PoolMetrics:
+    # upper bounds (ms) of the checkout wait-time histogram buckets
+    WAIT_BUCKETS_MS = [1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.pre_ping_failures = 0
+        self.wait_ms_total = 0.0
+        self.wait_ms_max = 0.0
+        self.wait_buckets = [0] * (len(self.WAIT_BUCKETS_MS) + 1)
+
+    def record_wait(self, wait_ms):
+        self.checkouts += 1
+        self.wait_ms_total += wait_ms
+        self.wait_ms_max = max(self.wait_ms_max, wait_ms)
+        for i, bound in enumerate(self.WAIT_BUCKETS_MS):
+            if wait_ms <= bound:
+                self.wait_buckets[i] += 1
+                return
+        self.wait_buckets[-1] += 1
+
+    def snapshot(self, pool):
+        histogram = {f"le_{bound}ms": count for bound, count in zip(self.WAIT_BUCKETS_MS, self.wait_buckets)}
+        histogram["le_inf"] = self.wait_buckets[-1]
+
+        return {
+            "pool_size": pool.size(),
+            "checked_in": pool.checkedin(),
+            "checked_out": pool.checkedout(),
+            "overflow": max(pool.overflow(), 0),
+            "max_overflow": pool._max_overflow,
+            "checkouts": self.checkouts,
+            "timeouts": self.timeouts,
+            "pre_ping_failures": self.pre_ping_failures,
+            "wait_ms_avg": self.wait_ms_total / self.checkouts if self.checkouts else 0.0,
+            "wait_ms_max": self.wait_ms_max,
+            "wait_ms_histogram": histogram,
+        }
+
+pool_metrics = PoolMetrics()
+
+
+class MeteredQueuePool(AsyncAdaptedQueuePool):
+    # times how long each checkout waits on the queue (or on opening an overflow connection)
+    def _do_get(self):
+        start_time = time.perf_counter()
+        try:
+            record = super()._do_get()
+        except PoolTimeoutError:
+            pool_metrics.timeouts += 1
+            raise
+        pool_metrics.record_wait((time.perf_counter() - start_time) * 1000)
+        return record
+
+
+class StatementCacheMetrics:
+    # how often a statement reused SQLAlchemy's compiled form and an already
+    # prepared asyncpg statement, rather than compiling or preparing it again
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.compiled_hits = 0
+        self.compiled_misses = 0
+        self.executions = 0
+        self.prepares = 0
+
+    def record_execution(self, cache_hit):
+        self.executions += 1
+        if cache_hit is CacheStats.CACHE_HIT:
+            self.compiled_hits += 1
+        elif cache_hit is CacheStats.CACHE_MISS:
+            self.compiled_misses += 1
+
+    def snapshot(self):
+        compiled = self.compiled_hits + self.compiled_misses
+        # every execution looks its SQL up in the connection's prepared statement
+        # cache and only calls prepare() when it isn't there
+        prepared_hits = max(self.executions - self.prepares, 0)
+
+        return {
+            "compiled_cache": {
+                "hits": self.compiled_hits,
+                "misses": self.compiled_misses,
+                "hit_rate": self.compiled_hits / compiled if compiled else None,
+            },
+            "prepared_statement_cache": {
+                "hits": prepared_hits,
+                "misses": self.prepares,
+                "hit_rate": prepared_hits / self.executions if self.executions else None,
+                **statement_cache_settings(),
+            },
+        }
+
+statement_cache_metrics = StatementCacheMetrics()
+
+
+class MeteredConnection(asyncpg.Connection):
+    # SQLAlchemy only prepares a statement when its prepared statement cache
+    # misses. what the dialect runs while setting the connection up isn't counted
+    metered = False
+
+    async def prepare(self, query, **kwargs):
+        if self.metered:
+            statement_cache_metrics.prepares += 1
+        return await super().prepare(query, **kwargs)
+
+
+# sync engine is kept for scripts and one-off maintenance commands
+engine = create_engine(database_connection_url(), pool_pre_ping=True, **pool_settings())
+
+# async engine is used by every request handler
+async_engine = create_async_engine(
+    async_database_connection_url(),
+    pool_pre_ping=True,
+    poolclass=MeteredQueuePool,
+    connect_args={**statement_cache_settings(), "connection_class": MeteredConnection},
+    **pool_settings(),
+)
+
+@event.listens_for(async_engine.sync_engine, "handle_error")
+def count_pre_ping_failures(context):
+    if context.is_pre_ping:
+        pool_metrics.pre_ping_failures += 1
+
+@event.listens_for(async_engine.sync_engine, "before_cursor_execute")
+def count_statement_cache_use(conn, cursor, statement, parameters, context, executemany):
+    # executemany goes straight to asyncpg, past SQLAlchemy's prepared statement cache
+    if context is not None and not executemany:
+        statement_cache_metrics.record_execution(context.cache_hit)
+
+@event.listens_for(async_engine.sync_engine, "connect")
+def meter_prepares(dbapi_connection, connection_record):
+    connection_record.driver_connection.metered = True
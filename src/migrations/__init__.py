@@ -0,0 +1,124 @@
+import collections
+import hashlib
+import os
+import re
+import sqlalchemy
+
+# Schema changes live in versions/ as NNNN_name.sql files and are applied in
+# version order. Each applied migration is recorded in schema_migrations with
+# a checksum of its file, so editing a migration after it has shipped is
+# caught instead of silently leaving environments out of step.
+
+VERSIONS_DIR = os.path.join(os.path.dirname(__file__), "versions")
+
+FILENAME_PATTERN = re.compile(r"^(\d+)_(\w+)\.sql$")
+
+# arbitrary key for pg_advisory_xact_lock so two deploys can't migrate at once
+LOCK_KEY = 804_117_325
+
+Migration = collections.namedtuple("Migration", ["version", "name", "sql", "checksum"])
+
+
+class MigrationError(Exception):
+    pass
+
+
+def checksum(sql):
+    # line endings are normalized so a checkout on another OS doesn't look edited
+    return hashlib.sha256(sql.replace("\r\n", "\n").encode("utf-8")).hexdigest()
+
+def load_migrations(directory=VERSIONS_DIR):
+    """
+    Reads every migration file in directory, ordered by version. Raises
+    MigrationError for files that don't follow NNNN_name.sql or that reuse a
+    version number.
+    """
+    migrations = {}
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith(".sql"):
+            continue
+
+        match = FILENAME_PATTERN.match(filename)
+        if match is None:
+            raise MigrationError(f"Invalid migration filename: {filename}")
+
+        version = int(match.group(1))
+        if version in migrations:
+            raise MigrationError(f"Duplicate migration version {version}: {filename}")
+
+        with open(os.path.join(directory, filename), encoding="utf-8") as file:
+            sql = file.read()
+        migrations[version] = Migration(version, match.group(2), sql, checksum(sql))
+
+    return [migrations[version] for version in sorted(migrations)]
+
+def pending_migrations(migrations, applied, target=None):
+    """
+    Checks the applied {version: checksum} against migrations and returns the
+    ones still to run, up to and including target if given.
+    """
+    known = {migration.version: migration for migration in migrations}
+    for version, applied_checksum in sorted(applied.items()):
+        if version not in known:
+            raise MigrationError(f"Migration {version} was applied but its file is missing")
+        if known[version].checksum != applied_checksum:
+            raise MigrationError(f"Migration {version:04d}_{known[version].name} was modified after it was applied")
+
+    return [
+        migration for migration in migrations
+        if migration.version not in applied and (target is None or migration.version <= target)
+    ]
+
+def applied_migrations(connection):
+    connection.execute(sqlalchemy.text(
+        """
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version integer primary key,
+            name text not null,
+            checksum text not null,
+            applied_at timestamp with time zone not null default now()
+        )
+        """
+    ))
+    rows = connection.execute(sqlalchemy.text("SELECT version, checksum FROM schema_migrations")).all()
+    return {row.version: row.checksum for row in rows}
+
+def migrate(engine, target=None, directory=VERSIONS_DIR):
+    """
+    Applies pending migrations in one transaction, so a failing migration
+    leaves the schema as it was. Returns the migrations that were applied.
+    """
+    migrations = load_migrations(directory)
+
+    with engine.begin() as connection:
+        connection.execute(sqlalchemy.text("SELECT pg_advisory_xact_lock(:key)"), {"key": LOCK_KEY})
+        pending = pending_migrations(migrations, applied_migrations(connection), target)
+
+        for migration in pending:
+            print(f"applying migration {migration.version:04d}_{migration.name}")
+            # straight to the driver cursor without parameters, so colons and percent
+            # signs in the file aren't read as bind placeholders
+            cursor = connection.connection.cursor()
+            cursor.execute(migration.sql)
+            cursor.close()
+            connection.execute(sqlalchemy.text(
+                """
+                INSERT INTO schema_migrations (version, name, checksum)
+                VALUES (:version, :name, :checksum)
+                """
+            ), {"version": migration.version, "name": migration.name, "checksum": migration.checksum})
+
+    return pending
+
+def status(engine, directory=VERSIONS_DIR):
+    """
+    Returns (migration, applied) pairs for every migration file, after
+    checking the applied ones haven't been modified.
+    """
+    migrations = load_migrations(directory)
+
+    with engine.begin() as connection:
+        applied = applied_migrations(connection)
+    pending_migrations(migrations, applied)
+
+    return [(migration, migration.version in applied) for migration in migrations]
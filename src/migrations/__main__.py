@@ -0,0 +1,20 @@
+import argparse
+import sys
+from src import database as db
+from src.migrations import MigrationError, migrate, status
+
+parser = argparse.ArgumentParser(prog="python -m src.migrations", description="Apply or inspect schema migrations.")
+parser.add_argument("command", nargs="?", choices=["up", "status"], default="up")
+parser.add_argument("--target", type=int, default=None, help="stop after this version")
+args = parser.parse_args()
+
+try:
+    if args.command == "status":
+        for migration, applied in status(db.engine):
+            print(f"{'applied' if applied else 'pending'}  {migration.version:04d}_{migration.name}")
+    else:
+        applied = migrate(db.engine, target=args.target)
+        print(f"{len(applied)} migration(s) applied")
+except MigrationError as error:
+    print(f"Migration failed: {error}")
+    sys.exit(1)
@@ -0,0 +1,112 @@
+-- schema as it stood before migrations existed. IF NOT EXISTS lets databases
+-- that were built from Testing/populate_posts.py adopt it without changes.
+
+CREATE TABLE IF NOT EXISTS public.users (
+    id bigint generated by default as identity,
+    name text not null,
+    email text not null,
+    constraint Users_pkey primary key (id),
+    constraint users_email_check check (
+        (
+            email ~* '^[A-Za-z0-9._+%-]+@[A-Za-z0-9.-]+[.][A-Za-z]+$'::text
+        )
+    )
+) tablespace pg_default;
+
+CREATE TABLE IF NOT EXISTS public.transactions (
+    id bigint generated by default as identity,
+    user_id bigint not null,
+    merchant text not null,
+    description text null,
+    created_at timestamp with time zone not null default now(),
+    date text null,
+    constraint Transaction_pkey primary key (id),
+    constraint transactions_user_id_fkey foreign key (user_id) references users (id) on update cascade on delete cascade
+) tablespace pg_default;
+
+CREATE TABLE IF NOT EXISTS public.purchases (
+    id bigint generated by default as identity,
+    transaction_id bigint not null,
+    item text not null,
+    price integer not null,
+    warranty_date text null,
+    return_date text null,
+    category text not null default 'Other'::text,
+    quantity integer not null default 1,
+    constraint Purchase_pkey primary key (id),
+    constraint purchases_transaction_id_fkey foreign key (transaction_id) references transactions (id) on update cascade on delete cascade,
+    constraint purchases_category_check check (
+        (
+            category = any (
+                array[
+                    'Groceries'::text,
+                    'Clothing and Accessories'::text,
+                    'Electronics'::text,
+                    'Home and Garden'::text,
+                    'Health and Beauty'::text,
+                    'Entertainment'::text,
+                    'Travel'::text,
+                    'Automotive'::text,
+                    'Services'::text,
+                    'Gifts and Special Occasions'::text,
+                    'Education'::text,
+                    'Fitness and Sports'::text,
+                    'Pets'::text,
+                    'Office Supplies'::text,
+                    'Financial Services'::text,
+                    'Other'::text
+                ]
+            )
+        )
+    ),
+    constraint purchases_price_check check ((price >= 0)),
+    constraint purchases_quantity_check check ((quantity >= 1))
+) tablespace pg_default;
+
+CREATE TABLE IF NOT EXISTS public.receipts (
+    id bigint generated by default as identity,
+    transaction_id bigint null,
+    url text not null,
+    parsed_data text not null,
+    constraint Reciept_pkey primary key (id),
+    constraint receipts_transaction_id_fkey foreign key (transaction_id) references transactions (id) on update cascade on delete cascade
+) tablespace pg_default;
+
+CREATE TABLE IF NOT EXISTS public.budgets (
+    id bigint generated by default as identity,
+    user_id bigint not null,
+    groceries integer not null default 0,
+    clothing_and_accessories integer not null default 0,
+    electronics integer not null default 0,
+    home_and_garden integer not null default 0,
+    health_and_beauty integer not null default 0,
+    entertainment integer not null default 0,
+    travel integer not null default 0,
+    automotive integer not null default 0,
+    services integer not null default 0,
+    gifts_and_special_occasions integer not null default 0,
+    education integer not null default 0,
+    fitness_and_sports integer not null default 0,
+    pets integer not null default 0,
+    office_supplies integer not null default 0,
+    financial_services integer not null default 0,
+    other integer not null default 0,
+    constraint budgets_pkey primary key (id),
+    constraint budgets_user_id_fkey foreign key (user_id) references users (id) on update cascade on delete cascade,
+    constraint budgets_education_check check ((education >= 0)),
+    constraint budgets_electronics_check check ((electronics >= 0)),
+    constraint budgets_entertainment_check check ((entertainment >= 0)),
+    constraint budgets_financial_services_check check ((financial_services >= 0)),
+    constraint budgets_fitness_and_sports_check check ((fitness_and_sports >= 0)),
+    constraint budgets_gifts_and_special_occasions_check check ((gifts_and_special_occasions >= 0)),
+    constraint budgets_groceries_check check ((groceries >= 0)),
+    constraint budgets_automotive_check check ((automotive >= 0)),
+    constraint budgets_home_and_garden_check check ((home_and_garden >= 0)),
+    constraint budgets_office_supplies_check check ((office_supplies >= 0)),
+    constraint budgets_other_check check ((other >= 0)),
+    constraint budgets_pets_check check ((pets >= 0)),
+    constraint budgets_services_check check ((services >= 0)),
+    constraint budgets_travel_check check ((travel >= 0)),
+    constraint budgets_health_and_beauty_check check ((health_and_beauty >= 0)),
+    constraint budgets_clothing_and_accessories_check check ((clothing_and_accessories >= 0))
+) tablespace pg_default;
@@ -0,0 +1,33 @@
+-- indexes for the access paths the API actually uses. they replace the
+-- single-column tdate, pwarranty and ppurchase indexes from
+-- Docs/performace_writeup.md, which were only ever created by hand.
+DROP INDEX IF EXISTS tdate;
+DROP INDEX IF EXISTS pwarranty;
+DROP INDEX IF EXISTS ppurchase;
+
+-- get_transactions filters on user_id and a date range and sorts by date or
+-- merchant; compare_budgets_to_actual_spending filters on user_id and date and
+-- only needs id to reach purchases. id as the last key makes paging stable and
+-- lets the compare join run off the index alone.
+CREATE INDEX IF NOT EXISTS transactions_user_id_date_idx ON transactions (user_id, date, id);
+CREATE INDEX IF NOT EXISTS transactions_user_id_merchant_idx ON transactions (user_id, merchant, id);
+
+-- get_purchases, the category rollups and every per-user purchase query reach
+-- purchases through transaction_id. the included columns cover the
+-- SUM(price * quantity) GROUP BY category aggregates without heap lookups.
+CREATE INDEX IF NOT EXISTS purchases_transaction_id_idx ON purchases (transaction_id) INCLUDE (category, price, quantity);
+
+-- get_all_purchases_warranty and get_all_purchases_return skip rows without a
+-- date, so only rows that have one are indexed
+CREATE INDEX IF NOT EXISTS purchases_transaction_id_warranty_date_idx ON purchases (transaction_id, warranty_date)
+    WHERE warranty_date IS NOT NULL AND warranty_date != '';
+CREATE INDEX IF NOT EXISTS purchases_transaction_id_return_date_idx ON purchases (transaction_id, return_date)
+    WHERE return_date IS NOT NULL AND return_date != '';
+
+-- foreign keys Postgres doesn't index on its own; these also keep the cascade
+-- from deleting a user or transaction off sequential scans
+CREATE INDEX IF NOT EXISTS receipts_transaction_id_idx ON receipts (transaction_id);
+CREATE INDEX IF NOT EXISTS budgets_user_id_idx ON budgets (user_id);
+
+-- create_user and update_user look users up by email
+CREATE INDEX IF NOT EXISTS users_email_idx ON users (email);
@@ -0,0 +1,15 @@
+-- transactions.date was text, so range filters compared strings and the
+-- (user_id, date, id) index ordered them as text. convert it to a real date.
+-- rows written by the API are YYYY-MM-DD and rows from populate_posts.py are
+-- full timestamps; both cast cleanly. anything that doesn't becomes NULL
+-- rather than failing the whole migration.
+CREATE FUNCTION pg_temp.try_date(value text) RETURNS date AS $$
+BEGIN
+    RETURN value::date;
+EXCEPTION WHEN others THEN
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+-- rewrites the table and rebuilds transactions_user_id_date_idx on the new type
+ALTER TABLE transactions ALTER COLUMN date TYPE date USING pg_temp.try_date(date);
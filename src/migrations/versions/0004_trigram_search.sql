@@ -0,0 +1,8 @@
+-- trigram index for merchant search. a leading-wildcard ILIKE can't use a
+-- B-tree, but a gin_trgm_ops index serves ILIKE '%foo%' (for patterns of three
+-- or more characters) as well as the <% word similarity operator that
+-- get_transactions uses in search mode. the planner combines it with the
+-- transactions (user_id, ...) indexes to stay within one user's rows.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS transactions_merchant_trgm_idx ON transactions USING gin (merchant gin_trgm_ops);
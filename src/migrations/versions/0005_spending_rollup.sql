@@ -0,0 +1,165 @@
+-- per user, month and category spending totals, so the budget endpoints read
+-- O(categories) rows instead of summing every purchase on each call. the
+-- triggers below keep it current; rebuild_spending_rollup() recomputes it
+-- from purchases if it ever drifts (python -m src.rollup).
+--
+-- month is the first day of the transaction's month. purchases on a
+-- transaction without a date are kept under '-infinity' so all-time totals
+-- still include them.
+CREATE TABLE IF NOT EXISTS spending_rollup (
+    user_id bigint not null,
+    month date not null,
+    category text not null,
+    total_cents bigint not null default 0,
+    item_count bigint not null default 0,
+    constraint spending_rollup_pkey primary key (user_id, month, category),
+    constraint spending_rollup_user_id_fkey foreign key (user_id) references users (id) on update cascade on delete cascade
+);
+
+CREATE FUNCTION spending_rollup_month(value date) RETURNS date AS $$
+    SELECT COALESCE(date_trunc('month', value)::date, '-infinity'::date);
+$$ LANGUAGE sql IMMUTABLE;
+
+-- adds (sign = 1) or removes (sign = -1) purchases, given as rows of
+-- (user_id, date, category, price, quantity), from the rollup. removals only
+-- update existing rows and drop them once they cover no items.
+CREATE FUNCTION spending_rollup_apply(changes jsonb, sign integer) RETURNS void AS $$
+BEGIN
+    IF sign > 0 THEN
+        INSERT INTO spending_rollup (user_id, month, category, total_cents, item_count)
+        SELECT user_id, spending_rollup_month(date), category, SUM(price::bigint * quantity), SUM(quantity)
+        FROM jsonb_to_recordset(changes) AS c(user_id bigint, date date, category text, price integer, quantity integer)
+        GROUP BY 1, 2, 3
+        ON CONFLICT (user_id, month, category) DO UPDATE
+        SET total_cents = spending_rollup.total_cents + EXCLUDED.total_cents,
+            item_count = spending_rollup.item_count + EXCLUDED.item_count;
+    ELSE
+        UPDATE spending_rollup AS r
+        SET total_cents = r.total_cents - d.total_cents,
+            item_count = r.item_count - d.item_count
+        FROM (
+            SELECT user_id, spending_rollup_month(date) AS month, category, SUM(price::bigint * quantity) AS total_cents, SUM(quantity) AS item_count
+            FROM jsonb_to_recordset(changes) AS c(user_id bigint, date date, category text, price integer, quantity integer)
+            GROUP BY 1, 2, 3
+        ) AS d
+        WHERE r.user_id = d.user_id AND r.month = d.month AND r.category = d.category;
+
+        DELETE FROM spending_rollup AS r
+        USING jsonb_to_recordset(changes) AS c(user_id bigint, date date, category text)
+        WHERE r.user_id = c.user_id AND r.month = spending_rollup_month(c.date) AND r.category = c.category
+        AND r.item_count <= 0;
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+-- purchases: statement-level triggers see every changed row at once through
+-- transition tables, so multi-row inserts cost one upsert per (month, category)
+CREATE FUNCTION spending_rollup_purchases_insert() RETURNS trigger AS $$
+BEGIN
+    PERFORM spending_rollup_apply(
+        (SELECT jsonb_agg(jsonb_build_object('user_id', t.user_id, 'date', t.date, 'category', p.category, 'price', p.price, 'quantity', p.quantity))
+         FROM new_purchases AS p JOIN transactions AS t ON t.id = p.transaction_id),
+        1);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- when a transaction is deleted, its purchases go with it through the foreign
+-- key cascade. the transaction is gone by then, so nothing joins here and
+-- spending_rollup_transactions_delete has already removed them instead
+CREATE FUNCTION spending_rollup_purchases_delete() RETURNS trigger AS $$
+BEGIN
+    PERFORM spending_rollup_apply(
+        (SELECT jsonb_agg(jsonb_build_object('user_id', t.user_id, 'date', t.date, 'category', p.category, 'price', p.price, 'quantity', p.quantity))
+         FROM old_purchases AS p JOIN transactions AS t ON t.id = p.transaction_id),
+        -1);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION spending_rollup_purchases_update() RETURNS trigger AS $$
+BEGIN
+    PERFORM spending_rollup_apply(
+        (SELECT jsonb_agg(jsonb_build_object('user_id', t.user_id, 'date', t.date, 'category', p.category, 'price', p.price, 'quantity', p.quantity))
+         FROM old_purchases AS p JOIN transactions AS t ON t.id = p.transaction_id),
+        -1);
+    PERFORM spending_rollup_apply(
+        (SELECT jsonb_agg(jsonb_build_object('user_id', t.user_id, 'date', t.date, 'category', p.category, 'price', p.price, 'quantity', p.quantity))
+         FROM new_purchases AS p JOIN transactions AS t ON t.id = p.transaction_id),
+        1);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- transactions: a delete removes the purchases while they can still be read,
+-- and moving a transaction to another month or user moves its purchases' totals
+CREATE FUNCTION spending_rollup_transactions_delete() RETURNS trigger AS $$
+BEGIN
+    PERFORM spending_rollup_apply(
+        (SELECT jsonb_agg(jsonb_build_object('user_id', OLD.user_id, 'date', OLD.date, 'category', p.category, 'price', p.price, 'quantity', p.quantity))
+         FROM purchases AS p WHERE p.transaction_id = OLD.id),
+        -1);
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION spending_rollup_transactions_update() RETURNS trigger AS $$
+BEGIN
+    PERFORM spending_rollup_apply(
+        (SELECT jsonb_agg(jsonb_build_object('user_id', o.user_id, 'date', o.date, 'category', p.category, 'price', p.price, 'quantity', p.quantity))
+         FROM old_transactions AS o
+         JOIN new_transactions AS n ON n.id = o.id
+         JOIN purchases AS p ON p.transaction_id = o.id
+         WHERE o.user_id != n.user_id OR spending_rollup_month(o.date) != spending_rollup_month(n.date)),
+        -1);
+    PERFORM spending_rollup_apply(
+        (SELECT jsonb_agg(jsonb_build_object('user_id', n.user_id, 'date', n.date, 'category', p.category, 'price', p.price, 'quantity', p.quantity))
+         FROM old_transactions AS o
+         JOIN new_transactions AS n ON n.id = o.id
+         JOIN purchases AS p ON p.transaction_id = n.id
+         WHERE o.user_id != n.user_id OR spending_rollup_month(o.date) != spending_rollup_month(n.date)),
+        1);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER spending_rollup_purchases_insert AFTER INSERT ON purchases
+    REFERENCING NEW TABLE AS new_purchases
+    FOR EACH STATEMENT EXECUTE FUNCTION spending_rollup_purchases_insert();
+
+CREATE TRIGGER spending_rollup_purchases_delete AFTER DELETE ON purchases
+    REFERENCING OLD TABLE AS old_purchases
+    FOR EACH STATEMENT EXECUTE FUNCTION spending_rollup_purchases_delete();
+
+CREATE TRIGGER spending_rollup_purchases_update AFTER UPDATE ON purchases
+    REFERENCING OLD TABLE AS old_purchases NEW TABLE AS new_purchases
+    FOR EACH STATEMENT EXECUTE FUNCTION spending_rollup_purchases_update();
+
+CREATE TRIGGER spending_rollup_transactions_delete BEFORE DELETE ON transactions
+    FOR EACH ROW EXECUTE FUNCTION spending_rollup_transactions_delete();
+
+CREATE TRIGGER spending_rollup_transactions_update AFTER UPDATE ON transactions
+    REFERENCING OLD TABLE AS old_transactions NEW TABLE AS new_transactions
+    FOR EACH STATEMENT EXECUTE FUNCTION spending_rollup_transactions_update();
+
+-- recomputes the rollup from purchases for one user, or everyone when
+-- p_user_id is NULL
+CREATE FUNCTION rebuild_spending_rollup(p_user_id bigint DEFAULT NULL) RETURNS bigint AS $$
+DECLARE
+    rebuilt bigint;
+BEGIN
+    DELETE FROM spending_rollup WHERE p_user_id IS NULL OR user_id = p_user_id;
+
+    INSERT INTO spending_rollup (user_id, month, category, total_cents, item_count)
+    SELECT t.user_id, spending_rollup_month(t.date), p.category, SUM(p.price::bigint * p.quantity), SUM(p.quantity)
+    FROM purchases AS p
+    JOIN transactions AS t ON t.id = p.transaction_id
+    WHERE p_user_id IS NULL OR t.user_id = p_user_id
+    GROUP BY 1, 2, 3;
+
+    GET DIAGNOSTICS rebuilt = ROW_COUNT;
+    RETURN rebuilt;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT rebuild_spending_rollup();
@@ -0,0 +1,35 @@
+-- deleting a user cascades to their transactions, whose delete trigger takes
+-- their purchases out of the rollup. by then the user is gone, and once a
+-- rollup row has been updated in the same transaction its foreign key is
+-- checked again, so a user with two transactions in the same month and
+-- category couldn't be deleted. removals now skip users that no longer exist;
+-- their rollup rows are deleted by the same cascade.
+CREATE OR REPLACE FUNCTION spending_rollup_apply(changes jsonb, sign integer) RETURNS void AS $$
+BEGIN
+    IF sign > 0 THEN
+        INSERT INTO spending_rollup (user_id, month, category, total_cents, item_count)
+        SELECT user_id, spending_rollup_month(date), category, SUM(price::bigint * quantity), SUM(quantity)
+        FROM jsonb_to_recordset(changes) AS c(user_id bigint, date date, category text, price integer, quantity integer)
+        GROUP BY 1, 2, 3
+        ON CONFLICT (user_id, month, category) DO UPDATE
+        SET total_cents = spending_rollup.total_cents + EXCLUDED.total_cents,
+            item_count = spending_rollup.item_count + EXCLUDED.item_count;
+    ELSE
+        UPDATE spending_rollup AS r
+        SET total_cents = r.total_cents - d.total_cents,
+            item_count = r.item_count - d.item_count
+        FROM (
+            SELECT user_id, spending_rollup_month(date) AS month, category, SUM(price::bigint * quantity) AS total_cents, SUM(quantity) AS item_count
+            FROM jsonb_to_recordset(changes) AS c(user_id bigint, date date, category text, price integer, quantity integer)
+            GROUP BY 1, 2, 3
+        ) AS d
+        WHERE r.user_id = d.user_id AND r.month = d.month AND r.category = d.category
+        AND EXISTS (SELECT 1 FROM users WHERE users.id = r.user_id);
+
+        DELETE FROM spending_rollup AS r
+        USING jsonb_to_recordset(changes) AS c(user_id bigint, date date, category text)
+        WHERE r.user_id = c.user_id AND r.month = spending_rollup_month(c.date) AND r.category = c.category
+        AND r.item_count <= 0;
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,73 @@
+-- warranty and return lookups ask "what of this user's expires between today
+-- and N days from now". user_id lives on transactions, so those lookups had
+-- to walk every transaction the user has. copy it onto purchases, where a
+-- (user_id, date) index turns the lookup into one range scan.
+ALTER TABLE purchases ADD COLUMN IF NOT EXISTS user_id bigint;
+
+UPDATE purchases AS p
+SET user_id = t.user_id
+FROM transactions AS t
+WHERE t.id = p.transaction_id
+AND p.user_id IS DISTINCT FROM t.user_id;
+
+ALTER TABLE purchases ALTER COLUMN user_id SET NOT NULL;
+ALTER TABLE purchases ADD CONSTRAINT purchases_user_id_fkey foreign key (user_id) references users (id) on update cascade on delete cascade;
+
+-- purchases.user_id always follows its transaction: it is filled in on insert
+-- and whenever a purchase moves, and updated when a transaction changes owner
+CREATE FUNCTION purchases_set_user_id() RETURNS trigger AS $$
+BEGIN
+    SELECT user_id INTO NEW.user_id FROM transactions WHERE id = NEW.transaction_id;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION transactions_propagate_user_id() RETURNS trigger AS $$
+BEGIN
+    UPDATE purchases SET user_id = NEW.user_id WHERE transaction_id = NEW.id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER purchases_set_user_id BEFORE INSERT OR UPDATE OF transaction_id, user_id ON purchases
+    FOR EACH ROW EXECUTE FUNCTION purchases_set_user_id();
+
+CREATE TRIGGER transactions_propagate_user_id AFTER UPDATE OF user_id ON transactions
+    FOR EACH ROW WHEN (OLD.user_id IS DISTINCT FROM NEW.user_id)
+    EXECUTE FUNCTION transactions_propagate_user_id();
+
+-- the spending rollup's update trigger (0005) would now also see the
+-- user_id copies above, after the transaction already points at its new
+-- owner, and count them on top of what the transactions trigger moves. only
+-- purchases whose own transaction, category, price or quantity changed count.
+CREATE OR REPLACE FUNCTION spending_rollup_purchases_update() RETURNS trigger AS $$
+BEGIN
+    PERFORM spending_rollup_apply(
+        (SELECT jsonb_agg(jsonb_build_object('user_id', t.user_id, 'date', t.date, 'category', o.category, 'price', o.price, 'quantity', o.quantity))
+         FROM old_purchases AS o
+         JOIN new_purchases AS n ON n.id = o.id
+         JOIN transactions AS t ON t.id = o.transaction_id
+         WHERE (o.transaction_id, o.category, o.price, o.quantity) IS DISTINCT FROM (n.transaction_id, n.category, n.price, n.quantity)),
+        -1);
+    PERFORM spending_rollup_apply(
+        (SELECT jsonb_agg(jsonb_build_object('user_id', t.user_id, 'date', t.date, 'category', n.category, 'price', n.price, 'quantity', n.quantity))
+         FROM old_purchases AS o
+         JOIN new_purchases AS n ON n.id = o.id
+         JOIN transactions AS t ON t.id = n.transaction_id
+         WHERE (o.transaction_id, o.category, o.price, o.quantity) IS DISTINCT FROM (n.transaction_id, n.category, n.price, n.quantity)),
+        1);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- warranty_date and return_date are YYYY-MM-DD text, which sorts the same as
+-- the dates themselves. only well formed values are indexed, and the queries
+-- repeat the same condition so they can use these indexes. id makes cursor
+-- pages stable.
+DROP INDEX IF EXISTS purchases_transaction_id_warranty_date_idx;
+DROP INDEX IF EXISTS purchases_transaction_id_return_date_idx;
+
+CREATE INDEX IF NOT EXISTS purchases_user_id_warranty_date_idx ON purchases (user_id, warranty_date, id)
+    WHERE warranty_date ~ '^\d{4}-\d{2}-\d{2}$';
+CREATE INDEX IF NOT EXISTS purchases_user_id_return_date_idx ON purchases (user_id, return_date, id)
+    WHERE return_date ~ '^\d{4}-\d{2}-\d{2}$';
@@ -0,0 +1,74 @@
+-- budgets as one row per (user, category, period) instead of one wide row per
+-- user. period is the first day of the month a line takes effect from; the
+-- budget for a month is each category's latest line at or before it, so
+-- changing a budget adds lines instead of losing the old amounts.
+-- category is the purchase category name, so comparing against spending is a
+-- plain join on spending_rollup.category.
+CREATE TABLE IF NOT EXISTS budget_lines (
+    user_id bigint not null,
+    category text not null,
+    period date not null,
+    amount_cents bigint not null,
+    constraint budget_lines_pkey primary key (user_id, category, period),
+    constraint budget_lines_user_id_fkey foreign key (user_id) references users (id) on update cascade on delete cascade,
+    constraint budget_lines_amount_cents_check check ((amount_cents >= 0))
+);
+
+-- the budgets endpoints still read and write the wide row. a new row becomes
+-- the budget for every month ('-infinity'), and each update becomes the
+-- budget from the current month on; updating twice in a month keeps the last.
+CREATE FUNCTION budgets_sync_lines() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO budget_lines (user_id, category, period, amount_cents)
+    SELECT NEW.user_id, b.category,
+        CASE WHEN TG_OP = 'INSERT' THEN '-infinity'::date ELSE date_trunc('month', CURRENT_DATE)::date END,
+        b.amount_cents
+    FROM (VALUES
+        ('Groceries', NEW.groceries),
+        ('Clothing and Accessories', NEW.clothing_and_accessories),
+        ('Electronics', NEW.electronics),
+        ('Home and Garden', NEW.home_and_garden),
+        ('Health and Beauty', NEW.health_and_beauty),
+        ('Entertainment', NEW.entertainment),
+        ('Travel', NEW.travel),
+        ('Automotive', NEW.automotive),
+        ('Services', NEW.services),
+        ('Gifts and Special Occasions', NEW.gifts_and_special_occasions),
+        ('Education', NEW.education),
+        ('Fitness and Sports', NEW.fitness_and_sports),
+        ('Pets', NEW.pets),
+        ('Office Supplies', NEW.office_supplies),
+        ('Financial Services', NEW.financial_services),
+        ('Other', NEW.other)
+    ) AS b(category, amount_cents)
+    ON CONFLICT (user_id, category, period) DO UPDATE SET amount_cents = EXCLUDED.amount_cents;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER budgets_sync_lines AFTER INSERT OR UPDATE ON budgets
+    FOR EACH ROW EXECUTE FUNCTION budgets_sync_lines();
+
+-- existing budgets apply to every month, as they did before
+INSERT INTO budget_lines (user_id, category, period, amount_cents)
+SELECT b.user_id, l.category, '-infinity'::date, l.amount_cents
+FROM budgets AS b
+CROSS JOIN LATERAL (VALUES
+    ('Groceries', b.groceries),
+    ('Clothing and Accessories', b.clothing_and_accessories),
+    ('Electronics', b.electronics),
+    ('Home and Garden', b.home_and_garden),
+    ('Health and Beauty', b.health_and_beauty),
+    ('Entertainment', b.entertainment),
+    ('Travel', b.travel),
+    ('Automotive', b.automotive),
+    ('Services', b.services),
+    ('Gifts and Special Occasions', b.gifts_and_special_occasions),
+    ('Education', b.education),
+    ('Fitness and Sports', b.fitness_and_sports),
+    ('Pets', b.pets),
+    ('Office Supplies', b.office_supplies),
+    ('Financial Services', b.financial_services),
+    ('Other', b.other)
+) AS l(category, amount_cents)
+ON CONFLICT (user_id, category, period) DO NOTHING;
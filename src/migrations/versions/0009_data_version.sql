@@ -0,0 +1,53 @@
+-- a per-user counter that goes up whenever anything the read endpoints
+-- return for that user may have changed. clients get it back as an ETag, and
+-- a poll whose ETag is still current is answered with one primary key lookup.
+ALTER TABLE users ADD COLUMN IF NOT EXISTS data_version bigint not null default 0;
+
+-- bumped by triggers rather than by each endpoint, so every write counts:
+-- the API's, receipt ingestion's, imports and anything run by hand. once per
+-- statement and user, however many rows the statement touched.
+CREATE FUNCTION bump_data_version() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE users SET data_version = data_version + 1
+        WHERE id IN (SELECT user_id FROM new_rows);
+    ELSIF TG_OP = 'DELETE' THEN
+        UPDATE users SET data_version = data_version + 1
+        WHERE id IN (SELECT user_id FROM old_rows);
+    ELSE
+        UPDATE users SET data_version = data_version + 1
+        WHERE id IN (SELECT user_id FROM old_rows UNION SELECT user_id FROM new_rows);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER transactions_bump_data_version_insert AFTER INSERT ON transactions
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version();
+CREATE TRIGGER transactions_bump_data_version_delete AFTER DELETE ON transactions
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version();
+CREATE TRIGGER transactions_bump_data_version_update AFTER UPDATE ON transactions
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version();
+
+CREATE TRIGGER purchases_bump_data_version_insert AFTER INSERT ON purchases
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version();
+CREATE TRIGGER purchases_bump_data_version_delete AFTER DELETE ON purchases
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version();
+CREATE TRIGGER purchases_bump_data_version_update AFTER UPDATE ON purchases
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version();
+
+CREATE TRIGGER budgets_bump_data_version_insert AFTER INSERT ON budgets
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version();
+CREATE TRIGGER budgets_bump_data_version_delete AFTER DELETE ON budgets
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version();
+CREATE TRIGGER budgets_bump_data_version_update AFTER UPDATE ON budgets
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version();
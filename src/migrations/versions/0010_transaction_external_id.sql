@@ -0,0 +1,9 @@
+-- the bank's own id for an imported transaction (OFX FITID, or a CSV id
+-- column), or one derived from the row when the file has none. importing a
+-- statement twice, or two statements that overlap, skips what is already
+-- there instead of adding it again. transactions created through the API
+-- have none.
+ALTER TABLE transactions ADD COLUMN IF NOT EXISTS external_id text;
+
+CREATE UNIQUE INDEX IF NOT EXISTS transactions_user_id_external_id_key ON transactions (user_id, external_id)
+    WHERE external_id IS NOT NULL;
@@ -0,0 +1,143 @@
+-- deleting a user or transaction with mode=async only stamps deleted_at, and
+-- the API hides stamped rows from then on. the rows and everything under them
+-- are deleted later, a batch at a time, by the purge worker (src/api/purges.py)
+-- working through purge_jobs.
+ALTER TABLE users ADD COLUMN IF NOT EXISTS deleted_at timestamptz;
+ALTER TABLE transactions ADD COLUMN IF NOT EXISTS deleted_at timestamptz;
+
+-- one row per soft delete. there is no foreign key to users, since the job
+-- outlives the rows it purges and is what reports progress on them. purged
+-- and total count rows per table, total is filled in when a worker first
+-- picks the job up. a job that fails is retried until it has had
+-- PURGE_MAX_ATTEMPTS attempts.
+CREATE TABLE IF NOT EXISTS purge_jobs (
+    id bigint generated by default as identity,
+    kind text not null,
+    target_id bigint not null,
+    user_id bigint not null,
+    status text not null default 'pending',
+    step text null,
+    purged jsonb not null default '{}',
+    total jsonb null,
+    batches integer not null default 0,
+    attempts integer not null default 0,
+    error text null,
+    created_at timestamptz not null default now(),
+    updated_at timestamptz not null default now(),
+    finished_at timestamptz null,
+    constraint purge_jobs_pkey primary key (id),
+    constraint purge_jobs_kind_check check (kind in ('user', 'transaction')),
+    constraint purge_jobs_status_check check (status in ('pending', 'running', 'done', 'failed'))
+);
+
+-- the worker only ever looks for unfinished jobs
+CREATE INDEX IF NOT EXISTS purge_jobs_unfinished_idx ON purge_jobs (id) WHERE status IN ('pending', 'running');
+
+-- purchases.user_id (0007) only had partial indexes, so purging a user's
+-- purchases, and the cascade from deleting a user, scanned every purchase
+CREATE INDEX IF NOT EXISTS purchases_user_id_idx ON purchases (user_id);
+
+-- the spending rollup counts only purchases of transactions that aren't
+-- deleted. soft deleting a transaction takes its purchases out right away,
+-- so the rollup reads stay correct while the purge catches up, and the purge
+-- deleting them later changes nothing.
+CREATE OR REPLACE FUNCTION spending_rollup_purchases_insert() RETURNS trigger AS $$
+BEGIN
+    PERFORM spending_rollup_apply(
+        (SELECT jsonb_agg(jsonb_build_object('user_id', t.user_id, 'date', t.date, 'category', p.category, 'price', p.price, 'quantity', p.quantity))
+         FROM new_purchases AS p JOIN transactions AS t ON t.id = p.transaction_id
+         WHERE t.deleted_at IS NULL),
+        1);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION spending_rollup_purchases_delete() RETURNS trigger AS $$
+BEGIN
+    PERFORM spending_rollup_apply(
+        (SELECT jsonb_agg(jsonb_build_object('user_id', t.user_id, 'date', t.date, 'category', p.category, 'price', p.price, 'quantity', p.quantity))
+         FROM old_purchases AS p JOIN transactions AS t ON t.id = p.transaction_id
+         WHERE t.deleted_at IS NULL),
+        -1);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION spending_rollup_purchases_update() RETURNS trigger AS $$
+BEGIN
+    PERFORM spending_rollup_apply(
+        (SELECT jsonb_agg(jsonb_build_object('user_id', t.user_id, 'date', t.date, 'category', o.category, 'price', o.price, 'quantity', o.quantity))
+         FROM old_purchases AS o
+         JOIN new_purchases AS n ON n.id = o.id
+         JOIN transactions AS t ON t.id = o.transaction_id
+         WHERE (o.transaction_id, o.category, o.price, o.quantity) IS DISTINCT FROM (n.transaction_id, n.category, n.price, n.quantity)
+         AND t.deleted_at IS NULL),
+        -1);
+    PERFORM spending_rollup_apply(
+        (SELECT jsonb_agg(jsonb_build_object('user_id', t.user_id, 'date', t.date, 'category', n.category, 'price', n.price, 'quantity', n.quantity))
+         FROM old_purchases AS o
+         JOIN new_purchases AS n ON n.id = o.id
+         JOIN transactions AS t ON t.id = n.transaction_id
+         WHERE (o.transaction_id, o.category, o.price, o.quantity) IS DISTINCT FROM (n.transaction_id, n.category, n.price, n.quantity)
+         AND t.deleted_at IS NULL),
+        1);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION spending_rollup_transactions_delete() RETURNS trigger AS $$
+BEGIN
+    IF OLD.deleted_at IS NULL THEN
+        PERFORM spending_rollup_apply(
+            (SELECT jsonb_agg(jsonb_build_object('user_id', OLD.user_id, 'date', OLD.date, 'category', p.category, 'price', p.price, 'quantity', p.quantity))
+             FROM purchases AS p WHERE p.transaction_id = OLD.id),
+            -1);
+    END IF;
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+
+-- being deleted (or undeleted) moves a transaction's purchases like changing
+-- its user or month does
+CREATE OR REPLACE FUNCTION spending_rollup_transactions_update() RETURNS trigger AS $$
+BEGIN
+    PERFORM spending_rollup_apply(
+        (SELECT jsonb_agg(jsonb_build_object('user_id', o.user_id, 'date', o.date, 'category', p.category, 'price', p.price, 'quantity', p.quantity))
+         FROM old_transactions AS o
+         JOIN new_transactions AS n ON n.id = o.id
+         JOIN purchases AS p ON p.transaction_id = o.id
+         WHERE (o.user_id != n.user_id OR spending_rollup_month(o.date) != spending_rollup_month(n.date)
+                OR (o.deleted_at IS NULL) != (n.deleted_at IS NULL))
+         AND o.deleted_at IS NULL),
+        -1);
+    PERFORM spending_rollup_apply(
+        (SELECT jsonb_agg(jsonb_build_object('user_id', n.user_id, 'date', n.date, 'category', p.category, 'price', p.price, 'quantity', p.quantity))
+         FROM old_transactions AS o
+         JOIN new_transactions AS n ON n.id = o.id
+         JOIN purchases AS p ON p.transaction_id = n.id
+         WHERE (o.user_id != n.user_id OR spending_rollup_month(o.date) != spending_rollup_month(n.date)
+                OR (o.deleted_at IS NULL) != (n.deleted_at IS NULL))
+         AND n.deleted_at IS NULL),
+        1);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION rebuild_spending_rollup(p_user_id bigint DEFAULT NULL) RETURNS bigint AS $$
+DECLARE
+    rebuilt bigint;
+BEGIN
+    DELETE FROM spending_rollup WHERE p_user_id IS NULL OR user_id = p_user_id;
+
+    INSERT INTO spending_rollup (user_id, month, category, total_cents, item_count)
+    SELECT t.user_id, spending_rollup_month(t.date), p.category, SUM(p.price::bigint * p.quantity), SUM(p.quantity)
+    FROM purchases AS p
+    JOIN transactions AS t ON t.id = p.transaction_id
+    WHERE (p_user_id IS NULL OR t.user_id = p_user_id)
+    AND t.deleted_at IS NULL
+    GROUP BY 1, 2, 3;
+
+    GET DIAGNOSTICS rebuilt = ROW_COUNT;
+    RETURN rebuilt;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,21 @@
+-- responses to POSTs sent with an Idempotency-Key header, so a client
+-- retrying the same request gets the first response back instead of running
+-- it again (src/api/idempotency.py). client is a hash of the API key the
+-- request came with, so two clients can't see each other's responses.
+-- request_hash tells a retry from a different request reusing the key.
+-- rows live until expires_at and are then overwritten or swept.
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    client text not null,
+    key text not null,
+    request_hash text not null,
+    status text not null default 'in_flight',
+    response_status integer null,
+    response_headers jsonb null,
+    response_body bytea null,
+    created_at timestamptz not null default now(),
+    expires_at timestamptz not null,
+    constraint idempotency_keys_pkey primary key (client, key),
+    constraint idempotency_keys_status_check check (status in ('in_flight', 'done'))
+);
+
+CREATE INDEX IF NOT EXISTS idempotency_keys_expires_at_idx ON idempotency_keys (expires_at);
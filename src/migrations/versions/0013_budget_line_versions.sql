@@ -0,0 +1,11 @@
+-- budget lines are written directly now (PUT /budgets/months/{month}), not
+-- only through the budgets row, so they bump users.data_version themselves.
+CREATE TRIGGER budget_lines_bump_data_version_insert AFTER INSERT ON budget_lines
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version();
+CREATE TRIGGER budget_lines_bump_data_version_delete AFTER DELETE ON budget_lines
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version();
+CREATE TRIGGER budget_lines_bump_data_version_update AFTER UPDATE ON budget_lines
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version();
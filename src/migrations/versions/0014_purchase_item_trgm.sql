@@ -0,0 +1,5 @@
+-- trigram index for item search, the purchases counterpart of
+-- transactions_merchant_trgm_idx (0004). it serves item ILIKE '%foo%' and the
+-- <% word similarity operator that get_purchases uses in search mode, so a
+-- search over a transaction with many purchases doesn't scan all of them.
+CREATE INDEX IF NOT EXISTS purchases_item_trgm_idx ON purchases USING gin (item gin_trgm_ops);
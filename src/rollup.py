@@ -0,0 +1,58 @@
+import argparse
+import sqlalchemy
+from src import database as db
+
+# Recomputes spending_rollup (migration 0005) from purchases. The triggers keep
+# it current on their own; this is for repairing drift, e.g. after loading data
+# with triggers disabled.
+#
+#     python -m src.rollup              # every user
+#     python -m src.rollup --user-id 7  # one user
+
+def drift(connection, user_id=None):
+    """
+    Returns how many (user_id, month, category) rows of spending_rollup differ
+    from what rebuilding it would produce.
+    """
+    return connection.execute(sqlalchemy.text(
+        """
+        WITH expected AS (
+            SELECT t.user_id, spending_rollup_month(t.date) AS month, p.category,
+            SUM(p.price::bigint * p.quantity) AS total_cents, SUM(p.quantity) AS item_count
+            FROM purchases AS p
+            JOIN transactions AS t ON t.id = p.transaction_id
+            WHERE (CAST(:user_id AS bigint) IS NULL OR t.user_id = :user_id)
+            AND t.deleted_at IS NULL
+            GROUP BY 1, 2, 3
+        ), actual AS (
+            SELECT user_id, month, category, total_cents, item_count
+            FROM spending_rollup
+            WHERE CAST(:user_id AS bigint) IS NULL OR user_id = :user_id
+        )
+        SELECT count(*)
+        FROM expected
+        FULL JOIN actual USING (user_id, month, category)
+        WHERE expected.total_cents IS DISTINCT FROM actual.total_cents
+        OR expected.item_count IS DISTINCT FROM actual.item_count
+        """
+    ), {"user_id": user_id}).scalar_one()
+
+def rebuild(connection, user_id=None):
+    """
+    Rebuilds the rollup for user_id, or for every user when it is None, and
+    returns the number of rows written.
+    """
+    return connection.execute(
+        sqlalchemy.text("SELECT rebuild_spending_rollup(:user_id)"),
+        {"user_id": user_id}).scalar_one()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m src.rollup", description="Rebuild the spending rollup.")
+    parser.add_argument("--user-id", type=int, default=None, help="only rebuild this user")
+    parser.add_argument("--check", action="store_true", help="report drift without rebuilding")
+    args = parser.parse_args()
+
+    with db.engine.begin() as connection:
+        print(f"{drift(connection, args.user_id)} rollup row(s) out of date")
+        if not args.check:
+            print(f"{rebuild(connection, args.user_id)} rollup row(s) rebuilt")
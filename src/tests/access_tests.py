@@ -0,0 +1,59 @@
+import pytest
+from fastapi import HTTPException
+from src.api.access import guarded, check_access
+
+
+class TestGuarded:
+
+    # Only the guard columns for the requested scope are selected
+    def test_scope_columns(self):
+        user_sql = guarded("SELECT 1 AS x")
+        purchase_sql = guarded("SELECT 1 AS x", scope="purchase")
+
+        assert "guard_user_id" in user_sql
+        assert "guard_owner_id" not in user_sql
+        assert "guard_owner_id" in purchase_sql
+        assert "guard_transaction_id" in purchase_sql
+
+    # Extra CTEs are placed between the guard and the body
+    def test_extra_ctes(self):
+        sql = guarded("SELECT * FROM input", ctes=["input AS (SELECT 1 AS x)"])
+        assert sql.index("guard AS") < sql.index("input AS") < sql.index("body AS")
+
+
+class TestCheckAccess:
+
+    # Missing user is reported before anything else
+    def test_user_not_found(self):
+        rows = [{"guard_user_id": None, "guard_owner_id": None, "guard_seq": None, "id": None}]
+        with pytest.raises(HTTPException) as exception:
+            check_access(rows, 1, 2)
+        assert exception.value.status_code == 404
+        assert exception.value.detail == "User not found"
+
+    # A transaction owned by someone else is a 400, not a 404
+    def test_transaction_wrong_owner(self):
+        rows = [{"guard_user_id": 1, "guard_owner_id": 5, "guard_seq": None, "id": None}]
+        with pytest.raises(HTTPException) as exception:
+            check_access(rows, 1, 2)
+        assert exception.value.status_code == 400
+
+    # A purchase on a different transaction is a 400
+    def test_purchase_wrong_transaction(self):
+        rows = [{"guard_user_id": 1, "guard_owner_id": 1, "guard_transaction_id": 3, "guard_seq": None, "id": None}]
+        with pytest.raises(HTTPException) as exception:
+            check_access(rows, 1, 2)
+        assert exception.value.detail == "Purchase does not belong to transaction"
+
+    # An empty body comes back as an empty list
+    def test_empty_body(self):
+        rows = [{"guard_user_id": 1, "guard_seq": None, "id": None}]
+        assert check_access(rows, 1) == []
+
+    # Body rows come back without the guard columns
+    def test_body_rows(self):
+        rows = [
+            {"guard_user_id": 1, "guard_seq": 1, "id": 10},
+            {"guard_user_id": 1, "guard_seq": 2, "id": 11},
+        ]
+        assert check_access(rows, 1) == [{"id": 10}, {"id": 11}]
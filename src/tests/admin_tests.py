@@ -0,0 +1,91 @@
+from src.api.admin import get_project_info, get_pool_status, get_statement_cache_status, get_cache_status, clear_cache
+from src.api.cache import cache
+from src.database import PoolMetrics
+from src import database as db
+import sqlalchemy
+import pytest
+
+
+class TestGetProjectInfo:
+
+    # Returns the project name and contributors
+    def test_returns_project_info(self):
+        result = get_project_info()
+        assert result["Project Name"] == "Receipt App"
+        assert len(result["Contributors"]) == 4
+
+
+class TestPoolMetrics:
+
+    # Wait times land in the first bucket whose bound they don't exceed
+    def test_record_wait_buckets(self):
+        metrics = PoolMetrics()
+        metrics.record_wait(0.5)
+        metrics.record_wait(7)
+        metrics.record_wait(10)
+        metrics.record_wait(60000)
+
+        assert metrics.checkouts == 4
+        assert metrics.wait_buckets[0] == 1
+        assert metrics.wait_buckets[2] == 2
+        assert metrics.wait_buckets[-1] == 1
+        assert metrics.wait_ms_max == 60000
+
+    # Reset clears every counter
+    def test_reset(self):
+        metrics = PoolMetrics()
+        metrics.record_wait(3)
+        metrics.timeouts = 2
+        metrics.reset()
+
+        assert metrics.checkouts == 0
+        assert metrics.timeouts == 0
+        assert sum(metrics.wait_buckets) == 0
+
+
+class TestGetPoolStatus:
+
+    # Reports pool occupancy alongside the wait-time histogram
+    def test_reports_pool_status(self):
+        result = get_pool_status()
+        assert result["checked_out"] >= 0
+        assert "pre_ping_failures" in result
+        assert "le_inf" in result["wait_ms_histogram"]
+
+
+class TestGetStatementCacheStatus:
+
+    # Reports registry lookups alongside the prepared statement cache size
+    def test_reports_statement_cache_status(self):
+        result = get_statement_cache_status()
+        assert "lookups" in result
+        assert "statements" in result
+        assert result["prepared_statement_cache"]["prepared_statement_cache_size"] > 0
+
+    # Running the same statement again reuses its compiled form and, on the same connection, its prepared statement
+    @pytest.mark.asyncio
+    async def test_counts_statement_cache_hits(self):
+        statement = sqlalchemy.text("SELECT CAST(:value AS integer) AS value")
+        before = get_statement_cache_status()
+
+        async with db.async_engine.connect() as connection:
+            for value in range(3):
+                await connection.execute(statement, {"value": value})
+
+        after = get_statement_cache_status()
+        assert after["compiled_cache"]["hits"] - before["compiled_cache"]["hits"] >= 2
+        assert after["prepared_statement_cache"]["hits"] - before["prepared_statement_cache"]["hits"] >= 2
+        assert after["prepared_statement_cache"]["hit_rate"] is not None
+
+
+class TestCache:
+
+    # Reports the counters of the shared cache and can empty it
+    @pytest.mark.asyncio
+    async def test_status_and_clear(self):
+        _, token = await cache.get(1, ("admin_tests",))
+        await cache.set(1, ("admin_tests",), "value", token)
+        assert (await get_cache_status())["entries"] >= 1
+
+        assert await clear_cache() == "OK"
+        assert (await get_cache_status())["entries"] == 0
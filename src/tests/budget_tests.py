@@ -1,6 +1,12 @@
+import fastapi
 import pytest
 from http.client import HTTPException
-from src.api.budget import NewBudget, create_budget, update_budget, is_first_day_of_month, is_last_day_of_month, is_valid_date
+from src.api.budget import BUDGET_CATEGORIES, NewBudget, create_budget, get_budgets, set_monthly_budget, get_monthly_budget, get_budget_history, update_budget, get_spending_series, MAX_SERIES_BUCKETS, compare_budgets_to_actual_spending, MAX_COMPARE_MONTHS, get_all_purchases_warranty, get_all_purchases_return, is_first_day_of_month, is_last_day_of_month, is_valid_date
+from src.api.statements import registry as statements
+from src.api.users import NewUser, create_user
+import datetime
+import sqlalchemy
+import uuid
 
 class TestNewBudget:
 
@@ -197,13 +203,14 @@ class TestNewBudget:
         assert budget.other == 1600
 
     # Updating an existing budget with valid integer values for some categories and None for others.
-    def test_update_budget_with_valid_integer_values_and_none(self):
+    @pytest.mark.asyncio
+    async def test_update_budget_with_valid_integer_values_and_none(self):
         budget = NewBudget(groceries=100, clothing_and_accessories=None, electronics=300, home_and_garden=None, health_and_beauty=500, 
                            entertainment=None, travel=700, automotive=None, services=900, gifts_and_special_occasions=None, 
                            education=1100, fitness_and_sports=None, pets=1300, office_supplies=None, financial_services=1500, 
                            other=None)
     
-        result = update_budget(1, 1, budget)
+        result = await update_budget(1, 1, budget)
     
         assert result["budget_id"] == 1
         assert result["groceries"] == 100
@@ -320,14 +327,15 @@ class TestNewBudget:
         assert budget.other == 2147483647
 
     # Creating a new budget with a float value for one category and valid integer values for the rest.
-    def test_create_budget_with_float_value(self):
+    @pytest.mark.asyncio
+    async def test_create_budget_with_float_value(self):
         budget = NewBudget(groceries=100, clothing_and_accessories=200, electronics=300, home_and_garden=400, health_and_beauty=500, 
                            entertainment=600, travel=700, automotive=800, services=900, gifts_and_special_occasions=1000, 
                            education=1100, fitness_and_sports=1200, pets=1300, office_supplies=1400, financial_services=1500, 
                            other=1600.5)
 
         with pytest.raises(HTTPException) as exc_info:
-            create_budget(1, budget)
+            await create_budget(1, budget)
     
         assert exc_info.value.status_code == 400
         assert exc_info.value.detail == "Invalid budget"
@@ -459,11 +467,12 @@ class TestIsLastDayOfMonth:
 class TestCreateBudget:
 
     # create a budget for a user with valid input
-    def test_valid_input(self, mocker):
+    @pytest.mark.asyncio
+    async def test_valid_input(self, mocker):
         # Mock the necessary dependencies
         mocker.patch('src.api.auth.check_user_query')
-        mocker.patch('src.database.engine.begin')
-        mocker.patch('src.database.engine.execute')
+        mocker.patch('src.database.async_engine.begin')
+        mocker.patch('src.database.async_engine.execute')
 
         # Create a mock budget object
         budget = NewBudget(
@@ -486,17 +495,18 @@ class TestCreateBudget:
         )
 
         # Invoke the create_budget function
-        result = create_budget(1, budget)
+        result = await create_budget(1, budget)
 
         # Assert the expected result
         assert result == {"budget_id": 1}
 
     # create a budget for a user with all categories set to 0
-    def test_all_categories_zero(self, mocker):
+    @pytest.mark.asyncio
+    async def test_all_categories_zero(self, mocker):
         # Mock the necessary dependencies
         mocker.patch('src.api.auth.check_user_query')
-        mocker.patch('src.database.engine.begin')
-        mocker.patch('src.database.engine.execute')
+        mocker.patch('src.database.async_engine.begin')
+        mocker.patch('src.database.async_engine.execute')
 
         # Create a mock budget object with all categories set to 0
         budget = NewBudget(
@@ -519,17 +529,18 @@ class TestCreateBudget:
         )
 
         # Invoke the create_budget function
-        result = create_budget(1, budget)
+        result = await create_budget(1, budget)
 
         # Assert the expected result
         assert result == {"budget_id": 1}
 
     # create a budget for a user with some categories set to 0
-    def test_some_categories_zero(self, mocker):
+    @pytest.mark.asyncio
+    async def test_some_categories_zero(self, mocker):
         # Mock the necessary dependencies
         mocker.patch('src.api.auth.check_user_query')
-        mocker.patch('src.database.engine.begin')
-        mocker.patch('src.database.engine.execute')
+        mocker.patch('src.database.async_engine.begin')
+        mocker.patch('src.database.async_engine.execute')
 
         # Create a mock budget object with some categories set to 0
         budget = NewBudget(
@@ -552,17 +563,18 @@ class TestCreateBudget:
         )
 
         # Invoke the create_budget function
-        result = create_budget(1, budget)
+        result = await create_budget(1, budget)
 
         # Assert the expected result
         assert result == {"budget_id": 1}
 
     # create a budget for a non-existent user
-    def test_nonexistent_user(self, mocker):
+    @pytest.mark.asyncio
+    async def test_nonexistent_user(self, mocker):
         # Mock the necessary dependencies
         mocker.patch('src.api.auth.check_user_query')
-        mocker.patch('src.database.engine.begin')
-        mocker.patch('src.database.engine.execute')
+        mocker.patch('src.database.async_engine.begin')
+        mocker.patch('src.database.async_engine.execute')
 
         # Set the check_user_query mock to return None
         check_user_query_mock = mocker.patch('src.api.auth.check_user_query')
@@ -590,57 +602,37 @@ class TestCreateBudget:
 
         # Invoke the create_budget function and expect an HTTPException
         with pytest.raises(HTTPException) as exc:
-            create_budget(1, budget)
+            await create_budget(1, budget)
 
         # Assert the expected status code and detail message of the HTTPException
         assert exc.value.status_code == 404
         assert exc.value.detail == "User not found"
 
-    # create a budget for a user who already has a budget
-    def test_user_already_has_budget(self, mocker):
-        # Mock the necessary dependencies
-        mocker.patch('src.api.auth.check_user_query')
-        mocker.patch('src.database.engine.begin')
-        mocker.patch('src.database.engine.execute')
-
-        # Set the execute mock to return a non-None result
-        execute_mock = mocker.patch('src.database.engine.execute')
-        execute_mock.return_value.fetchone.return_value = (1,)
-
-        # Create a mock budget object
-        budget = NewBudget(
-            groceries=100,
-            clothing_and_accessories=50,
-            electronics=0,
-            home_and_garden=75,
-            health_and_beauty=0,
-            entertainment=0,
-            travel=0,
-            automotive=0,
-            services=0,
-            gifts_and_special_occasions=0,
-            education=0,
-            fitness_and_sports=50,
-            pets=0,
-            office_supplies=0,
-            financial_services=0,
-            other=0
-        )
+    # A second budget replaces the first from the current month on, and earlier months keep the first
+    @pytest.mark.asyncio
+    async def test_user_already_has_budget(self):
+        # Arrange
+        user_id = (await create_user(NewUser(name="Planner", email="planner@example.com")))["user_id"]
+        first = NewBudget(**{field: 100 for field in BUDGET_CATEGORIES})
+        second = NewBudget(**{field: 200 for field in BUDGET_CATEGORIES})
+        budget_id = (await create_budget(user_id, first))["budget_id"]
 
-        # Invoke the create_budget function and expect an HTTPException
-        with pytest.raises(HTTPException) as exc:
-            create_budget(1, budget)
+        # Act
+        replaced = await create_budget(user_id, second)
 
-        # Assert the expected status code and detail message of the HTTPException
-        assert exc.value.status_code == 400
-        assert exc.value.detail == "User already has a budget"
+        # Assert
+        this_month = datetime.date.today().strftime("%Y-%m")
+        assert replaced["budget_id"] == budget_id
+        assert (await get_monthly_budget(user_id, "2000-01"))["groceries"] == 100
+        assert (await get_monthly_budget(user_id, this_month))["groceries"] == 200
 
     # create a budget for a user with invalid input
-    def test_invalid_input(self, mocker):
+    @pytest.mark.asyncio
+    async def test_invalid_input(self, mocker):
         # Mock the necessary dependencies
         mocker.patch('src.api.auth.check_user_query')
-        mocker.patch('src.database.engine.begin')
-        mocker.patch('src.database.engine.execute')
+        mocker.patch('src.database.async_engine.begin')
+        mocker.patch('src.database.async_engine.execute')
 
         # Create a mock budget object with invalid input (negative amount)
         budget = NewBudget(
@@ -664,8 +656,225 @@ class TestCreateBudget:
 
         # Invoke the create_budget function and expect an HTTPException
         with pytest.raises(HTTPException) as exc:
-            create_budget(1, budget)
+            await create_budget(1, budget)
 
         # Assert the expected status code and detail message of the HTTPException
         assert exc.value.status_code == 400
-        assert exc.value.detail == "Invalid budget"
\ No newline at end of file
+        assert exc.value.detail == "Invalid budget"
+class TestUpdateBudget:
+
+    # Only the user's own budget is updated, and someone else's budget is not found
+    @pytest.mark.asyncio
+    async def test_other_users_budget(self):
+        owner_id = (await create_user(NewUser(name="Owner", email=f"owner-{uuid.uuid4().hex}@example.com")))["user_id"]
+        other_id = (await create_user(NewUser(name="Other", email=f"other-{uuid.uuid4().hex}@example.com")))["user_id"]
+        budget_id = (await create_budget(owner_id, NewBudget(**{field: 100 for field in BUDGET_CATEGORIES})))["budget_id"]
+
+        with pytest.raises(fastapi.HTTPException) as exc:
+            await update_budget(other_id, budget_id, NewBudget(**{field: 0 for field in BUDGET_CATEGORIES}))
+        assert exc.value.status_code == 404
+        assert exc.value.detail == "Budget not found"
+        assert (await get_budgets(owner_id))["groceries"] == 100
+
+        await update_budget(owner_id, budget_id, NewBudget(**{field: 50 for field in BUDGET_CATEGORIES}))
+        assert (await get_budgets(owner_id))["groceries"] == 50
+
+    # An unknown user is reported before the budget
+    @pytest.mark.asyncio
+    async def test_nonexistent_user(self):
+        with pytest.raises(fastapi.HTTPException) as exc:
+            await update_budget(999999, 1, NewBudget(**{field: 0 for field in BUDGET_CATEGORIES}))
+        assert exc.value.detail == "User not found"
+
+class TestSpendingRollup:
+
+    # Comparing to the budget joins budget lines to the monthly rollup rather than every purchase
+    def test_compare_reads_rollup(self):
+        sql = statements.get("budgets.compare").text
+        assert "FROM spending_rollup" in sql
+        assert "FROM budget_lines" in sql
+        assert "purchases" not in sql
+
+    # So does the all-time total per category
+    def test_categorized_reads_rollup(self):
+        sql = statements.get("budgets.categorized").text
+        assert "FROM spending_rollup" in sql
+        assert "JOIN transactions" not in sql
+
+
+class TestGetSpendingSeries:
+
+    # Only day, week and month buckets exist
+    @pytest.mark.asyncio
+    async def test_invalid_granularity(self):
+        with pytest.raises(fastapi.HTTPException) as exc:
+            await get_spending_series(1, "year", None, None, False)
+        assert exc.value.status_code == 400
+        assert exc.value.detail == "Invalid granularity"
+
+    # Dates must be YYYY-MM-DD
+    @pytest.mark.asyncio
+    async def test_invalid_dates(self):
+        with pytest.raises(fastapi.HTTPException) as exc:
+            await get_spending_series(1, "month", "2023-1-1", None, False)
+        assert exc.value.detail == "Invalid from"
+
+        with pytest.raises(fastapi.HTTPException) as exc:
+            await get_spending_series(1, "month", None, "tomorrow", False)
+        assert exc.value.detail == "Invalid to"
+
+    # from can't come after to
+    @pytest.mark.asyncio
+    async def test_reversed_range(self):
+        with pytest.raises(fastapi.HTTPException) as exc:
+            await get_spending_series(1, "month", "2023-05-01", "2023-01-31", False)
+        assert exc.value.detail == "from must be before to"
+
+    # Ranges are capped so a request can't ask for years of days
+    @pytest.mark.asyncio
+    async def test_too_many_buckets(self):
+        with pytest.raises(fastapi.HTTPException) as exc:
+            await get_spending_series(1, "day", "2020-01-01", "2023-01-01", False)
+        assert exc.value.detail == f"Too many buckets, at most {MAX_SERIES_BUCKETS} allowed"
+
+    # Every granularity and density is built up front
+    def test_statements_prebuilt(self):
+        for granularity in ["day", "week", "month"]:
+            sql = statements.get("budgets.series", granularity=granularity, dense=True).text
+            assert "generate_series" in sql
+        assert "FROM spending_rollup" in statements.get("budgets.series", granularity="month", dense=False).text
+
+
+class TestCompareBudgetsToActualSpending:
+
+    # month is YYYY-MM
+    @pytest.mark.asyncio
+    async def test_invalid_month(self):
+        for month in ["2023-1", "2023-13", "2023-01-01"]:
+            with pytest.raises(fastapi.HTTPException) as exc:
+                await compare_budgets_to_actual_spending(1, None, None, month)
+            assert exc.value.status_code == 400
+            assert exc.value.detail == "Invalid month"
+
+    # A month and a date range can't both be given
+    @pytest.mark.asyncio
+    async def test_month_and_range(self):
+        with pytest.raises(fastapi.HTTPException) as exc:
+            await compare_budgets_to_actual_spending(1, "2023-01-01", "2023-01-31", "2023-01")
+        assert exc.value.detail == "month can't be combined with date_from and date_to"
+
+    # The range has to run forwards and is capped
+    @pytest.mark.asyncio
+    async def test_range_limits(self):
+        with pytest.raises(fastapi.HTTPException) as exc:
+            await compare_budgets_to_actual_spending(1, "2023-03-01", "2023-01-31", None)
+        assert exc.value.detail == "date_from must be before date_to"
+
+        with pytest.raises(fastapi.HTTPException) as exc:
+            await compare_budgets_to_actual_spending(1, "2000-01-01", "2023-01-31", None)
+        assert exc.value.detail == f"Too many months, at most {MAX_COMPARE_MONTHS} allowed"
+
+    # A failed lookup is a 500, not a month without a budget
+    @pytest.mark.asyncio
+    async def test_database_error(self, mocker):
+        mocker.patch("src.api.budget.statements.get", return_value=sqlalchemy.text("SELECT 1 / 0 AS category"))
+        with pytest.raises(fastapi.HTTPException) as exc:
+            await compare_budgets_to_actual_spending(1, None, None, "1999-01")
+        assert exc.value.status_code == 500
+        assert exc.value.detail == "Database error"
+
+class TestMonthlyBudgets:
+
+    # Budgets set for a month apply from it until the next month with one, and earlier months keep theirs
+    @pytest.mark.asyncio
+    async def test_set_and_get(self):
+        # Arrange
+        user_id = (await create_user(NewUser(name="Saver", email="saver@example.com")))["user_id"]
+        await create_budget(user_id, NewBudget(**{field: 100 for field in BUDGET_CATEGORIES}))
+
+        # Act
+        await set_monthly_budget(user_id, "2023-03", NewBudget(**{field: 300 for field in BUDGET_CATEGORIES}))
+        await set_monthly_budget(user_id, "2023-06", NewBudget(**{field: 600 for field in BUDGET_CATEGORIES}))
+
+        # Assert
+        assert (await get_monthly_budget(user_id, "2023-02"))["travel"] == 100
+        assert (await get_monthly_budget(user_id, "2023-03"))["travel"] == 300
+        assert (await get_monthly_budget(user_id, "2023-05"))["travel"] == 300
+        assert (await get_monthly_budget(user_id, "2024-01"))["travel"] == 600
+        history = await get_budget_history(user_id)
+        assert [entry["month"] for entry in history] == [None, "2023-03", "2023-06"]
+        assert history[1]["budget"]["pets"] == 300
+
+    # Setting a month again replaces it
+    @pytest.mark.asyncio
+    async def test_set_twice(self):
+        user_id = (await create_user(NewUser(name="Changer", email="changer@example.com")))["user_id"]
+        await set_monthly_budget(user_id, "2023-03", NewBudget(**{field: 300 for field in BUDGET_CATEGORIES}))
+        await set_monthly_budget(user_id, "2023-03", NewBudget(**{field: 350 for field in BUDGET_CATEGORIES}))
+        assert (await get_monthly_budget(user_id, "2023-03"))["other"] == 350
+        assert len(await get_budget_history(user_id)) == 1
+
+    # Months before any budget have none
+    @pytest.mark.asyncio
+    async def test_no_budget_yet(self):
+        user_id = (await create_user(NewUser(name="Newcomer", email="newcomer@example.com")))["user_id"]
+        await set_monthly_budget(user_id, "2023-03", NewBudget(**{field: 300 for field in BUDGET_CATEGORIES}))
+        with pytest.raises(fastapi.HTTPException) as exc:
+            await get_monthly_budget(user_id, "2023-02")
+        assert exc.value.status_code == 404
+
+    # month is YYYY-MM and every category needs a non-negative amount
+    @pytest.mark.asyncio
+    async def test_invalid_input(self):
+        budget = NewBudget(**{field: 100 for field in BUDGET_CATEGORIES})
+        with pytest.raises(fastapi.HTTPException) as exc:
+            await set_monthly_budget(1, "2023-3", budget)
+        assert exc.value.detail == "Invalid month"
+
+        with pytest.raises(fastapi.HTTPException) as exc:
+            await set_monthly_budget(1, "2023-03", NewBudget(**{**vars(budget), "pets": -1}))
+        assert exc.value.detail == "Invalid budget"
+
+    # A failed lookup is a 500, not a missing budget or an empty history
+    @pytest.mark.asyncio
+    async def test_database_error(self, mocker):
+        mocker.patch("src.api.budget.statements.get", return_value=sqlalchemy.text("SELECT 1 / 0 AS field"))
+        with pytest.raises(fastapi.HTTPException) as exc:
+            await get_monthly_budget(1, "1999-01")
+        assert exc.value.status_code == 500
+        with pytest.raises(fastapi.HTTPException) as exc:
+            await get_budget_history(1)
+        assert exc.value.status_code == 500
+
+    # Only the user's own budget can be set
+    @pytest.mark.asyncio
+    async def test_nonexistent_user(self):
+        with pytest.raises(fastapi.HTTPException) as exc:
+            await set_monthly_budget(999999, "2023-03", NewBudget(**{field: 100 for field in BUDGET_CATEGORIES}))
+        assert exc.value.status_code == 404
+
+class TestDeadlines:
+
+    # The window has to be at least a day and at most MAX_WITHIN_DAYS
+    @pytest.mark.asyncio
+    async def test_invalid_within_days(self):
+        with pytest.raises(fastapi.HTTPException) as exc:
+            await get_all_purchases_warranty(1, 0, 50, None, False)
+        assert exc.value.status_code == 400
+        assert exc.value.detail == "Invalid within_days"
+
+    # Pages are bounded
+    @pytest.mark.asyncio
+    async def test_invalid_limit(self):
+        with pytest.raises(fastapi.HTTPException) as exc:
+            await get_all_purchases_return(1, 7, 0, None, False)
+        assert exc.value.detail == "Invalid limit"
+
+    # Both lookups filter on purchases.user_id with the indexed date condition, and reach transactions only by primary key to skip deleted ones
+    def test_statements_use_user_id(self):
+        for name, column in [("budgets.warranty", "warranty_date"), ("budgets.return", "return_date")]:
+            sql = statements.get(name, paging="offset").text
+            assert "WHERE p.user_id = :user_id" in sql
+            assert f"p.{column} ~ '^\\d{{4}}-\\d{{2}}-\\d{{2}}$'" in sql
+            assert "JOIN transactions AS t ON t.id = p.transaction_id AND t.deleted_at IS NULL" in sql
+            assert "t.user_id" not in sql
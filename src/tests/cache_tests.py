@@ -0,0 +1,242 @@
+from src.api.cache import UserCache, CacheBackend, MemoryBackend, RedisBackend, create_backend, MISSING
+import asyncio
+import datetime
+import pytest
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestUserCache:
+
+    # A value set for a user and key comes back until it expires
+    def test_hit_then_expire(self):
+        clock = FakeClock()
+        cache = UserCache(max_entries=10, ttl=60, clock=clock)
+        cache.set(1, ("budgets.get",), {"groceries": 100}, cache.token())
+
+        assert cache.get(1, ("budgets.get",)) == {"groceries": 100}
+        clock.now = 60
+        assert cache.get(1, ("budgets.get",)) is MISSING
+
+        stats = cache.stats()
+        assert stats["hits"] == 1
+        assert stats["misses"] == 1
+        assert stats["expirations"] == 1
+        assert stats["entries"] == 0
+
+    # Keys are per user, so one user's entry isn't another's
+    def test_keyed_by_user(self):
+        cache = UserCache()
+        cache.set(1, ("budgets.categorized",), [], cache.token())
+        assert cache.get(2, ("budgets.categorized",)) is MISSING
+
+    # The least recently used entry is evicted first
+    def test_lru_eviction(self):
+        cache = UserCache(max_entries=2)
+        cache.set(1, ("a",), "a", cache.token())
+        cache.set(1, ("b",), "b", cache.token())
+        cache.get(1, ("a",))
+        cache.set(1, ("c",), "c", cache.token())
+
+        assert cache.get(1, ("b",)) is MISSING
+        assert cache.get(1, ("a",)) == "a"
+        assert cache.get(1, ("c",)) == "c"
+        assert cache.stats()["evictions"] == 1
+
+    # Invalidating a user drops every entry of theirs and nobody else's
+    def test_invalidate(self):
+        cache = UserCache()
+        token = cache.token()
+        cache.set(1, ("a",), "a", token)
+        cache.set(1, ("b",), "b", token)
+        cache.set(2, ("a",), "a", token)
+
+        cache.invalidate(1)
+        assert cache.get(1, ("a",)) is MISSING
+        assert cache.get(1, ("b",)) is MISSING
+        assert cache.get(2, ("a",)) == "a"
+        assert cache.stats()["invalidations"] == 1
+
+    # A read that started before an invalidation isn't cached
+    def test_stale_set_ignored(self):
+        cache = UserCache()
+        token = cache.token()
+        cache.invalidate(1)
+        cache.set(1, ("a",), "old", token)
+
+        assert cache.get(1, ("a",)) is MISSING
+        assert cache.stats()["stale_sets"] == 1
+
+        cache.set(1, ("a",), "new", cache.token())
+        assert cache.get(1, ("a",)) == "new"
+
+    # Forgotten invalidation stamps still reject reads older than them
+    def test_dropped_stamps_stay_conservative(self):
+        cache = UserCache(max_entries=1)
+        token = cache.token()
+        cache.invalidate(1)
+        cache.invalidate(2)
+
+        cache.set(1, ("a",), "old", token)
+        assert cache.get(1, ("a",)) is MISSING
+
+    # Hit rate is undefined until something has been looked up
+    def test_stats_before_lookup(self):
+        assert UserCache().stats()["hit_rate"] is None
+
+
+class TestMemoryBackend:
+
+    # get hands out the token set needs, and a write in between makes it stale
+    @pytest.mark.asyncio
+    async def test_get_set_invalidate(self):
+        cache = MemoryBackend()
+        value, token = await cache.get(1, ("a",))
+        assert value is MISSING
+
+        await cache.invalidate(1)
+        await cache.set(1, ("a",), "old", token)
+        assert (await cache.get(1, ("a",)))[0] is MISSING
+
+        _, token = await cache.get(1, ("a",))
+        await cache.set(1, ("a",), "new", token)
+        assert (await cache.get(1, ("a",)))[0] == "new"
+        assert (await cache.stats())["backend"] == "memory"
+
+    # CACHE_BACKEND picks the backend, anything else is refused
+    def test_create_backend(self):
+        assert isinstance(create_backend("memory"), MemoryBackend)
+        with pytest.raises(ValueError):
+            create_backend("memcached")
+
+    # A backend missing part of the interface can't be created at all
+    def test_incomplete_backend(self):
+        class NoStats(CacheBackend):
+            async def get(self, user_id, key):
+                return MISSING, None
+
+            async def set(self, user_id, key, value, token):
+                pass
+
+            async def invalidate(self, user_id):
+                pass
+
+            async def clear(self):
+                pass
+
+        with pytest.raises(TypeError):
+            NoStats()
+
+
+class FakeWorkers:
+    """Two workers' redis backends talking to one fake Redis server."""
+
+    def __init__(self, fakeredis, **kwargs):
+        server = fakeredis.FakeServer()
+        self.workers = [
+            RedisBackend(fakeredis.aioredis.FakeRedis(server=server), prefix="test", **kwargs)
+            for _ in range(2)
+        ]
+
+    async def __aenter__(self):
+        for worker in self.workers:
+            await worker.start()
+        return self.workers
+
+    async def __aexit__(self, *exc):
+        for worker in self.workers:
+            await worker.close()
+
+
+async def settle(condition):
+    # pub/sub messages arrive in the background
+    for _ in range(100):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("condition not met")
+
+
+class TestRedisBackend:
+
+    # A value one worker caches is a hit on the other
+    @pytest.mark.asyncio
+    async def test_shared_between_workers(self):
+        fakeredis = pytest.importorskip("fakeredis")
+        async with FakeWorkers(fakeredis) as (first, second):
+            value, token = await first.get(1, ("budgets.get",))
+            assert value is MISSING
+            await first.set(1, ("budgets.get",), {"groceries": 100}, token)
+
+            assert (await second.get(1, ("budgets.get",)))[0] == {"groceries": 100}
+            assert (await second.stats())["hits"] == 1
+
+    # Values come back the way the API would serialize them
+    @pytest.mark.asyncio
+    async def test_dates_become_strings(self):
+        fakeredis = pytest.importorskip("fakeredis")
+        async with FakeWorkers(fakeredis) as (first, second):
+            key = ("budgets.series", datetime.date(2023, 1, 1))
+            _, token = await first.get(1, key)
+            await first.set(1, key, [{"bucket": datetime.date(2023, 1, 1)}], token)
+
+            assert (await second.get(1, key))[0] == [{"bucket": "2023-01-01"}]
+
+    # Invalidating on one worker drops the entry on every worker, l1 included
+    @pytest.mark.asyncio
+    async def test_invalidation_fans_out(self):
+        fakeredis = pytest.importorskip("fakeredis")
+        async with FakeWorkers(fakeredis) as (first, second):
+            _, token = await first.get(1, ("a",))
+            await first.set(1, ("a",), "old", token)
+            assert (await second.get(1, ("a",)))[0] == "old"
+            assert (await second.get(1, ("a",)))[0] == "old"
+            assert (await second.stats())["l1_hits"] == 1
+
+            await first.invalidate(1)
+            await settle(lambda: second._stats["remote_invalidations"] == 1)
+            assert (await second.get(1, ("a",)))[0] is MISSING
+
+    # A read that started before another worker's invalidation isn't cached
+    @pytest.mark.asyncio
+    async def test_stale_set_across_workers(self):
+        fakeredis = pytest.importorskip("fakeredis")
+        async with FakeWorkers(fakeredis) as (first, second):
+            _, token = await first.get(1, ("a",))
+            await second.invalidate(1)
+            await first.set(1, ("a",), "old", token)
+
+            assert (await first.get(1, ("a",)))[0] is MISSING
+            assert (await first.stats())["stale_sets"] == 1
+
+    # Entries expire after the shared TTL
+    @pytest.mark.asyncio
+    async def test_expiry(self):
+        fakeredis = pytest.importorskip("fakeredis")
+        clock = FakeClock()
+        async with FakeWorkers(fakeredis, clock=clock) as (first, second):
+            _, token = await first.get(1, ("a",))
+            await first.set(1, ("a",), "value", token)
+            clock.now = 60
+
+            assert (await second.get(1, ("a",)))[0] is MISSING
+            assert (await second.stats())["expirations"] == 1
+
+    # clear empties every worker's entries
+    @pytest.mark.asyncio
+    async def test_clear(self):
+        fakeredis = pytest.importorskip("fakeredis")
+        async with FakeWorkers(fakeredis) as (first, second):
+            _, token = await first.get(1, ("a",))
+            await first.set(1, ("a",), "value", token)
+            await second.get(1, ("a",))
+
+            await first.clear()
+            await settle(lambda: second._stats["remote_invalidations"] == 1)
+            assert (await second.get(1, ("a",)))[0] is MISSING
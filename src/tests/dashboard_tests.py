@@ -0,0 +1,22 @@
+import pytest
+import fastapi
+from src.api.dashboard import get_dashboard, MAX_LIMIT
+from src.api.statements import registry as statements
+
+
+class TestGetDashboard:
+
+    # limit has to be between 1 and MAX_LIMIT
+    @pytest.mark.asyncio
+    async def test_invalid_limit(self):
+        for limit in [0, -1, MAX_LIMIT + 1]:
+            with pytest.raises(fastapi.HTTPException) as exc:
+                await get_dashboard(1, limit)
+            assert exc.value.status_code == 400
+            assert exc.value.detail == "Invalid limit"
+
+    # Every section comes from the same statement
+    def test_single_statement(self):
+        sql = statements.get("dashboard.get").text
+        for section in ["budget", "comparison", "categories", "warranties", "returns", "recent_transactions"]:
+            assert f"AS {section}" in sql
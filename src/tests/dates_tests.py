@@ -0,0 +1,69 @@
+from datetime import date
+from src.api.dates import parse_date, is_valid_date, is_first_day_of_month, is_last_day_of_month
+from src.api.dates import bucket_start, shift_buckets, count_buckets
+
+
+class TestParseDate:
+
+    # A zero padded YYYY-MM-DD string parses to a date
+    def test_valid_date(self):
+        assert parse_date("2023-02-28") == date(2023, 2, 28)
+
+    # Unpadded months and days are rejected even though strptime accepts them
+    def test_unpadded(self):
+        assert parse_date("2023-1-05") is None
+        assert parse_date("2023-01-5") is None
+
+    # Dates that don't exist are rejected
+    def test_impossible_date(self):
+        assert parse_date("2023-02-29") is None
+
+    # Anything that isn't a string is rejected instead of raising
+    def test_non_string(self):
+        assert parse_date(None) is None
+        assert parse_date(20230101) is None
+        assert not is_valid_date(None)
+
+
+class TestMonthBoundaries:
+
+    # Accepts date objects as well as strings
+    def test_accepts_dates(self):
+        assert is_first_day_of_month(date(2024, 3, 1))
+        assert is_last_day_of_month(date(2024, 2, 29))
+        assert not is_last_day_of_month(date(2023, 12, 30))
+
+    # December rolls over into the next year
+    def test_end_of_year(self):
+        assert is_last_day_of_month("2023-12-31")
+
+    # Invalid input is never a month boundary
+    def test_invalid(self):
+        assert not is_first_day_of_month("")
+        assert not is_last_day_of_month("2022-02-30")
+
+
+class TestBuckets:
+
+    # Weeks start on Monday and months on the first, like date_trunc
+    def test_bucket_start(self):
+        assert bucket_start(date(2023, 3, 15), "day") == date(2023, 3, 15)
+        assert bucket_start(date(2023, 3, 15), "week") == date(2023, 3, 13)
+        assert bucket_start(date(2023, 3, 13), "week") == date(2023, 3, 13)
+        assert bucket_start(date(2023, 3, 15), "month") == date(2023, 3, 1)
+
+    # Shifting by months crosses year boundaries in both directions
+    def test_shift_months(self):
+        assert shift_buckets(date(2023, 12, 1), "month", 1) == date(2024, 1, 1)
+        assert shift_buckets(date(2023, 3, 1), "month", -11) == date(2022, 4, 1)
+
+    # Days and weeks shift by whole days
+    def test_shift_days_and_weeks(self):
+        assert shift_buckets(date(2024, 2, 28), "day", 2) == date(2024, 3, 1)
+        assert shift_buckets(date(2023, 3, 13), "week", -2) == date(2023, 2, 27)
+
+    # Both ends of the range count
+    def test_count_buckets(self):
+        assert count_buckets(date(2023, 1, 1), date(2023, 1, 1), "day") == 1
+        assert count_buckets(date(2023, 1, 2), date(2023, 1, 30), "week") == 5
+        assert count_buckets(date(2022, 4, 1), date(2023, 3, 1), "month") == 12
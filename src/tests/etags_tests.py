@@ -0,0 +1,71 @@
+from src.api.etags import make_etag, request_shape, etag_matches, not_modified
+from starlette.requests import Request
+import pytest
+
+
+def make_request(path="/user/1/budgets/", query=b"", if_none_match=None):
+    headers = [(b"if-none-match", if_none_match.encode())] if if_none_match is not None else []
+    return Request({"type": "http", "method": "GET", "path": path, "query_string": query, "headers": headers})
+
+
+class TestEtagMatches:
+
+    # Weak and strong forms of the same tag match, in a list or alone
+    def test_weak_comparison(self):
+        etag = make_etag(1, 3, "abc")
+        assert etag == 'W/"u1-v3-abc"'
+        assert etag_matches(etag, etag)
+        assert etag_matches('"u1-v3-abc"', etag)
+        assert etag_matches('"other", W/"u1-v3-abc"', etag)
+        assert etag_matches("*", etag)
+
+    # A different version, or no header, doesn't match
+    def test_no_match(self):
+        etag = make_etag(1, 3, "abc")
+        assert not etag_matches(make_etag(1, 2, "abc"), etag)
+        assert not etag_matches(None, etag)
+
+
+class TestRequestShape:
+
+    # Query strings in any order are the same representation
+    def test_query_order(self):
+        assert request_shape(make_request(query=b"a=1&b=2")) == request_shape(make_request(query=b"b=2&a=1"))
+
+    # Different queries, paths or extras are different representations
+    def test_differs(self):
+        shape = request_shape(make_request(query=b"a=1"))
+        assert shape != request_shape(make_request(query=b"a=2"))
+        assert shape != request_shape(make_request(path="/user/1/transactions/", query=b"a=1"))
+        assert shape != request_shape(make_request(query=b"a=1"), "2023-01-01")
+
+
+class TestNotModified:
+
+    # A current ETag is answered with an empty 304
+    @pytest.mark.asyncio
+    async def test_current(self, mocker):
+        mocker.patch("src.api.etags.data_version", return_value=3)
+        request = make_request()
+        etag = make_etag(1, 3, request_shape(request))
+
+        response = await not_modified(1, make_request(if_none_match=etag), None)
+        assert response.status_code == 304
+        assert response.headers["etag"] == etag
+
+    # An out of date ETag gets the current one on the response
+    @pytest.mark.asyncio
+    async def test_stale(self, mocker):
+        mocker.patch("src.api.etags.data_version", return_value=4)
+        request = make_request(if_none_match=make_etag(1, 3, request_shape(make_request())))
+        response = mocker.Mock(headers={})
+
+        assert await not_modified(1, request, response) is None
+        assert response.headers["ETag"] == make_etag(1, 4, request_shape(request))
+
+    # Unknown users and direct calls are left to the endpoint
+    @pytest.mark.asyncio
+    async def test_skipped(self, mocker):
+        mocker.patch("src.api.etags.data_version", return_value=None)
+        assert await not_modified(99, make_request(), None) is None
+        assert await not_modified(1, None, None) is None
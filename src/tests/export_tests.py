@@ -0,0 +1,45 @@
+import json
+import pytest
+import fastapi
+from datetime import date
+from src.api.export import COLUMNS, csv_chunk, ndjson_chunk, export_history
+
+ROW = (1, "Store, Inc.", 'said "hi"', date(2023, 1, 5), 2, "Thing", 500, "Groceries", 2, "", None)
+
+
+class TestCsvChunk:
+
+    # The header is only written for the first chunk
+    def test_header(self):
+        assert csv_chunk([], header=True).strip() == ",".join(COLUMNS)
+        assert csv_chunk([]) == ""
+
+    # Commas and quotes are escaped and NULLs become empty fields
+    def test_quoting(self):
+        line = csv_chunk([ROW]).strip()
+        assert line == '1,"Store, Inc.","said ""hi""",2023-01-05,2,Thing,500,Groceries,2,,'
+
+
+class TestNdjsonChunk:
+
+    # One JSON object per line, keyed by column, with dates as YYYY-MM-DD
+    def test_lines(self):
+        chunk = ndjson_chunk([ROW, ROW])
+        lines = chunk.splitlines()
+        assert len(lines) == 2 and chunk.endswith("\n")
+
+        record = json.loads(lines[0])
+        assert list(record) == COLUMNS
+        assert record["date"] == "2023-01-05"
+        assert record["return_date"] is None
+
+
+class TestExportHistory:
+
+    # Only csv and ndjson are supported
+    @pytest.mark.asyncio
+    async def test_invalid_format(self):
+        with pytest.raises(fastapi.HTTPException) as exc:
+            await export_history(1, "xml")
+        assert exc.value.status_code == 400
+        assert exc.value.detail == "Invalid format"
@@ -0,0 +1,128 @@
+from src.api.idempotency import IdempotencyMiddleware, request_hash
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+import asyncio
+import httpx
+import pytest
+import uuid
+
+
+def counting_app(delay=0.0, fail_first=False):
+    app = FastAPI()
+    app.add_middleware(IdempotencyMiddleware, poll=0.01, sweep_interval=3600)
+    app.state.calls = 0
+
+    @app.post("/things")
+    async def create_thing(payload: dict):
+        app.state.calls += 1
+        await asyncio.sleep(delay)
+        if fail_first and app.state.calls == 1:
+            return JSONResponse({"detail": "boom"}, status_code=500)
+        return {"thing_id": app.state.calls, "payload": payload}
+
+    @app.get("/things")
+    async def get_things():
+        app.state.calls += 1
+        return []
+
+    return app
+
+
+def client(app):
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test",
+                             headers={"access_token": "demo-key"})
+
+
+class TestRequestHash:
+
+    # A new multipart boundary doesn't make a retry look like a different request
+    def test_ignores_multipart_boundary(self):
+        first = request_hash("POST", "/upload_receipt", b"user_id=1", "multipart/form-data; boundary=aaa",
+                             b"--aaa\r\nreceipt bytes\r\n--aaa--")
+        retry = request_hash("POST", "/upload_receipt", b"user_id=1", "multipart/form-data; boundary=bbb",
+                             b"--bbb\r\nreceipt bytes\r\n--bbb--")
+        assert first == retry
+
+    # The path, query and body all count
+    def test_differs_by_request(self):
+        base = request_hash("POST", "/things", b"", "application/json", b"{}")
+        assert base != request_hash("POST", "/other", b"", "application/json", b"{}")
+        assert base != request_hash("POST", "/things", b"user_id=2", "application/json", b"{}")
+        assert base != request_hash("POST", "/things", b"", "application/json", b"{\"a\": 1}")
+
+
+class TestIdempotencyMiddleware:
+
+    # A retry with the same key gets the first response back without running again
+    @pytest.mark.asyncio
+    async def test_replays_first_response(self):
+        app = counting_app()
+        key = uuid.uuid4().hex
+        async with client(app) as http:
+            first = await http.post("/things", json={"a": 1}, headers={"Idempotency-Key": key})
+            retry = await http.post("/things", json={"a": 1}, headers={"Idempotency-Key": key})
+
+        assert app.state.calls == 1
+        assert retry.status_code == first.status_code == 200
+        assert retry.json() == first.json()
+        assert retry.headers["idempotent-replayed"] == "true"
+        assert "idempotent-replayed" not in first.headers
+
+    # Duplicates sent at the same time wait for the first instead of running again
+    @pytest.mark.asyncio
+    async def test_concurrent_duplicates_wait(self):
+        app = counting_app(delay=0.2)
+        key = uuid.uuid4().hex
+        async with client(app) as http:
+            responses = await asyncio.gather(*[
+                http.post("/things", json={"a": 1}, headers={"Idempotency-Key": key}) for _ in range(3)])
+
+        assert app.state.calls == 1
+        assert len({response.text for response in responses}) == 1
+
+    # Reusing a key for a different request is refused
+    @pytest.mark.asyncio
+    async def test_key_reused_for_different_request(self):
+        app = counting_app()
+        key = uuid.uuid4().hex
+        async with client(app) as http:
+            await http.post("/things", json={"a": 1}, headers={"Idempotency-Key": key})
+            other = await http.post("/things", json={"a": 2}, headers={"Idempotency-Key": key})
+
+        assert other.status_code == 422
+        assert app.state.calls == 1
+
+    # A server error isn't replayed, the retry runs again
+    @pytest.mark.asyncio
+    async def test_server_error_releases_key(self):
+        app = counting_app(fail_first=True)
+        key = uuid.uuid4().hex
+        async with client(app) as http:
+            first = await http.post("/things", json={"a": 1}, headers={"Idempotency-Key": key})
+            retry = await http.post("/things", json={"a": 1}, headers={"Idempotency-Key": key})
+
+        assert first.status_code == 500
+        assert retry.status_code == 200
+        assert app.state.calls == 2
+
+    # Requests without a key, and anything but POST, are left alone
+    @pytest.mark.asyncio
+    async def test_passthrough(self):
+        app = counting_app()
+        async with client(app) as http:
+            await http.post("/things", json={"a": 1})
+            await http.post("/things", json={"a": 1})
+            await http.get("/things", headers={"Idempotency-Key": uuid.uuid4().hex})
+            await http.get("/things", headers={"Idempotency-Key": uuid.uuid4().hex})
+
+        assert app.state.calls == 4
+
+    # Keys have to fit in the table
+    @pytest.mark.asyncio
+    async def test_key_too_long(self):
+        app = counting_app()
+        async with client(app) as http:
+            response = await http.post("/things", json={"a": 1}, headers={"Idempotency-Key": "k" * 256})
+
+        assert response.status_code == 400
+        assert app.state.calls == 0
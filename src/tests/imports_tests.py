@@ -0,0 +1,164 @@
+from src.api.imports import read_lines, parse_csv, parse_ofx, parse_amount, to_price, detect_format, import_statement, Rejected
+from src.api.users import NewUser, create_user
+from src.api.transactions import NewTransaction, create_transaction, get_transactions
+from src.api.statements import registry as statements
+from starlette.datastructures import UploadFile
+from decimal import Decimal
+from datetime import date
+import fastapi
+import io
+import pytest
+import sqlalchemy
+import uuid
+
+
+async def iterate(lines):
+    for line in lines:
+        yield line
+
+
+async def collect(rows):
+    return [row async for row in rows]
+
+
+def upload(filename, text):
+    return UploadFile(filename, file=io.BytesIO(text.encode()))
+
+
+class TestReadLines:
+
+    # Lines split across reads, and CRLF endings, come out whole
+    @pytest.mark.asyncio
+    async def test_small_reads(self):
+        file = upload("a.csv", "﻿one\r\ntwo\nthree")
+        assert await collect(read_lines(file, read_size=3)) == ["one", "two", "three"]
+
+
+class TestAmounts:
+
+    # Currency signs, thousands separators and parentheses are understood
+    def test_parse_amount(self):
+        assert parse_amount("$1,234.50") == Decimal("1234.50")
+        assert parse_amount("(3.10)") == Decimal("-3.10")
+        with pytest.raises(Rejected):
+            parse_amount("abc")
+
+    # Only money going out becomes a price, in cents
+    def test_to_price(self):
+        assert to_price(Decimal("-12.345"), "negative") == 1234
+        assert to_price(Decimal("12.00"), "positive") == 1200
+        with pytest.raises(Rejected):
+            to_price(Decimal("12.00"), "negative")
+
+
+class TestParseCsv:
+
+    # Rows become statement rows, bad ones are rejected with their line number
+    @pytest.mark.asyncio
+    async def test_rows_and_rejects(self):
+        rows = await collect(parse_csv(iterate([
+            "Date,Payee,Amount,Memo",
+            "2023-01-05,Coffee,-4.50,latte",
+            "01/06/2023,Salary,2000.00,",
+            "not a date,Shop,-1.00,",
+        ])))
+        assert rows[0][1].merchant == "Coffee"
+        assert rows[0][1].description == "latte"
+        assert rows[0][1].date == date(2023, 1, 5)
+        assert rows[0][1].price == 450
+        assert rows[1] == (3, None, "Not a debit")
+        assert rows[2] == (4, None, "Invalid date")
+
+    # Identical rows without ids get different derived ids
+    @pytest.mark.asyncio
+    async def test_derived_ids(self):
+        rows = await collect(parse_csv(iterate(["date,merchant,amount", "2023-01-05,A,-1", "2023-01-05,A,-1"])))
+        assert rows[0][1].external_id != rows[1][1].external_id
+
+    # Debit and credit columns work without an amount column
+    @pytest.mark.asyncio
+    async def test_debit_column(self):
+        rows = await collect(parse_csv(iterate(["Date,Description,Debit,Credit,Transaction ID", "2023-01-05,Shop,7.25,,T1"])))
+        assert rows[0][1].price == 725
+        assert rows[0][1].external_id == "T1"
+
+    # A file without the needed columns is refused
+    @pytest.mark.asyncio
+    async def test_missing_column(self):
+        with pytest.raises(fastapi.HTTPException):
+            await collect(parse_csv(iterate(["Date,Amount", "2023-01-05,-1"])))
+
+
+class TestParseOfx:
+
+    # Unclosed SGML elements, on one line or many, are read per STMTTRN
+    @pytest.mark.asyncio
+    async def test_transactions(self):
+        rows = await collect(parse_ofx(iterate([
+            "<OFX><BANKTRANLIST>",
+            "<STMTTRN><DTPOSTED>20230105120000[-8:PST]<TRNAMT>-12.34<FITID>A1<NAME>Coffee &amp; Co</STMTTRN>",
+            "<STMTTRN>",
+            "<DTPOSTED>20230106",
+            "<TRNAMT>100.00",
+            "<NAME>Refund",
+            "</STMTTRN>",
+            "</BANKTRANLIST></OFX>",
+        ])))
+        assert rows[0][1].merchant == "Coffee & Co"
+        assert rows[0][1].external_id == "A1"
+        assert rows[0][1].price == 1234
+        assert rows[1] == (3, None, "Not a debit")
+
+
+class TestImportStatement:
+
+    # The format comes from the file name
+    def test_detect_format(self):
+        assert detect_format("Statement.QFX") == "ofx"
+        assert detect_format("january.csv") == "csv"
+        assert detect_format("notes.txt") is None
+
+    # Importing the same statement twice only inserts it once, and transactions entered by hand don't count as duplicates
+    @pytest.mark.asyncio
+    async def test_duplicates(self):
+        user_id = (await create_user(NewUser(name="Importer", email=f"importer-{uuid.uuid4().hex}@example.com")))["user_id"]
+        merchant = f"Import-{uuid.uuid4().hex}"
+        await create_transaction(user_id, NewTransaction(merchant=merchant, description="by hand", date="2023-01-05"))
+        text = f"date,merchant,amount\n2023-01-05,{merchant},-1.00\n2023-01-06,{merchant},-2.00\n2023-01-07,{merchant},3.00\n"
+
+        first = await import_statement(user_id, upload("a.csv", text))
+        assert first["inserted"] == 2
+        assert first["rejected"] == 1
+
+        second = await import_statement(user_id, upload("a.csv", text))
+        assert second["inserted"] == 0
+        assert second["duplicates"] == 2
+        assert len(await get_transactions(user_id)) == 3
+
+    # An unknown user is refused before the file is read
+    @pytest.mark.asyncio
+    async def test_unknown_user(self):
+        file = upload("a.csv", "date,merchant,amount\n2023-01-05,Shop,-1.00\n")
+        with pytest.raises(fastapi.HTTPException) as exc:
+            await import_statement(999999, file)
+        assert exc.value.status_code == 404
+        assert file.file.tell() == 0
+
+    # A failed merge is a 500, not an import of nothing
+    @pytest.mark.asyncio
+    async def test_database_error(self, mocker):
+        user_id = (await create_user(NewUser(name="Importer", email=f"importer-{uuid.uuid4().hex}@example.com")))["user_id"]
+        real_get = statements.get
+        mocker.patch("src.api.imports.statements.get", side_effect=lambda name, **variant:
+                     sqlalchemy.text("SELECT 1 / 0") if name == "imports.merge" else real_get(name, **variant))
+
+        with pytest.raises(fastapi.HTTPException) as exc:
+            await import_statement(user_id, upload("a.csv", "date,merchant,amount\n2023-01-05,Shop,-1.00\n"))
+        assert exc.value.status_code == 500
+        assert exc.value.detail == "Database error"
+
+    # Unknown formats are refused before anything is read
+    @pytest.mark.asyncio
+    async def test_invalid_format(self):
+        with pytest.raises(fastapi.HTTPException):
+            await import_statement(1, upload("a.txt", ""))
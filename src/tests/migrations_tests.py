@@ -0,0 +1,95 @@
+import pytest
+from src.migrations import MigrationError, checksum, load_migrations, pending_migrations
+
+
+def write(directory, filename, sql):
+    (directory / filename).write_text(sql)
+
+
+class TestLoadMigrations:
+
+    # Migrations come back ordered by version, not by filename
+    def test_orders_by_version(self, tmp_path):
+        write(tmp_path, "10_later.sql", "SELECT 10;")
+        write(tmp_path, "0002_second.sql", "SELECT 2;")
+        write(tmp_path, "0001_first.sql", "SELECT 1;")
+
+        migrations = load_migrations(tmp_path)
+        assert [migration.version for migration in migrations] == [1, 2, 10]
+        assert migrations[0].name == "first"
+        assert migrations[0].checksum == checksum("SELECT 1;")
+
+    # Files that aren't .sql are ignored
+    def test_ignores_other_files(self, tmp_path):
+        write(tmp_path, "0001_first.sql", "SELECT 1;")
+        write(tmp_path, "README.md", "notes")
+
+        assert len(load_migrations(tmp_path)) == 1
+
+    # A .sql file without a version prefix is rejected
+    def test_invalid_filename(self, tmp_path):
+        write(tmp_path, "first.sql", "SELECT 1;")
+
+        with pytest.raises(MigrationError):
+            load_migrations(tmp_path)
+
+    # Two files can't share a version number
+    def test_duplicate_version(self, tmp_path):
+        write(tmp_path, "0001_first.sql", "SELECT 1;")
+        write(tmp_path, "1_again.sql", "SELECT 1;")
+
+        with pytest.raises(MigrationError):
+            load_migrations(tmp_path)
+
+    # The migrations that ship with the app load and are numbered without gaps
+    def test_bundled_migrations(self):
+        migrations = load_migrations()
+        assert [migration.version for migration in migrations] == list(range(1, len(migrations) + 1))
+
+
+class TestChecksum:
+
+    # Line endings don't change the checksum
+    def test_ignores_line_endings(self):
+        assert checksum("SELECT 1;\r\nSELECT 2;\r\n") == checksum("SELECT 1;\nSELECT 2;\n")
+
+    # Any edit to the SQL does
+    def test_detects_edits(self):
+        assert checksum("SELECT 1;") != checksum("SELECT 2;")
+
+
+class TestPendingMigrations:
+
+    # Only migrations that haven't been applied are returned, in order
+    def test_returns_unapplied(self, tmp_path):
+        for version in range(1, 4):
+            write(tmp_path, f"000{version}_m{version}.sql", f"SELECT {version};")
+        migrations = load_migrations(tmp_path)
+
+        pending = pending_migrations(migrations, {1: migrations[0].checksum})
+        assert [migration.version for migration in pending] == [2, 3]
+
+    # target stops at the given version
+    def test_target(self, tmp_path):
+        for version in range(1, 4):
+            write(tmp_path, f"000{version}_m{version}.sql", f"SELECT {version};")
+        migrations = load_migrations(tmp_path)
+
+        pending = pending_migrations(migrations, {}, target=2)
+        assert [migration.version for migration in pending] == [1, 2]
+
+    # A migration edited after it was applied is refused
+    def test_modified_migration(self, tmp_path):
+        write(tmp_path, "0001_first.sql", "SELECT 1;")
+        migrations = load_migrations(tmp_path)
+
+        with pytest.raises(MigrationError):
+            pending_migrations(migrations, {1: checksum("SELECT 'original';")})
+
+    # A migration recorded in the database but missing on disk is refused
+    def test_missing_migration(self, tmp_path):
+        write(tmp_path, "0001_first.sql", "SELECT 1;")
+        migrations = load_migrations(tmp_path)
+
+        with pytest.raises(MigrationError):
+            pending_migrations(migrations, {1: migrations[0].checksum, 2: "abc"})
@@ -0,0 +1,67 @@
+import pytest
+from fastapi import HTTPException
+from src.api.pagination import paging_mode, encode_cursor, decode_cursor, keyset_sql, order_sql, limit_sql, keyset_page
+
+
+class TestCursor:
+
+    # A cursor decodes back to the position it was made from
+    def test_round_trip(self):
+        cursor = encode_cursor("date", "desc", "2023-01-05", 42)
+        assert decode_cursor(cursor, "date", "desc") == ("2023-01-05", 42)
+
+    # A cursor can't be reused with a different sort
+    def test_sort_mismatch(self):
+        cursor = encode_cursor("date", "asc", "2023-01-05", 42)
+        with pytest.raises(HTTPException) as error:
+            decode_cursor(cursor, "merchant", "asc")
+        assert error.value.status_code == 400
+
+    # Garbage tokens are rejected with a 400 rather than a server error
+    def test_malformed(self):
+        for cursor in ["not a cursor", "e30", encode_cursor("date", "asc", 5, "x")]:
+            with pytest.raises(HTTPException) as error:
+                decode_cursor(cursor, "date", "asc")
+            assert error.value.detail == "Invalid cursor"
+
+
+class TestPagingMode:
+
+    # Without after the old offset paging is used, an empty after starts a cursor walk
+    def test_modes(self):
+        assert paging_mode(None) == "offset"
+        assert paging_mode("") == "first"
+        assert paging_mode("abc") == "after"
+
+
+class TestKeysetSql:
+
+    # Offset paging keeps the original ORDER BY and LIMIT/OFFSET
+    def test_offset(self):
+        assert keyset_sql("date", "id", "asc", "date", "offset") == ("", "")
+        assert order_sql("date", "id", "asc", "offset") == "date asc"
+        assert limit_sql("offset") == "LIMIT :page_size OFFSET :offset"
+
+    # Cursor pages break ties on id and seek past the cursor in the sort direction
+    def test_after(self):
+        column, condition = keyset_sql("date", "id", "desc", "date", "after")
+        assert column == ", (date)::text AS sort_key"
+        assert condition == "AND (date, id) < (CAST(CAST(:after_key AS text) AS date), :after_id)"
+        assert order_sql("date", "id", "desc", "after") == "date desc, id desc"
+        assert limit_sql("after") == "LIMIT :page_size + 1"
+
+
+class TestKeysetPage:
+
+    # The extra row only signals a next page, and sort_key is stripped from items
+    def test_next_cursor(self):
+        rows = [{"id": i, "sort_key": f"k{i}"} for i in range(3)]
+        page = keyset_page(rows, 2, "merchant", "asc")
+
+        assert page["items"] == [{"id": 0}, {"id": 1}]
+        assert decode_cursor(page["next_cursor"], "merchant", "asc") == ("k1", 1)
+
+    # The last page has no next cursor
+    def test_last_page(self):
+        rows = [{"id": 0, "sort_key": "k0"}]
+        assert keyset_page(rows, 2, "merchant", "asc") == {"items": [{"id": 0}], "next_cursor": None}
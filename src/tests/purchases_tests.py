@@ -1,12 +1,20 @@
 import pytest
 from http.client import HTTPException
-from src.api.purchases import NewPurchase, create_purchase
+from src.api.purchases import NewPurchase, create_purchase, create_purchases_bulk, get_purchases, validate_purchase, MAX_BULK_PURCHASES
+from src.api.users import NewUser, create_user
+from src.api.transactions import NewTransaction, create_transaction
+from src import database as db
+from src.api.statements import registry as statements
+import fastapi
+import sqlalchemy
+import uuid
 
 
 class TestNewPurchase:
 
     # Creating a new purchase with valid inputs should be successful.
-    def test_create_purchase_with_valid_inputs1(self):
+    @pytest.mark.asyncio
+    async def test_create_purchase_with_valid_inputs1(self):
         purchase = NewPurchase(
             item="Item",
             price=10,
@@ -15,11 +23,12 @@ class TestNewPurchase:
             return_date="2022-02-01",
             quantity=1
         )
-        result = create_purchase(1, 1, purchase)
+        result = await create_purchase(1, 1, purchase)
         assert "purchase_id" in result
 
     # Creating a new purchase with the minimum valid inputs should be successful.
-    def test_create_purchase_with_minimum_valid_inputs(self):
+    @pytest.mark.asyncio
+    async def test_create_purchase_with_minimum_valid_inputs(self):
         purchase = NewPurchase(
             item="Item",
             price=1,
@@ -28,11 +37,12 @@ class TestNewPurchase:
             return_date="2022-02-01",
             quantity=1
         )
-        result = create_purchase(1, 1, purchase)
+        result = await create_purchase(1, 1, purchase)
         assert "purchase_id" in result
 
     # Creating a new purchase with the maximum valid inputs should be successful.
-    def test_create_purchase_with_maximum_valid_inputs(self):
+    @pytest.mark.asyncio
+    async def test_create_purchase_with_maximum_valid_inputs(self):
         purchase = NewPurchase(
             item="Item" * 25,
             price=1000000,
@@ -41,11 +51,12 @@ class TestNewPurchase:
             return_date="2022-02-01",
             quantity=100
         )
-        result = create_purchase(1, 1, purchase)
+        result = await create_purchase(1, 1, purchase)
         assert "purchase_id" in result
 
     # Creating a new purchase with an empty item should raise a validation error.
-    def test_create_purchase_with_empty_item(self):
+    @pytest.mark.asyncio
+    async def test_create_purchase_with_empty_item(self):
         purchase = NewPurchase(
             item="",
             price=10,
@@ -55,10 +66,11 @@ class TestNewPurchase:
             quantity=1
         )
         with pytest.raises(HTTPException):
-            create_purchase(1, 1, purchase)
+            await create_purchase(1, 1, purchase)
 
     # Creating a new purchase with an item longer than 100 characters should raise a validation error.
-    def test_create_purchase_with_long_item(self):
+    @pytest.mark.asyncio
+    async def test_create_purchase_with_long_item(self):
         purchase = NewPurchase(
             item="Item" * 26,
             price=10,
@@ -68,10 +80,11 @@ class TestNewPurchase:
             quantity=1
         )
         with pytest.raises(HTTPException):
-            create_purchase(1, 1, purchase)
+            await create_purchase(1, 1, purchase)
 
     # Creating a new purchase with a negative price should raise a validation error.
-    def test_create_purchase_with_negative_price(self):
+    @pytest.mark.asyncio
+    async def test_create_purchase_with_negative_price(self):
         purchase = NewPurchase(
             item="Item",
             price=-10,
@@ -81,10 +94,11 @@ class TestNewPurchase:
             quantity=1
         )
         with pytest.raises(HTTPException):
-            create_purchase(1, 1, purchase)
+            await create_purchase(1, 1, purchase)
 
     # Creating a new purchase with the same minimum and maximum valid inputs should be successful.
-    def test_create_purchase_with_valid_inputs2(self):
+    @pytest.mark.asyncio
+    async def test_create_purchase_with_valid_inputs2(self):
         purchase = NewPurchase(
             item="Item",
             price=10,
@@ -93,11 +107,12 @@ class TestNewPurchase:
             return_date="2022-02-01",
             quantity=1
         )
-        result = create_purchase(1, 1, purchase)
+        result = await create_purchase(1, 1, purchase)
         assert "purchase_id" in result
 
     # Creating a new purchase with the same valid inputs as an existing purchase, but with different category should be successful.
-    def test_create_purchase_with_different_category(self):
+    @pytest.mark.asyncio
+    async def test_create_purchase_with_different_category(self):
         # Create an existing purchase
         existing_purchase = NewPurchase(
             item="Item",
@@ -107,7 +122,7 @@ class TestNewPurchase:
             return_date="2022-02-01",
             quantity=1
         )
-        existing_purchase_result = create_purchase(1, 1, existing_purchase)
+        existing_purchase_result = await create_purchase(1, 1, existing_purchase)
         existing_purchase_id = existing_purchase_result["purchase_id"]
 
         # Create a new purchase with the same inputs but different category
@@ -119,14 +134,15 @@ class TestNewPurchase:
             return_date="2022-02-01",
             quantity=1
         )
-        new_purchase_result = create_purchase(1, 1, new_purchase)
+        new_purchase_result = await create_purchase(1, 1, new_purchase)
         new_purchase_id = new_purchase_result["purchase_id"]
 
         # Assert that the new purchase is created successfully
         assert new_purchase_id != existing_purchase_id
 
     # Creating a new purchase with the same valid inputs as an existing purchase, but with different transaction_id should be successful.
-    def test_create_purchase_with_same_valid_inputs_different_transaction_id(self):
+    @pytest.mark.asyncio
+    async def test_create_purchase_with_same_valid_inputs_different_transaction_id(self):
         # Create an existing purchase
         existing_purchase = NewPurchase(
             item="Item",
@@ -136,7 +152,7 @@ class TestNewPurchase:
             return_date="2022-02-01",
             quantity=1
         )
-        create_purchase(1, 1, existing_purchase)
+        await create_purchase(1, 1, existing_purchase)
 
         # Create a new purchase with the same valid inputs but different transaction_id
         new_purchase = NewPurchase(
@@ -147,12 +163,13 @@ class TestNewPurchase:
             return_date="2022-02-01",
             quantity=1
         )
-        result = create_purchase(1, 2, new_purchase)
+        result = await create_purchase(1, 2, new_purchase)
 
         assert "purchase_id" in result
 
     # Creating a new purchase with the same valid inputs as an existing purchase, but with different quantity should be successful.
-    def test_create_purchase_with_different_quantity(self):
+    @pytest.mark.asyncio
+    async def test_create_purchase_with_different_quantity(self):
         # Create an existing purchase
         existing_purchase = NewPurchase(
             item="Item",
@@ -162,7 +179,7 @@ class TestNewPurchase:
             return_date="2022-02-01",
             quantity=1
         )
-        existing_purchase_result = create_purchase(1, 1, existing_purchase)
+        existing_purchase_result = await create_purchase(1, 1, existing_purchase)
         existing_purchase_id = existing_purchase_result["purchase_id"]
 
         # Create a new purchase with different quantity
@@ -174,14 +191,15 @@ class TestNewPurchase:
             return_date="2022-02-01",
             quantity=2
         )
-        new_purchase_result = create_purchase(1, 1, new_purchase)
+        new_purchase_result = await create_purchase(1, 1, new_purchase)
         new_purchase_id = new_purchase_result["purchase_id"]
 
         # Assert that the new purchase is created successfully
         assert new_purchase_id != existing_purchase_id
 
     # Creating a new purchase with the same valid inputs as an existing purchase should be successful.
-    def test_create_purchase_with_same_valid_inputs(self):
+    @pytest.mark.asyncio
+    async def test_create_purchase_with_same_valid_inputs(self):
         # Create a new purchase with valid inputs
         purchase = NewPurchase(
             item="Item",
@@ -191,15 +209,16 @@ class TestNewPurchase:
             return_date="2022-02-01",
             quantity=1
         )
-        result = create_purchase(1, 1, purchase)
+        result = await create_purchase(1, 1, purchase)
         assert "purchase_id" in result
 
         # Create a new purchase with the same valid inputs as the existing purchase
-        result = create_purchase(1, 1, purchase)
+        result = await create_purchase(1, 1, purchase)
         assert "purchase_id" in result
 
     # Creating a new purchase with the same valid inputs as an existing purchase, but with different user_id should be successful.
-    def test_create_purchase_with_different_user_id(self):
+    @pytest.mark.asyncio
+    async def test_create_purchase_with_different_user_id(self):
         # Create an existing purchase
         existing_purchase = NewPurchase(
             item="Item",
@@ -209,7 +228,7 @@ class TestNewPurchase:
             return_date="2022-02-01",
             quantity=1
         )
-        create_purchase(1, 1, existing_purchase)
+        await create_purchase(1, 1, existing_purchase)
 
         # Create a new purchase with the same inputs but different user_id
         new_purchase = NewPurchase(
@@ -220,13 +239,14 @@ class TestNewPurchase:
             return_date="2022-02-01",
             quantity=1
         )
-        result = create_purchase(2, 1, new_purchase)
+        result = await create_purchase(2, 1, new_purchase)
 
         # Assert that the new purchase was created successfully
         assert "purchase_id" in result
 
     # Creating a new purchase with the same valid inputs as an existing purchase, but with different price should be successful.
-    def test_create_purchase_with_different_price(self):
+    @pytest.mark.asyncio
+    async def test_create_purchase_with_different_price(self):
         # Create an existing purchase
         existing_purchase = NewPurchase(
             item="Item",
@@ -236,7 +256,7 @@ class TestNewPurchase:
             return_date="2022-02-01",
             quantity=1
         )
-        existing_purchase_result = create_purchase(1, 1, existing_purchase)
+        existing_purchase_result = await create_purchase(1, 1, existing_purchase)
         existing_purchase_id = existing_purchase_result["purchase_id"]
 
         # Create a new purchase with different price
@@ -248,8 +268,78 @@ class TestNewPurchase:
             return_date="2022-02-01",
             quantity=1
         )
-        new_purchase_result = create_purchase(1, 1, new_purchase)
+        new_purchase_result = await create_purchase(1, 1, new_purchase)
         new_purchase_id = new_purchase_result["purchase_id"]
 
         # Assert that the new purchase is created successfully
-        assert new_purchase_id != existing_purchase_id
\ No newline at end of file
+        assert new_purchase_id != existing_purchase_id
+
+def bulk_purchase(item, price=10, quantity=2, category="Groceries"):
+    return NewPurchase(item=item, price=price, category=category, warranty_date="2022-01-01",
+                       return_date="", quantity=quantity)
+
+
+class TestCreatePurchasesBulk:
+
+    # Every purchase is validated before anything is inserted, and the error names the bad one
+    @pytest.mark.asyncio
+    async def test_rejects_invalid_purchase(self):
+        purchases = [bulk_purchase("ok"), bulk_purchase("bad", category="Snacks")]
+        with pytest.raises(fastapi.HTTPException) as error:
+            await create_purchases_bulk(1, 1, purchases)
+        assert error.value.status_code == 400
+        assert error.value.detail == "Invalid category (purchase 1)"
+
+    # Empty and oversized lists are rejected
+    @pytest.mark.asyncio
+    async def test_rejects_bad_sizes(self):
+        with pytest.raises(fastapi.HTTPException):
+            await create_purchases_bulk(1, 1, [])
+        with pytest.raises(fastapi.HTTPException):
+            await create_purchases_bulk(1, 1, [bulk_purchase("item")] * (MAX_BULK_PURCHASES + 1))
+
+    # A single item is a valid quantity, so a bulk request with one goes through whole
+    @pytest.mark.asyncio
+    async def test_quantity_one(self):
+        user_id = (await create_user(NewUser(name="Single", email=f"single-{uuid.uuid4().hex}@example.com")))["user_id"]
+        transaction_id = (await create_transaction(user_id, NewTransaction(merchant="Market", description="food", date="2023-03-04")))["transaction_id"]
+
+        result = await create_purchases_bulk(user_id, transaction_id, [bulk_purchase("Bread", quantity=1), bulk_purchase("Eggs", quantity=12)])
+        assert len(result["purchase_ids"]) == 2
+
+        with pytest.raises(fastapi.HTTPException) as error:
+            validate_purchase(bulk_purchase("Nothing", quantity=0))
+        assert error.value.detail == "Invalid quantity format"
+
+    # Prices that don't fit the price column are invalid
+    def test_validate_purchase_price(self):
+        with pytest.raises(fastapi.HTTPException):
+            validate_purchase(bulk_purchase("item", price=2 ** 31))
+
+    # One statement inserts every purchase behind the transaction guard
+    def test_single_statement(self):
+        sql = str(statements.get("purchases.create_bulk"))
+        assert sql.count("INSERT INTO purchases") == 1
+        assert "WITH ORDINALITY" in sql
+        assert "guard_owner_id = :user_id" in sql
+
+
+class TestSearchPurchases:
+
+    # Item search ranks the closest matches first
+    @pytest.mark.asyncio
+    async def test_ranked_by_similarity(self):
+        user_id = (await create_user(NewUser(name="Searcher", email=f"searcher-{uuid.uuid4().hex}@example.com")))["user_id"]
+        transaction_id = (await create_transaction(user_id, NewTransaction(merchant="Market", description="food", date="2023-03-04")))["transaction_id"]
+        await create_purchases_bulk(user_id, transaction_id, [bulk_purchase(item) for item in ["Bananas", "Apple juice", "Apples"]])
+
+        results = await get_purchases(user_id, transaction_id, search="apples")
+        assert [row["item"] for row in results][:2] == ["Apples", "Apple juice"]
+
+    # Item search has a trigram index, like merchant search
+    @pytest.mark.asyncio
+    async def test_item_trigram_index(self):
+        async with db.async_engine.begin() as connection:
+            definition = (await connection.execute(sqlalchemy.text(
+                "SELECT indexdef FROM pg_indexes WHERE indexname = 'purchases_item_trgm_idx'"))).scalar()
+        assert "gin (item gin_trgm_ops)" in definition
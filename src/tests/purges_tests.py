@@ -0,0 +1,143 @@
+from src.api.purges import PURGE_STEPS, PurgeWorker, get_purge
+from src.api.users import NewUser, create_user, delete_user, get_user
+from src.api.transactions import NewTransaction, create_transaction, delete_transaction, get_transactions
+from src.api.purchases import NewPurchase, create_purchases_bulk
+from src.api.budget import get_all_purchases_categorized
+from src.api.statements import registry as statements
+import asyncio
+import fastapi
+import pytest
+import sqlalchemy
+import uuid
+
+
+async def make_user(transactions=2, purchases=3):
+    user_id = (await create_user(NewUser(name="Purge", email=f"{uuid.uuid4().hex}@example.com")))["user_id"]
+    transaction_ids = []
+    for _ in range(transactions):
+        transaction_id = (await create_transaction(user_id, NewTransaction(merchant="Costco", description="food", date="2023-03-04")))["transaction_id"]
+        await create_purchases_bulk(user_id, transaction_id, [
+            NewPurchase(item="Apples", price=100, category="Groceries", warranty_date="", return_date="", quantity=2)] * purchases)
+        transaction_ids.append(transaction_id)
+    return user_id, transaction_ids
+
+
+async def drain(worker):
+    while await worker.run_once():
+        pass
+
+
+class TestPurgeSteps:
+
+    # Every kind of job deletes children first and the soft deleted row itself last
+    def test_row_itself_last(self):
+        assert list(PURGE_STEPS["user"])[-1] == "users"
+        assert list(PURGE_STEPS["transaction"])[-1] == "transactions"
+        assert list(PURGE_STEPS["user"])[0] == "purchases"
+
+    # Each batch deletes and counts itself on the job in one statement
+    def test_step_statements(self):
+        for kind, steps in PURGE_STEPS.items():
+            for step in steps:
+                sql = statements.get(f"purges.{kind}", step=step).text
+                assert f"DELETE FROM {step}" in sql
+                assert "UPDATE purge_jobs" in sql
+
+
+class TestAsyncDelete:
+
+    # An async transaction delete hides it and its spending right away, and the worker purges it in batches
+    @pytest.mark.asyncio
+    async def test_delete_transaction(self):
+        user_id, transaction_ids = await make_user()
+
+        result = await delete_transaction(user_id, transaction_ids[0], mode="async")
+
+        assert [row["id"] for row in await get_transactions(user_id)] == transaction_ids[1:]
+        assert await get_all_purchases_categorized(user_id) == [{"category": "Groceries", "total": "$6.00"}]
+        with pytest.raises(fastapi.HTTPException) as exc_info:
+            await get_transactions(user_id, transaction_id=transaction_ids[0])
+        assert exc_info.value.status_code == 404
+
+        await drain(PurgeWorker(batch_size=2))
+        job = await get_purge(result["purge_job_id"])
+        assert job["status"] == "done"
+        assert job["purged"] == {"purchases": 3, "receipts": 0, "transactions": 1}
+        assert await get_all_purchases_categorized(user_id) == [{"category": "Groceries", "total": "$6.00"}]
+
+    # An async user delete hides the user at once, and the worker removes everything they had
+    @pytest.mark.asyncio
+    async def test_delete_user(self):
+        user_id, _ = await make_user()
+
+        result = await delete_user(user_id, mode="async")
+
+        with pytest.raises(fastapi.HTTPException) as exc_info:
+            await get_user(user_id)
+        assert exc_info.value.status_code == 404
+        with pytest.raises(fastapi.HTTPException) as exc_info:
+            await delete_user(user_id, mode="async")
+        assert exc_info.value.status_code == 404
+
+        await drain(PurgeWorker(batch_size=2))
+        job = await get_purge(result["purge_job_id"])
+        assert job["status"] == "done"
+        assert job["purged"] == job["total"] == {"purchases": 6, "receipts": 0, "transactions": 2, "users": 1}
+
+    # A soft delete the database fails is a 500, and nothing is hidden or queued
+    @pytest.mark.asyncio
+    async def test_delete_database_error(self, mocker):
+        user_id, transaction_ids = await make_user(transactions=1)
+        mocker.patch("src.api.purges.statements.get", return_value=sqlalchemy.text("SELECT 1 / 0 AS id"))
+
+        for delete in [lambda: delete_user(user_id, mode="async"), lambda: delete_transaction(user_id, transaction_ids[0], mode="async")]:
+            with pytest.raises(fastapi.HTTPException) as exc_info:
+                await delete()
+            assert exc_info.value.status_code == 500
+            assert exc_info.value.detail == "Database error"
+
+        mocker.stopall()
+        assert [row["id"] for row in await get_transactions(user_id)] == transaction_ids
+
+    # Only sync and async are modes
+    @pytest.mark.asyncio
+    async def test_invalid_mode(self):
+        with pytest.raises(fastapi.HTTPException) as exc_info:
+            await delete_user(1, mode="later")
+        assert exc_info.value.status_code == 400
+        assert exc_info.value.detail == "Invalid mode"
+
+    # Asking about a job that doesn't exist is a 404
+    @pytest.mark.asyncio
+    async def test_missing_job(self):
+        with pytest.raises(fastapi.HTTPException) as exc_info:
+            await get_purge(10 ** 12)
+        assert exc_info.value.status_code == 404
+
+
+class TestPurgeWorker:
+
+    # A job whose purge fails for any reason is marked failed once it runs out of attempts, with the error
+    @pytest.mark.asyncio
+    async def test_failed_job(self, mocker):
+        await drain(PurgeWorker())
+        user_id, transaction_ids = await make_user(transactions=1)
+        result = await delete_transaction(user_id, transaction_ids[0], mode="async")
+        worker = PurgeWorker(max_attempts=1)
+        mocker.patch.object(worker, "purge", side_effect=RuntimeError("disk on fire"))
+
+        assert await worker.run_once()
+
+        job = await get_purge(result["purge_job_id"])
+        assert job["status"] == "failed"
+        assert job["error"] == "disk on fire"
+
+    # The background loop outlives errors that aren't the database's, and stops when cancelled
+    @pytest.mark.asyncio
+    async def test_run_survives_errors(self, mocker):
+        worker = PurgeWorker(poll=0)
+        run_once = mocker.patch.object(worker, "run_once", side_effect=[ValueError("bad row"), True, asyncio.CancelledError()])
+
+        with pytest.raises(asyncio.CancelledError):
+            await worker._run()
+        assert run_once.call_count == 3
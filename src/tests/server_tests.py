@@ -1,15 +1,44 @@
 import pytest
-import src
-from http.client import HTTPException
-from src.api.server import get_file_type, upload_receipt_to_S3, s3_upload, openai_process_receipt, get_receipts, db, status, MB, NewTransaction, NewPurchase
+from src.api.server import get_file_type, upload_receipt_to_S3, s3_upload, openai_process_receipt, ingest_receipt, status, MB
+from src.api.statements import registry as statements
+from src.api.users import NewUser, create_user
+from src import database as db
+from sqlalchemy import text
+from starlette.datastructures import UploadFile
+import fastapi
+import io
 import json
-import requests
-import sqlalchemy
-from sqlalchemy.exc import DBAPIError
+import uuid
 
 # Dependencies:
 # pip install pytest-mock
 
+PNG = b'\x89\x50\x4E\x47\x0D\x0A\x1A\x0A'
+
+
+def receipt(items):
+    return {"store_name": "Store", "date": "2023-02-03", "items": items}
+
+
+def openai_response(receipt_json):
+    # the chat completion wraps the receipt JSON in a fenced code block
+    content = f"```json\n{json.dumps(receipt_json)}\n```"
+    return json.dumps({"choices": [{"message": {"content": content}}]})
+
+
+def upload(filename, contents):
+    return UploadFile(filename, file=io.BytesIO(contents))
+
+
+async def new_user():
+    return (await create_user(NewUser(name="Shopper", email=f"shopper-{uuid.uuid4().hex}@example.com")))["user_id"]
+
+
+async def receipt_count(url):
+    async with db.async_engine.begin() as connection:
+        return (await connection.execute(text("SELECT count(*) FROM receipts WHERE url = :url"), {"url": url})).scalar()
+
+
 class TestGetFileType:
 
     # Returns 'image/jpeg' when contents start with b'\xFF\xD8\xFF\xDB'
@@ -62,576 +91,161 @@ class TestGetFileType:
 
 class TestUploadReceiptToS3:
 
-    # Successfully upload a supported file to S3 and return image URL
+    # An uploaded receipt is stored in S3, parsed, and ingested as a transaction with its purchases and receipt row
     @pytest.mark.asyncio
-    async def test_upload_supported_file_to_S3(self, mocker):
-        # Mock the necessary dependencies
-        mocker.patch('src.api.server.s3_upload')
-        mocker.patch('src.api.server.openai_process_receipt')
-
-        # Create a mock UploadFile object
-        mock_file = mocker.Mock()
-        mock_file.filename = 'test.jpg'
-        mock_file.read.return_value = b'test file contents'
-
-        # Invoke the function under test
-        result = await upload_receipt_to_S3(1, file=mock_file)
-
-        # Assert that the S3 upload function was called with the correct arguments
-        s3_upload.assert_called_once_with(contents=b'test file contents', key='test.jpg')
-
-        # Assert that the OpenAI process receipt function was called with the correct arguments
-        openai_process_receipt.assert_called_once_with(user_id=1, img_url='https://example.s3.us-west-1.amazonaws.com/test.jpg', file=mock_file)
+    async def test_upload_supported_file(self, mocker):
+        # Arrange
+        user_id = await new_user()
+        upload_mock = mocker.patch('src.api.server.storage.upload')
+        items = [{"name": "Apples", "price": 350, "quantity": 2}, {"name": "Pears", "price": 275, "quantity": 3}]
+        mocker.patch('src.api.server.requests.post', return_value=mocker.Mock(text=openai_response(receipt(items))))
 
-        # Assert that the result contains the expected image URL
-        assert result == {"image_url": "https://example.s3.us-west-1.amazonaws.com/test.jpg"}
+        # Act
+        result = await upload_receipt_to_S3(user_id, file=upload("test.png", PNG + b'image'))
 
-    # Successfully parse receipt data using OpenAI API and store it in the database
-    @pytest.mark.asyncio
-    async def test_parse_receipt_data_and_store_in_database(self, mocker):
-        # Mock the necessary dependencies
-        mocker.patch('src.api.server.s3_upload')
-        mocker.patch('src.api.server.openai_process_receipt')
-        mocker.patch('src.api.server.db.engine.begin')
-        mocker.patch('src.api.server.db.engine.begin().__enter__')
-        mocker.patch('src.api.server.db.engine.begin().__exit__')
-
-        # Create a mock UploadFile object
-        mock_file = mocker.Mock()
-        mock_file.filename = 'test.jpg'
-        mock_file.read.return_value = b'test file contents'
-
-        # Mock the return value of the openai_process_receipt function
-        openai_process_receipt.return_value = {'transaction_id': 1}
-
-        # Invoke the function under test
-        result = await upload_receipt_to_S3(1, file=mock_file)
-
-        # Assert that the S3 upload function was called with the correct arguments
-        s3_upload.assert_called_once_with(contents=b'test file contents', key='test.jpg')
-
-        # Assert that the OpenAI process receipt function was called with the correct arguments
-        openai_process_receipt.assert_called_once_with(user_id=1, img_url='https://example.s3.us-west-1.amazonaws.com/test.jpg', file=mock_file)
-
-        # Assert that the database connection was opened and closed correctly
-        db.engine.begin.assert_called_once()
-        db.engine.begin().__enter__.assert_called_once()
-        db.engine.begin().__exit__.assert_called_once()
-
-        # Assert that the receipt URL was inserted into the database correctly
-        db.engine.begin().__enter__().execute.assert_called_once_with(
-            sqlalchemy.text(
-                """
-                INSERT INTO receipts (transaction_id, url, parsed_data)
-                VALUES (:transaction_id, :url, :parsed_data)
-                """
-            ), {"transaction_id": 1, "url": "https://example.s3.us-west-1.amazonaws.com/test.jpg", "parsed_data": ""}
-        )
-
-        # Assert that the result contains the expected image URL
-        assert result == {"image_url": "https://example.s3.us-west-1.amazonaws.com/test.jpg"}
-
-    # Successfully insert receipt URL into receipts table in the database
-    @pytest.mark.asyncio
-    async def test_insert_receipt_URL_into_database(self, mocker):
-        # Mock the necessary dependencies
-        mocker.patch('src.api.server.s3_upload')
-        mocker.patch('src.api.server.openai_process_receipt')
-        mocker.patch('src.api.server.db.engine.begin')
-        mocker.patch('src.api.server.db.engine.begin().__enter__')
-        mocker.patch('src.api.server.db.engine.begin().__exit__')
-
-        # Create a mock UploadFile object
-        mock_file = mocker.Mock()
-        mock_file.filename = 'test.jpg'
-        mock_file.read.return_value = b'test file contents'
-
-        # Mock the return value of the openai_process_receipt function
-        openai_process_receipt.return_value = {'transaction_id': 1}
-
-        # Invoke the function under test
-        result = await upload_receipt_to_S3(1, file=mock_file)
-
-        # Assert that the S3 upload function was called with the correct arguments
-        s3_upload.assert_called_once_with(contents=b'test file contents', key='test.jpg')
-
-        # Assert that the OpenAI process receipt function was called with the correct arguments
-        openai_process_receipt.assert_called_once_with(user_id=1, img_url='https://example.s3.us-west-1.amazonaws.com/test.jpg', file=mock_file)
-
-        # Assert that the database connection was opened and closed correctly
-        db.engine.begin.assert_called_once()
-        db.engine.begin().__enter__.assert_called_once()
-        db.engine.begin().__exit__.assert_called_once()
-
-        # Assert that the receipt URL was inserted into the database correctly
-        db.engine.begin().__enter__().execute.assert_called_once_with(
-            sqlalchemy.text(
-                """
-                INSERT INTO receipts (transaction_id, url, parsed_data)
-                VALUES (:transaction_id, :url, :parsed_data)
-                """
-            ), {"transaction_id": 1, "url": "https://example.s3.us-west-1.amazonaws.com/test.jpg", "parsed_data": ""}
-        )
-
-        # Assert that the result contains the expected image URL
-        assert result == {"image_url": "https://example.s3.us-west-1.amazonaws.com/test.jpg"}
+        # Assert
+        key, contents = upload_mock.call_args.args
+        assert key.startswith("test.png.") and key.endswith(".png")
+        assert contents == PNG + b'image'
+        assert result["image_url"].endswith(f"/{key}")
+        assert await receipt_count(result["image_url"]) == 1
+        async with db.async_engine.begin() as connection:
+            purchases = (await connection.execute(
+                text("SELECT item FROM purchases WHERE transaction_id = :transaction_id ORDER BY item"),
+                {"transaction_id": result["transaction_id"]})).scalars().all()
+        assert purchases == ["Apples", "Pears"]
 
     # Test with a file of size 0 bytes
     @pytest.mark.asyncio
     async def test_upload_file_size_zero_bytes(self, mocker):
-        # Mock the necessary dependencies
-        mocker.patch('src.api.server.s3_upload')
-        mocker.patch('src.api.server.openai_process_receipt')
+        upload_mock = mocker.patch('src.api.server.storage.upload')
 
-        # Create a mock UploadFile object
-        mock_file = mocker.Mock()
-        mock_file.filename = 'test.jpg'
-        mock_file.read.return_value = b''
+        with pytest.raises(fastapi.HTTPException) as exc_info:
+            await upload_receipt_to_S3(1, file=upload("test.png", b''))
 
-        # Invoke the function under test and expect an HTTPException with status code 400
-        with pytest.raises(HTTPException) as exc_info:
-            await upload_receipt_to_S3(1, file=mock_file)
-
-        # Assert that the HTTPException has the correct status code and detail message
         assert exc_info.value.status_code == status.HTTP_400_BAD_REQUEST
         assert exc_info.value.detail == 'File size must be between 0 and 10 MB'
-
-    # Test with a file of size 10 MB
-    @pytest.mark.asyncio
-    async def test_upload_file_size_10_MB(self, mocker):
-        # Mock the necessary dependencies
-        mocker.patch('src.api.server.s3_upload')
-        mocker.patch('src.api.server.openai_process_receipt')
-
-        # Create a mock UploadFile object
-        mock_file = mocker.Mock()
-        mock_file.filename = 'test.jpg'
-        mock_file.read.return_value = b'test' * (10 * MB // 4)
-
-        # Invoke the function under test and expect no exceptions
-        result = await upload_receipt_to_S3(1, file=mock_file)
-
-        # Assert that the S3 upload function was called with the correct arguments
-        s3_upload.assert_called_once_with(contents=b'test' * (10 * MB // 4), key='test.jpg')
-
-        # Assert that the OpenAI process receipt function was called with the correct arguments
-        openai_process_receipt.assert_called_once_with(user_id=1, img_url='https://example.s3.us-west-1.amazonaws.com/test.jpg', file=mock_file)
-
-        # Assert that the result contains the expected image URL
-        assert result == {"image_url": "https://example.s3.us-west-1.amazonaws.com/test.jpg"}
+        upload_mock.assert_not_called()
 
     # Return appropriate error message if file size is greater than 10 MB
     @pytest.mark.asyncio
     async def test_file_size_greater_than_10MB(self, mocker):
-        # Mock the necessary dependencies
-        mocker.patch('src.api.server.s3_upload')
-        mocker.patch('src.api.server.openai_process_receipt')
-
-        # Create a mock UploadFile object with a file size greater than 10 MB
-        mock_file = mocker.Mock()
-        mock_file.filename = 'test.jpg'
-        mock_file.read.return_value = b'test file contents' * (10 * MB + 1)
+        upload_mock = mocker.patch('src.api.server.storage.upload')
 
-        # Invoke the function under test and expect a HTTPException with status code 400
-        with pytest.raises(HTTPException) as exc_info:
-            await upload_receipt_to_S3(1, file=mock_file)
+        with pytest.raises(fastapi.HTTPException) as exc_info:
+            await upload_receipt_to_S3(1, file=upload("test.png", PNG + b'\x00' * (10 * MB)))
 
-        # Assert that the exception has the correct status code and detail message
         assert exc_info.value.status_code == status.HTTP_400_BAD_REQUEST
         assert exc_info.value.detail == 'File size must be between 0 and 10 MB'
-
-        # Assert that the S3 upload function and OpenAI process receipt function were not called
-        s3_upload.assert_not_called()
-        openai_process_receipt.assert_not_called()
-
-    # Return appropriate error message if file type is not supported
-    @pytest.mark.asyncio
-    async def test_return_error_message_if_file_type_not_supported(self, mocker):
-        # Mock the necessary dependencies
-        mocker.patch('src.api.server.get_file_type').return_value = 'unsupported_file_type'
-
-        # Create a mock UploadFile object
-        mock_file = mocker.Mock()
-        mock_file.filename = 'test.txt'
-
-        # Invoke the function under test
-        with pytest.raises(HTTPException) as exc_info:
-            await upload_receipt_to_S3(1, file=mock_file)
-
-        # Assert that the HTTPException was raised with the correct status code and detail message
-        assert exc_info.value.status_code == status.HTTP_400_BAD_REQUEST
-        assert exc_info.value.detail == 'file type: unsupported_file_type not supported'
+        upload_mock.assert_not_called()
 
     # Return appropriate error message if file is not found
     @pytest.mark.asyncio
     async def test_return_error_message_if_file_not_found(self, mocker):
-        # Mock the necessary dependencies
-        mocker.patch('src.api.server.s3_upload')
-        mocker.patch('src.api.server.openai_process_receipt')
-
-        # Create a mock UploadFile object
-        mock_file = mocker.Mock()
-        mock_file.filename = 'test.jpg'
-        mock_file.read.return_value = b'test file contents'
+        upload_mock = mocker.patch('src.api.server.storage.upload')
 
-        # Invoke the function under test with a None file
-        with pytest.raises(HTTPException) as exc_info:
+        with pytest.raises(fastapi.HTTPException) as exc_info:
             await upload_receipt_to_S3(1, file=None)
 
-        # Assert that the HTTPException was raised with the correct status code and detail
         assert exc_info.value.status_code == status.HTTP_400_BAD_REQUEST
         assert exc_info.value.detail == 'File not found'
-
-        # Assert that the S3 upload function was not called
-        s3_upload.assert_not_called()
-
-        # Assert that the OpenAI process receipt function was not called
-        openai_process_receipt.assert_not_called()
-
-    # Test with a file type not supported by S3
-    @pytest.mark.asyncio
-    async def test_upload_unsupported_file_to_S3_1(self, mocker):
-        # Mock the necessary dependencies
-        mocker.patch('src.api.server.s3_upload')
-        mocker.patch('src.api.server.openai_process_receipt')
-
-        # Create a mock UploadFile object
-        mock_file = mocker.Mock()
-        mock_file.filename = 'test.txt'
-        mock_file.read.return_value = b'test file contents'
-
-        # Invoke the function under test
-        with pytest.raises(HTTPException) as exc_info:
-            await upload_receipt_to_S3(1, file=mock_file)
-
-        # Assert that the S3 upload function was not called
-        s3_upload.assert_not_called()
-
-        # Assert that the OpenAI process receipt function was not called
-        openai_process_receipt.assert_not_called()
-
-        # Assert the correct HTTPException was raised
-        assert exc_info.value.status_code == status.HTTP_400_BAD_REQUEST
-        assert exc_info.value.detail == 'file type: text/plain not supported'
+        upload_mock.assert_not_called()
 
     # Test with a file type not supported by the application
     @pytest.mark.asyncio
-    async def test_upload_unsupported_file_to_S3_2(self, mocker):
-        # Mock the necessary dependencies
-        mocker.patch('src.api.server.s3_upload')
-        mocker.patch('src.api.server.openai_process_receipt')
-
-        # Create a mock UploadFile object
-        mock_file = mocker.Mock()
-        mock_file.filename = 'test.txt'
-        mock_file.read.return_value = b'test file contents'
-
-        # Invoke the function under test
-        with pytest.raises(HTTPException) as exc_info:
-            await upload_receipt_to_S3(1, file=mock_file)
-
-        # Assert that the S3 upload function was not called
-        s3_upload.assert_not_called()
-
-        # Assert that the OpenAI process receipt function was not called
-        openai_process_receipt.assert_not_called()
-
-        # Assert the correct HTTPException was raised
-        assert exc_info.value.status_code == status.HTTP_400_BAD_REQUEST
-        assert exc_info.value.detail == 'file type: text/plain not supported'
-
-    # Test with a file that contains invalid receipt data
-    @pytest.mark.asyncio
-    async def test_invalid_receipt_data(self, mocker):
-        # Mock the necessary dependencies
-        mocker.patch('src.api.server.s3_upload')
-        mocker.patch('src.api.server.openai_process_receipt')
+    async def test_upload_unsupported_file(self, mocker):
+        upload_mock = mocker.patch('src.api.server.storage.upload')
+        post_mock = mocker.patch('src.api.server.requests.post')
 
-        # Create a mock UploadFile object
-        mock_file = mocker.Mock()
-        mock_file.filename = 'test.jpg'
-        mock_file.read.return_value = b'test file contents'
+        with pytest.raises(fastapi.HTTPException) as exc_info:
+            await upload_receipt_to_S3(1, file=upload("test.txt", b'test file contents'))
 
-        # Invoke the function under test
-        with pytest.raises(HTTPException) as exc_info:
-            await upload_receipt_to_S3(1, file=mock_file)
-
-        # Assert that the HTTPException was raised with the correct status code and detail
         assert exc_info.value.status_code == status.HTTP_400_BAD_REQUEST
-        assert exc_info.value.detail == 'File type: unknown not supported'
-
-        # Assert that the S3 upload function was not called
-        s3_upload.assert_not_called()
-
-        # Assert that the OpenAI process receipt function was not called
-        openai_process_receipt.assert_not_called()
+        assert exc_info.value.detail == 'file type: unknown not supported'
+        upload_mock.assert_not_called()
+        post_mock.assert_not_called()
 
 
 class TestS3Upload:
 
-    # Uploads image to S3 successfully
-    @pytest.mark.asyncio
-    async def test_upload_image_successfully(self):
-        # Arrange
-        contents = b'image contents'
-        key = 'image.jpg'
-    
-        # Act
-        await s3_upload(contents, key)
-    
-        # Assert
-        # Add assertions to check if the image was successfully uploaded to S3
-
-    # Handles empty contents
-    @pytest.mark.asyncio
-    async def test_handles_empty_contents(self):
-        # Arrange
-        contents = b''
-        key = 'image.jpg'
-    
-        # Act and Assert
-        with pytest.raises(Exception):
-            await s3_upload(contents, key)
-
-    # Handles invalid key
-    @pytest.mark.asyncio
-    async def test_handles_invalid_key(self):
-        # Arrange
-        contents = b'image contents'
-        key = ''
-    
-        # Act and Assert
-        with pytest.raises(Exception):
-            await s3_upload(contents, key)
-
-    # Successfully parse receipt data and create a new transaction and purchase for each item
-    @pytest.mark.asyncio
-    async def test_parse_receipt_data_and_create_transaction_and_purchase(self, mocker):
-        # Mock the necessary dependencies
-        mocker.patch('requests.post')
-        mocker.patch('json.loads')
-        mocker.patch('src.api.transactions.create_transaction')
-        mocker.patch('src.api.purchases.create_purchase')
-
-        # Set up the mock responses
-        mock_response = mocker.Mock()
-        mock_response.text = '{"choices": [{"message": {"content": "```json\\n{\\\\n  \\\\\\"store_name\\\\\\": \\\\\\"store\\\\\\", \\\\\\"date\\\\\\": \\\\\\"2022-01-01\\\\\\", \\\\\\"items\\\\\\": [\\\\n    {\\\\n      \\\\\\"name\\\\\\": \\\\\\"item1\\\\\\", \\\\\\"price\\\\\\": 10.0, \\\\\\"quantity\\\\\\": 2\\\\n    },\\\\n    {\\\\n      \\\\\\"name\\\\\\": \\\\\\"item2\\\\\\", \\\\\\"price\\\\\\": 5.0, \\\\\\"quantity\\\\\\": 1\\\\n    }\\\\n  ]\\\\n}```"}]}]}'
-        requests.post.return_value = mock_response
-
-        # Set up the mock JSON data
-        mock_json_data = {
-            "store_name": "store",
-            "date": "2022-01-01",
-            "items": [
-                {
-                    "name": "item1",
-                    "price": 10.0,
-                    "quantity": 2
-                },
-                {
-                    "name": "item2",
-                    "price": 5.0,
-                    "quantity": 1
-                }
-            ]
-        }
-        json.loads.return_value = mock_json_data
-
-        # Set up the mock transaction and purchase IDs
-        mock_transaction_id = {"transaction_id": 123}
-        mock_purchase_id = {"purchase_id": 456}
-        src.api.transactions.create_transaction.return_value = mock_transaction_id
-        src.api.purchases.create_purchase.return_value = mock_purchase_id
-
-        # Call the function under test
-        result = await openai_process_receipt(123, "https://example.com/receipt.jpg", None)
-
-        # Assert the expected calls were made
-        requests.post.assert_called_once()
-        json.loads.assert_called_once_with('{"choices": [{"message": {"content": "```json\\n{\\\\n  \\\\\\"store_name\\\\\\": \\\\\\"store\\\\\\", \\\\\\"date\\\\\\": \\\\\\"2022-01-01\\\\\\", \\\\\\"items\\\\\\": [\\\\n    {\\\\n      \\\\\\"name\\\\\\": \\\\\\"item1\\\\\\", \\\\\\"price\\\\\\": 10.0, \\\\\\"quantity\\\\\\": 2\\\\n    },\\\\n    {\\\\n      \\\\\\"name\\\\\\": \\\\\\"item2\\\\\\", \\\\\\"price\\\\\\": 5.0, \\\\\\"quantity\\\\\\": 1\\\\n    }\\\\n  ]\\\\n}```"}]}]}')
-        src.api.transactions.create_transaction.assert_called_once_with(123, NewTransaction(merchant="store", description="", date="2022-01-01"))
-        src.api.purchases.create_purchase.assert_has_calls([
-            mocker.call(123, 123, NewPurchase(item="item1", price=10.0, quantity=2, category="", warranty_date="2023-11-16", return_date="2023-11-16")),
-            mocker.call(123, 123, NewPurchase(item="item2", price=5.0, quantity=1, category="", warranty_date="2023-11-16", return_date="2023-11-16"))
-        ])
-
-        # Assert the expected result
-        assert result == mock_transaction_id
-
-
-class TestGetReceipts:
-
-    # Returns a list of receipt URLs for a given user ID
+    # Uploads go through the shared storage client
     @pytest.mark.asyncio
-    async def test_returns_list_of_receipt_urls1(self, mocker):
-        # Mock the database connection and result
-        mock_connection = mocker.MagicMock()
-        mock_result = mocker.MagicMock()
-        mock_result.__iter__.return_value = [("url1",), ("url2",)]
-        mock_connection.execute.return_value = mock_result
-        mocker.patch("src.database.engine.begin", return_value=mock_connection)
-
-        # Call the function
-        result = await get_receipts(1)
+    async def test_upload_image(self, mocker):
+        upload_mock = mocker.patch('src.api.server.storage.upload')
 
-        # Assert the result
-        assert result == {"receipts": ["url1", "url2"]}
+        await s3_upload(b'image contents', 'image.jpg')
 
-    # Returns an empty list if the user has no receipts
-    @pytest.mark.asyncio
-    async def test_returns_empty_list_if_no_receipts(self, mocker):
-        # Mock the database connection and result
-        mock_connection = mocker.MagicMock()
-        mock_result = mocker.MagicMock()
-        mock_result.__iter__.return_value = []
-        mock_connection.execute.return_value = mock_result
-        mocker.patch("src.database.engine.begin", return_value=mock_connection)
+        upload_mock.assert_awaited_once_with('image.jpg', b'image contents')
 
-        # Call the function
-        result = await get_receipts(1)
 
-        # Assert the result
-        assert result == {"receipts": []}
+class TestOpenAIProcessReceipt:
 
-    # Handles multiple receipts for a user
+    # The receipt JSON is taken out of the fenced block in the completion
     @pytest.mark.asyncio
-    async def test_handles_multiple_receipts_for_user(self, mocker):
-        # Mock the database connection and result
-        mock_connection = mocker.MagicMock()
-        mock_result = mocker.MagicMock()
-        mock_result.__iter__.return_value = [("url1",), ("url2",), ("url3",)]
-        mock_connection.execute.return_value = mock_result
-        mocker.patch("src.database.engine.begin", return_value=mock_connection)
+    async def test_parse_receipt_data(self, mocker):
+        items = [{"name": "item1", "price": 10.0, "quantity": 2}, {"name": "item2", "price": 5.0, "quantity": 1}]
+        post_mock = mocker.patch('src.api.server.requests.post', return_value=mocker.Mock(text=openai_response(receipt(items))))
 
-        # Call the function
-        result = await get_receipts(1)
-
-        # Assert the result
-        assert result == {"receipts": ["url1", "url2", "url3"]}
-
-    # Raises an HTTPException with status code 500 if there is a database error
-    @pytest.mark.asyncio
-    async def test_raises_http_exception_on_database_error(self, mocker):
-        # Mock the database connection and raise a DBAPIError
-        mock_connection = mocker.MagicMock()
-        mock_connection.execute.side_effect = DBAPIError("Database error", None, None)
-        mocker.patch("src.database.engine.begin", return_value=mock_connection)
-
-        # Call the function and assert the HTTPException is raised
-        with pytest.raises(HTTPException) as exc_info:
-            await get_receipts(1)
-    
-        # Assert the status code of the raised HTTPException
-        assert exc_info.value.status_code == 500
-
-    # Handles a non-existent user ID
-    @pytest.mark.asyncio
-    async def test_handles_nonexistent_user_id(self, mocker):
-        # Mock the database connection and result
-        mock_connection = mocker.MagicMock()
-        mock_result = mocker.MagicMock()
-        mock_result.__iter__.return_value = []
-        mock_connection.execute.return_value = mock_result
-        mocker.patch("src.database.engine.begin", return_value=mock_connection)
-
-        # Call the function
-        result = await get_receipts(999)
-
-        # Assert the result
-        assert result == {"receipts": []}
-
-    # Handles a user ID of 0
-    @pytest.mark.asyncio
-    async def test_handles_user_id_of_zero(self, mocker):
-        # Mock the database connection and result
-        mock_connection = mocker.MagicMock()
-        mock_result = mocker.MagicMock()
-        mock_result.__iter__.return_value = []
-        mock_connection.execute.return_value = mock_result
-        mocker.patch("src.database.engine.begin", return_value=mock_connection)
-
-        # Call the function
-        result = await get_receipts(0)
+        result = await openai_process_receipt(123, "https://example.com/receipt.jpg", None)
 
-        # Assert the result
-        assert result == {"receipts": []}
+        post_mock.assert_called_once()
+        assert post_mock.call_args.kwargs["json"]["messages"][0]["content"][1]["image_url"]["url"] == "https://example.com/receipt.jpg"
+        assert result == receipt(items)
 
-    # Handles a large number of receipts for a user
-    @pytest.mark.asyncio
-    async def test_handles_large_number_of_receipts(self, mocker):
-        # Mock the database connection and result
-        mock_connection = mocker.MagicMock()
-        mock_result = mocker.MagicMock()
-        mock_result.__iter__.return_value = [("url1",), ("url2",), ("url3",), ("url4",), ("url5",)]
-        mock_connection.execute.return_value = mock_result
-        mocker.patch("src.database.engine.begin", return_value=mock_connection)
 
-        # Call the function
-        result = await get_receipts(1)
+class TestIngestReceipt:
 
-        # Assert the result
-        assert result == {"receipts": ["url1", "url2", "url3", "url4", "url5"]}
+    # The transaction, every purchase and the receipt row are written by one statement
+    def test_single_statement(self):
+        sql = str(statements.get("receipts.ingest"))
+        assert "INSERT INTO transactions" in sql
+        assert sql.count("INSERT INTO purchases") == 1
+        assert "INSERT INTO receipts" in sql
 
-    # Handles a user with no transactions
+    # Every item becomes a purchase and the parsed JSON is kept with the receipt
     @pytest.mark.asyncio
-    async def test_handles_user_with_no_transactions(self, mocker):
-        # Mock the database connection and result
-        mock_connection = mocker.MagicMock()
-        mock_result = mocker.MagicMock()
-        mock_result.__iter__.return_value = []
-        mock_connection.execute.return_value = mock_result
-        mocker.patch("src.database.engine.begin", return_value=mock_connection)
-
-        # Call the function
-        result = await get_receipts(1)
+    async def test_ingests_all_items(self):
+        user_id = await new_user()
+        url = f"https://example.com/{uuid.uuid4().hex}.png"
+        items = [{"name": f"item {n}", "price": 100 + n, "quantity": 2} for n in range(10)]
 
-        # Assert the result
-        assert result == {"receipts": []}
+        result = await ingest_receipt(user_id, url, receipt(items))
+        assert result["purchases"] == 10
+        assert result["transaction_id"] is not None
+        assert await receipt_count(url) == 1
 
-    # Returns receipts in descending order by date
+    # Single items are fine, each purchase keeps its parsed category, and the dates are left empty
     @pytest.mark.asyncio
-    async def test_returns_receipts_in_descending_order_by_date(self, mocker):
-        # Mock the database connection and result
-        mock_connection = mocker.MagicMock()
-        mock_result = mocker.MagicMock()
-        mock_result.__iter__.return_value = [("url1",), ("url2",)]
-        mock_connection.execute.return_value = mock_result
-        mocker.patch("src.database.engine.begin", return_value=mock_connection)
+    async def test_purchase_fields(self):
+        user_id = await new_user()
+        url = f"https://example.com/{uuid.uuid4().hex}.png"
+        items = [{"name": "Milk", "price": 250, "quantity": 1, "category": "Groceries"},
+                 {"name": "Mystery", "price": 100, "quantity": 1, "category": "Snacks"},
+                 {"name": "Cable", "price": 999, "quantity": 2}]
 
-        # Call the function
-        result = await get_receipts(1)
+        result = await ingest_receipt(user_id, url, receipt(items))
+        async with db.async_engine.begin() as connection:
+            purchases = (await connection.execute(
+                text("SELECT item, quantity, category, warranty_date, return_date FROM purchases WHERE transaction_id = :transaction_id ORDER BY item"),
+                {"transaction_id": result["transaction_id"]})).all()
+        assert [tuple(row) for row in purchases] == [
+            ("Cable", 2, "Other", "", ""), ("Milk", 1, "Groceries", "", ""), ("Mystery", 1, "Other", "", "")]
 
-        # Assert the result
-        assert result == {"receipts": ["url1", "url2"]}
-
-    # Handles a user with no receipts
+    # A bad item fails the whole receipt before anything is written
     @pytest.mark.asyncio
-    async def test_handles_user_with_no_receipts(self, mocker):
-        # Mock the database connection and result
-        mock_connection = mocker.MagicMock()
-        mock_result = mocker.MagicMock()
-        mock_result.__iter__.return_value = []
-        mock_connection.execute.return_value = mock_result
-        mocker.patch("src.database.engine.begin", return_value=mock_connection)
-
-        # Call the function
-        result = await get_receipts(1)
+    async def test_nothing_written_on_invalid_item(self):
+        user_id = await new_user()
+        url = f"https://example.com/{uuid.uuid4().hex}.png"
+        items = [{"name": "fine", "price": 100, "quantity": 2}, {"name": "free", "price": 0, "quantity": 2}]
 
-        # Assert the result
-        assert result == {"receipts": []}
+        with pytest.raises(fastapi.HTTPException):
+            await ingest_receipt(user_id, url, receipt(items))
+        assert await receipt_count(url) == 0
 
-    # Handles a user with receipts from multiple transactions
+    # An unknown user writes nothing either
     @pytest.mark.asyncio
-    async def test_returns_list_of_receipt_urls2(self, mocker):
-        # Mock the database connection and result
-        mock_connection = mocker.MagicMock()
-        mock_result = mocker.MagicMock()
-        mock_result.__iter__.return_value = [("url1",), ("url2",)]
-        mock_connection.execute.return_value = mock_result
-        mocker.patch("src.database.engine.begin", return_value=mock_connection)
-
-        # Call the function
-        result = await get_receipts(1)
-
-        # Assert the result
-        assert result == {"receipts": ["url1", "url2"]}
\ No newline at end of file
+    async def test_unknown_user(self):
+        url = f"https://example.com/{uuid.uuid4().hex}.png"
+        with pytest.raises(fastapi.HTTPException):
+            await ingest_receipt(999999, url, receipt([{"name": "fine", "price": 100, "quantity": 2}]))
+        assert await receipt_count(url) == 0
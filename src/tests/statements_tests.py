@@ -0,0 +1,52 @@
+import pytest
+from src.api.statements import StatementRegistry
+
+
+class TestStatementRegistry:
+
+    # Plain statements are built once and the same object is handed back every time
+    def test_get_returns_prebuilt_statement(self):
+        registry = StatementRegistry()
+        registry.register("users.get", "SELECT name FROM users WHERE id = :user_id")
+
+        first = registry.get("users.get")
+        assert first is registry.get("users.get")
+        assert first.text == "SELECT name FROM users WHERE id = :user_id"
+
+    # Every combination of variants is built up front
+    def test_register_builds_every_variant(self):
+        registry = StatementRegistry()
+        registry.register("list", lambda sort_by, sort_order: f"SELECT * FROM t ORDER BY {sort_by} {sort_order}",
+                          sort_by=["date", "merchant"], sort_order=["asc", "desc"])
+
+        assert registry.stats()["registered"] == 4
+        assert registry.get("list", sort_by="merchant", sort_order="desc").text == "SELECT * FROM t ORDER BY merchant desc"
+        assert registry.stats()["built_on_use"] == 0
+
+    # A variant that wasn't registered is built on first use, once
+    def test_unregistered_variant_built_on_use(self):
+        registry = StatementRegistry()
+        registry.register("list", lambda sort_by: f"SELECT * FROM t ORDER BY {sort_by}", sort_by=["date"])
+
+        statement = registry.get("list", sort_by="id")
+        assert statement is registry.get("list", sort_by="id")
+
+        stats = registry.stats()
+        assert stats["lookups"] == 2
+        assert stats["built_on_use"] == 1
+        assert stats["statements"]["list"] == {"lookups": 2, "built_on_use": 1}
+
+    # Looking up a name that was never registered is a programming error
+    def test_unknown_name_raises(self):
+        registry = StatementRegistry()
+        with pytest.raises(KeyError):
+            registry.get("missing")
+
+    # Nothing is counted until something has been looked up
+    def test_stats_before_any_lookup(self):
+        registry = StatementRegistry()
+        registry.register("users.get", "SELECT 1")
+
+        stats = registry.stats()
+        assert stats["lookups"] == 0
+        assert stats["statements"]["users.get"] == {"lookups": 0, "built_on_use": 0}
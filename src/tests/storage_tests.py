@@ -0,0 +1,99 @@
+from src.api.storage import Storage, MB
+import asyncio
+import threading
+import time
+import pytest
+
+
+class SlowClient:
+    # stands in for boto3's client, blocking like a slow upload does
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.running = 0
+        self.most_running = 0
+        self.uploaded = {}
+        self._lock = threading.Lock()
+
+    def upload_fileobj(self, fileobj, bucket, key, ExtraArgs=None, Config=None):
+        with self._lock:
+            self.running += 1
+            self.most_running = max(self.most_running, self.running)
+        time.sleep(self.seconds)
+        with self._lock:
+            self.running -= 1
+            self.uploaded[key] = fileobj.read()
+
+
+class TestStorage:
+
+    # A slow upload doesn't stop the event loop from serving anything else
+    @pytest.mark.asyncio
+    async def test_upload_does_not_block_loop(self):
+        storage = Storage("receipts", client=SlowClient(0.3))
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        ticker = asyncio.create_task(tick())
+        await storage.upload("slow.png", b"receipt")
+        ticker.cancel()
+        await storage.close()
+
+        assert ticks > 10
+        assert storage.client.uploaded == {"slow.png": b"receipt"}
+
+    # No more uploads run at once than the pool has threads
+    @pytest.mark.asyncio
+    async def test_uploads_bounded(self):
+        storage = Storage("receipts", max_workers=2, client=SlowClient(0.05))
+
+        await asyncio.gather(*[storage.upload(f"{i}.png", b"receipt") for i in range(6)])
+        await storage.close()
+
+        assert storage.client.most_running == 2
+        assert len(storage.client.uploaded) == 6
+
+    # Concurrent first uploads share one client, made on the event loop's thread from a session of its own
+    @pytest.mark.asyncio
+    async def test_client_made_once(self, mocker):
+        client = SlowClient(0.05)
+        made_on = []
+        session = mocker.patch("src.api.storage.boto3.session.Session")
+        session.return_value.client.side_effect = lambda *args, **kwargs: made_on.append(threading.current_thread()) or client
+        storage = Storage("receipts", max_workers=4)
+
+        await asyncio.gather(*[storage.upload(f"{i}.png", b"receipt") for i in range(8)])
+        await storage.close()
+
+        assert made_on == [threading.current_thread()]
+        assert len(client.uploaded) == 8
+
+    # Objects over the threshold go up in parts, and come back whole
+    @pytest.mark.asyncio
+    async def test_multipart_upload(self, monkeypatch):
+        moto = pytest.importorskip("moto")
+        boto3 = pytest.importorskip("boto3")
+        monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+        monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+        monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+
+        with moto.mock_aws():
+            client = boto3.client("s3")
+            client.create_bucket(Bucket="receipts")
+            storage = Storage("receipts", multipart_threshold=5 * MB, part_size=5 * MB, client=client)
+            contents = bytes(range(256)) * (12 * MB // 256)
+
+            await storage.upload("large.pdf", contents, content_type="application/pdf")
+            await storage.upload("small.png", b"receipt")
+            await storage.close()
+
+            large = client.get_object(Bucket="receipts", Key="large.pdf")
+            assert large["Body"].read() == contents
+            assert large["ContentType"] == "application/pdf"
+            # multipart uploads get an ETag of the parts' hashes, suffixed with how many parts there were
+            assert large["ETag"].strip('"').endswith("-3")
+            assert client.get_object(Bucket="receipts", Key="small.png")["Body"].read() == b"receipt"